@@ -0,0 +1,233 @@
+"""
+Local stand-in for the Twitter API (v1.1 statuses/show and v2 /2/tweets) and the
+video CDN, so the whole request pipeline can be loaded without touching Twitter.
+
+Tweets are generated from their ID: IDs ending in 0-4 are videos, 5-7 images and
+8-9 text, every third tweet quotes another one. IDs ending in 99 belong to a
+protected user.
+
+    python -m benchmarks.fake_upstream --port 8090 --latency 40 --video-size 2000000
+"""
+import argparse
+import asyncio
+import os
+from datetime import datetime, timezone
+
+import sanic
+import sanic.response
+
+upstream = sanic.Sanic("fake-upstream", configure_logging=False)
+
+CREATED_AT = datetime(2022, 6, 1, tzinfo=timezone.utc)
+RESOLUTIONS = ((480, 270, 256000), (640, 360, 832000), (1280, 720, 2176000))
+
+
+def base_url(request):
+    return f"http://{request.host}"
+
+
+def tweet_kind(tweet_id: int) -> str:
+    last = tweet_id % 10
+    if last < 5:
+        return "video"
+    if last < 8:
+        return "photo"
+    return "text"
+
+
+def v1_tweet(request, tweet_id: int, quoted: bool = True) -> dict:
+    kind = tweet_kind(tweet_id)
+    screen_name = f"user{tweet_id % 1000}"
+    tweet = {
+        "id": tweet_id,
+        "id_str": str(tweet_id),
+        "created_at": CREATED_AT.strftime("%a %b %d %H:%M:%S +0000 %Y"),
+        "full_text": f"Benchmark tweet {tweet_id} with some text to clean up https://t.co/{tweet_id:x}",
+        "favorite_count": tweet_id % 5000,
+        "retweet_count": tweet_id % 700,
+        "possibly_sensitive": tweet_id % 17 == 0,
+        "user": {
+            "name": f"User {tweet_id % 1000}",
+            "screen_name": screen_name,
+            "profile_image_url": f"{base_url(request)}/profile/{screen_name}.jpg",
+            "protected": tweet_id % 100 == 99,
+        },
+    }
+    if kind == "video":
+        tweet["extended_entities"] = {
+            "media": [
+                {
+                    "type": "video",
+                    "media_url": f"{base_url(request)}/thumb/{tweet_id}.jpg",
+                    "media_url_https": f"{base_url(request)}/thumb/{tweet_id}.jpg",
+                    "video_info": {
+                        "duration_millis": 30000,
+                        "variants": [
+                            {
+                                "content_type": "application/x-mpegURL",
+                                "url": f"{base_url(request)}/ext_tw_video/{tweet_id}/pu/pl/playlist.m3u8",
+                            }
+                        ]
+                        + [
+                            {
+                                "content_type": "video/mp4",
+                                "bitrate": bitrate,
+                                "url": f"{base_url(request)}/ext_tw_video/{tweet_id}/pu/vid/{width}x{height}/{tweet_id}-{height}.mp4?tag=12",
+                            }
+                            for width, height, bitrate in RESOLUTIONS
+                        ],
+                    },
+                }
+            ]
+        }
+    elif kind == "photo":
+        tweet["extended_entities"] = {
+            "media": [
+                {
+                    "type": "photo",
+                    "media_url": f"{base_url(request)}/media/{tweet_id}-{i}.jpg",
+                    "media_url_https": f"{base_url(request)}/media/{tweet_id}-{i}.jpg",
+                }
+                for i in range(1 + tweet_id % 4)
+            ]
+        }
+    if quoted and tweet_id % 3 == 0:
+        tweet["quoted_status"] = v1_tweet(request, tweet_id // 3, quoted=False)
+    return tweet
+
+
+def v2_tweets(request, ids) -> dict:
+    data, media, users, quoted = [], {}, {}, {}
+    for tweet_id in ids:
+        tweet = v1_tweet(request, tweet_id)
+        user_id = str(tweet_id % 1000)
+        users[user_id] = {
+            "id": user_id,
+            "name": tweet["user"]["name"],
+            "username": tweet["user"]["screen_name"],
+            "profile_image_url": tweet["user"]["profile_image_url"],
+            "protected": tweet["user"]["protected"],
+        }
+        entry = {
+            "id": str(tweet_id),
+            "text": tweet["full_text"],
+            "author_id": user_id,
+            "lang": "en",
+            "created_at": CREATED_AT.isoformat(),
+            "possibly_sensitive": tweet["possibly_sensitive"],
+            "display_text_range": [0, len(tweet["full_text"])],
+        }
+        keys = []
+        for i, item in enumerate(tweet.get("extended_entities", {}).get("media", [])):
+            key = f"3_{tweet_id}_{i}"
+            keys.append(key)
+            if item["type"] == "video":
+                media[key] = {
+                    "media_key": key,
+                    "type": "video",
+                    "width": 1280,
+                    "height": 720,
+                    "duration_ms": 30000,
+                    "variants": [
+                        {
+                            "bit_rate": variant.get("bitrate"),
+                            "content_type": variant["content_type"],
+                            "url": variant["url"],
+                        }
+                        for variant in item["video_info"]["variants"]
+                    ],
+                }
+            else:
+                media[key] = {
+                    "media_key": key,
+                    "type": "photo",
+                    "width": 1200,
+                    "height": 675,
+                    "url": item["media_url_https"],
+                }
+        if keys:
+            entry["attachments"] = {"media_keys": keys}
+        if "quoted_status" in tweet:
+            quoted_id = str(tweet["quoted_status"]["id"])
+            entry["referenced_tweets"] = [{"type": "quoted", "id": quoted_id}]
+            quoted[quoted_id] = {
+                "id": quoted_id,
+                "text": tweet["quoted_status"]["full_text"],
+                "author_id": str(int(quoted_id) % 1000),
+            }
+        data.append(entry)
+    return {
+        "data": data,
+        "includes": {
+            "media": list(media.values()),
+            "users": list(users.values()),
+            "tweets": list(quoted.values()),
+        },
+    }
+
+
+@upstream.middleware("request")
+async def latency(request):
+    await asyncio.sleep(request.app.config.LATENCY / 1000)
+
+
+@upstream.route("/1.1/statuses/show.json")
+@upstream.route("/1.1/statuses/show/<tweet_file:str>")
+async def statuses_show(request, tweet_file: str = None):
+    if tweet_file:
+        tweet_id = int(tweet_file.split(".")[0])
+    else:
+        tweet_id = int(request.args.get("id") or request.args.get("_id"))
+    return sanic.response.json(v1_tweet(request, tweet_id))
+
+
+@upstream.route("/oauth2/token", methods=["POST"])
+async def token(request):
+    return sanic.response.json({"token_type": "bearer", "access_token": "benchmark"})
+
+
+@upstream.route("/2/tweets")
+async def tweets(request):
+    ids = [int(i) for i in request.args.get("ids", "").split(",") if i]
+    return sanic.response.json(v2_tweets(request, ids))
+
+
+@upstream.route("/ext_tw_video/<tweet_id:int>/pu/vid/<resolution:str>/<name:str>")
+async def video(request, tweet_id: int, resolution: str, name: str):
+    size = request.app.config.VIDEO_SIZE
+    height = int(resolution.split("x")[-1])
+    # Smaller renditions get proportionally smaller files.
+    size = size * height // 720
+    chunk = b"\0" * 65536
+
+    response = await request.respond(
+        content_type="video/mp4", headers={"content-length": str(size)}
+    )
+    for _ in range(size // len(chunk)):
+        await response.send(chunk)
+    await response.send(chunk[: size % len(chunk)])
+    await response.eof()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument(
+        "--latency", type=float, default=40, help="added to every response, in ms"
+    )
+    parser.add_argument(
+        "--video-size", type=int, default=2_000_000, help="bytes of the 720p rendition"
+    )
+    args = parser.parse_args()
+    upstream.config.LATENCY = args.latency
+    upstream.config.VIDEO_SIZE = args.video_size
+    upstream.run(
+        host="127.0.0.1",
+        port=args.port,
+        workers=int(os.environ.get("WORKERS", "1")),
+        access_log=False,
+    )
+
+
+if __name__ == "__main__":
+    main()
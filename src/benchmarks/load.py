@@ -0,0 +1,337 @@
+"""
+End-to-end load benchmark: boots TwitFix against the local fake upstream for each
+backend configuration, replays a crawler traffic mix and reports throughput,
+latency percentiles and cache hit ratio.
+
+Run from the `src` directory:
+
+    python -m benchmarks.load --duration 30 --concurrency 64
+    python -m benchmarks.load --configs json-none,mongo-none --mongo mongodb://localhost:27017/
+    python -m benchmarks.load --json results.json
+    python -m benchmarks.load --faults "link_cache:latency=0.2,error_rate=0.05"
+
+Compare the JSON output of two runs to catch regressions before deploying.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+SRC = Path(__file__).resolve().parent.parent
+
+DISCORD = "Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)"
+BROWSER = "Mozilla/5.0 (X11; Linux x86_64; rv:101.0) Gecko/20100101 Firefox/101.0"
+
+# Backend combinations to boot TwitFix with, "mongo" ones need --mongo.
+CONFIGS: Dict[str, Dict[str, str]] = {
+    "json-none": {"LINK_CACHE": "json", "STORAGE_MODULE": "none"},
+    "json-local": {"LINK_CACHE": "json", "STORAGE_MODULE": "local_storage"},
+    "mongo-none": {"LINK_CACHE": "db", "STORAGE_MODULE": "none"},
+    "mongo-local": {"LINK_CACHE": "db", "STORAGE_MODULE": "local_storage"},
+}
+
+# Share of each kind of request in a traffic mix.
+MIXES: Dict[str, Dict[str, float]] = {
+    # What a busy instance sees: mostly chat crawlers, some downloads and API use.
+    "crawler": {"embed": 0.8, "mp4": 0.1, "redirect": 0.05, "top": 0.05},
+    # A link posted in many servers at once, every crawler asks at the same time.
+    "discord-burst": {"embed": 1.0},
+    "downloads": {"mp4": 1.0},
+}
+
+
+class TweetPicker:
+    """
+    Chooses tweets with a skewed popularity, a few tweets get most of the traffic.
+    New tweets arrive in bursts of the same tweet requested back to back.
+    """
+
+    def __init__(self, pool: int, burst: int, seed: int) -> None:
+        self.random = random.Random(seed)
+        self.ids = [1500000000000000000 + i for i in range(pool)]
+        self.weights = [1 / (rank + 1) ** 1.1 for rank in range(pool)]
+        self.burst = burst
+        self.pending: List[int] = []
+
+    def next(self, video_only: bool = False) -> int:
+        if video_only:
+            # IDs ending in 0-4 are videos on the fake upstream.
+            return self.next() // 10 * 10 + self.random.randrange(5)
+        if not self.pending:
+            [tweet] = self.random.choices(self.ids, self.weights)
+            self.pending = [tweet] * self.burst
+        return self.pending.pop()
+
+
+# Statuses each request kind answers with when it worked, anything else is counted
+# as an error. Downloads redirect to the video when the storage cannot serve it.
+EXPECTED = {
+    "embed": {200},
+    "mp4": {200, 302},
+    "redirect": {301},
+    "top": {200},
+}
+
+
+def request_for(kind: str, picker: TweetPicker) -> Tuple[str, Dict[str, str]]:
+    if kind == "embed":
+        tweet = picker.next()
+        return f"/user{tweet % 1000}/status/{tweet}", {"user-agent": DISCORD}
+    if kind == "mp4":
+        tweet = picker.next(video_only=True)
+        return f"/user{tweet % 1000}/status/{tweet}.mp4", {"user-agent": DISCORD}
+    if kind == "redirect":
+        tweet = picker.next()
+        return f"/user{tweet % 1000}/status/{tweet}", {"user-agent": BROWSER}
+    if kind == "top":
+        return "/api/top?tweets=10", {"user-agent": BROWSER}
+    raise LookupError(f"Unknown request kind {kind}")
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spawn(args: List[str], env: Dict[str, str], cwd: Path) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, *args],
+        env={**os.environ, **env},
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def stop(process: subprocess.Popen):
+    group = os.getpgid(process.pid)
+    os.killpg(group, signal.SIGTERM)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(group, signal.SIGKILL)
+
+
+async def wait_until_up(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up in {timeout} seconds")
+
+
+async def cache_lookups(client: httpx.AsyncClient) -> Dict[str, float]:
+    text = (await client.get("/metrics")).text
+    return {
+        result: float(value)
+        for result, value in re.findall(
+            r'^twitfix_cache_lookups_total\{result="(\w+)"\} (\S+)$', text, re.M
+        )
+    }
+
+
+async def replay(
+    base: str, mix: Dict[str, float], args: argparse.Namespace
+) -> Dict[str, object]:
+    picker = TweetPicker(args.tweets, args.burst, args.seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    choose = random.Random(args.seed)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    limits = httpx.Limits(max_connections=args.concurrency)
+
+    async with httpx.AsyncClient(
+        base_url=base, limits=limits, timeout=args.timeout
+    ) as client:
+        before = await cache_lookups(client)
+        deadline = time.monotonic() + args.duration
+
+        async def user():
+            while time.monotonic() < deadline:
+                [kind] = choose.choices(kinds, weights)
+                path, headers = request_for(kind, picker)
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path, headers=headers)
+                    failed = response.status_code not in EXPECTED[kind]
+                except httpx.HTTPError:
+                    failed = True
+                elapsed = (time.perf_counter() - started) * 1000
+                if failed:
+                    errors[kind] += 1
+                else:
+                    latencies[kind].append(elapsed)
+
+        started = time.monotonic()
+        await asyncio.gather(*(user() for _ in range(args.concurrency)))
+        wall = time.monotonic() - started
+        after = await cache_lookups(client)
+
+    hits = after.get("hit", 0) - before.get("hit", 0)
+    misses = after.get("miss", 0) - before.get("miss", 0)
+    everything = list(itertools.chain.from_iterable(latencies.values()))
+    return {
+        "requests": len(everything) + sum(errors.values()),
+        "errors": sum(errors.values()),
+        "throughput": round(len(everything) / wall, 1),
+        "p50_ms": percentile(everything, 50),
+        "p99_ms": percentile(everything, 99),
+        "cache_hit_ratio": round(hits / (hits + misses), 3) if hits + misses else None,
+        "by_kind": {
+            kind: {
+                "requests": len(latencies[kind]) + errors[kind],
+                "errors": errors[kind],
+                "p50_ms": percentile(latencies[kind], 50),
+                "p99_ms": percentile(latencies[kind], 99),
+            }
+            for kind in kinds
+        },
+    }
+
+
+async def run_config(name: str, upstream: str, args: argparse.Namespace) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix=f"twitfix-bench-{name}-") as workdir:
+        port = free_port()
+        env = {
+            "PORT": str(port),
+            "WORKERS": str(args.workers),
+            "PROMETHEUS_MULTIPROC_DIR": tempfile.mkdtemp(dir=workdir),
+            "TWITFIX_CONFIG_FROM": "environment",
+            "TWITFIX_DOWNLOAD_METHOD": "api",
+            "TWITFIX_TWITTER_API_DOMAIN": upstream,
+            "TWITFIX_TWITTER_API_SECURE": "false",
+            "TWITFIX_TWITTER_API_KEY": "benchmark",
+            "TWITFIX_TWITTER_API_SECRET": "benchmark",
+            "TWITFIX_TWITTER_ACCESS_TOKEN": "benchmark",
+            "TWITFIX_TWITTER_ACCESS_SECRET": "benchmark",
+            "TWITFIX_JSON_CACHE_FILE": str(Path(workdir) / "links.json"),
+            "TWITFIX_STORAGE_LOCAL_BASE": workdir,
+            "TWITFIX_MONGO_DB": args.mongo or "",
+            "TWITFIX_MONGO_DB_TABLE": f"TwitFixBench{int(time.time())}",
+            "TWITFIX_BASE_URL": f"http://127.0.0.1:{port}",
+            "TWITFIX_REPO": "https://github.com/stormydragon/twitfix",
+            "TWITFIX_APP_NAME": "TwitFix",
+            "TWITFIX_COLOR": "#43B581",
+            "TWITFIX_STATS_PAGES": "true",
+            "TWITFIX_LOG_SAMPLING": args.log_sampling,
+            "TWITFIX_FAULT_INJECTION": "true" if args.faults else "false",
+            "TWITFIX_FAULTS": args.faults,
+            **{f"TWITFIX_{key}": value for key, value in CONFIGS[name].items()},
+        }
+        for mix in args.mixes.split(","):
+            # A fresh server per mix so every mix starts with a cold cache.
+            server = spawn(["-m", "twitfix.wsgi"], env, SRC)
+            try:
+                await wait_until_up(f"http://127.0.0.1:{port}/metrics")
+                results[mix] = await replay(
+                    f"http://127.0.0.1:{port}", MIXES[mix], args
+                )
+            finally:
+                stop(server)
+            if Path(env["TWITFIX_JSON_CACHE_FILE"]).exists():
+                Path(env["TWITFIX_JSON_CACHE_FILE"]).unlink()
+    return results
+
+
+def report(results: Dict[str, Dict[str, dict]]):
+    header = f"{'config':<12} {'mix':<14} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'hit ratio':>9}"
+    print(header)
+    print("-" * len(header))
+    for config, mixes in results.items():
+        for mix, row in mixes.items():
+            p50 = f"{row['p50_ms']:.1f}" if row["p50_ms"] is not None else "-"
+            p99 = f"{row['p99_ms']:.1f}" if row["p99_ms"] is not None else "-"
+            ratio = (
+                row["cache_hit_ratio"] if row["cache_hit_ratio"] is not None else "-"
+            )
+            print(
+                f"{config:<12} {mix:<14} {row['requests']:>8} {row['errors']:>6} {row['throughput']:>8} {p50:>8} {p99:>8} {ratio:>9}"
+            )
+
+
+async def main(args: argparse.Namespace):
+    upstream_port = free_port()
+    upstream = spawn(
+        [
+            "-m",
+            "benchmarks.fake_upstream",
+            "--port",
+            str(upstream_port),
+            "--latency",
+            str(args.upstream_latency),
+            "--video-size",
+            str(args.video_size),
+        ],
+        {},
+        SRC,
+    )
+    results = {}
+    try:
+        await wait_until_up(f"http://127.0.0.1:{upstream_port}/2/tweets")
+        for name in args.configs.split(","):
+            if CONFIGS[name]["LINK_CACHE"] == "db" and not args.mongo:
+                print(f"Skipping {name}, pass --mongo to run it.", file=sys.stderr)
+                continue
+            results[name] = await run_config(name, f"127.0.0.1:{upstream_port}", args)
+    finally:
+        stop(upstream)
+
+    report(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--configs", default="json-none,json-local,mongo-none")
+    parser.add_argument("--mixes", default="crawler,discord-burst,downloads")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per mix")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2, help="TwitFix workers")
+    parser.add_argument("--tweets", type=int, default=2000, help="distinct tweets")
+    parser.add_argument("--burst", type=int, default=8, help="requests per new tweet")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--upstream-latency", type=float, default=40, help="ms")
+    parser.add_argument("--video-size", type=int, default=2_000_000, help="bytes")
+    parser.add_argument("--mongo", help="MongoDB URL for the mongo configurations")
+    parser.add_argument("--log-sampling", default="", help="TWITFIX_LOG_SAMPLING")
+    parser.add_argument(
+        "--faults",
+        default="",
+        help='TWITFIX_FAULTS, e.g. "link_cache:latency=0.2;twitter_api:error_rate=0.3"',
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    asyncio.run(main(parser.parse_args()))
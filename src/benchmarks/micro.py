@@ -0,0 +1,350 @@
+"""
+Micro-benchmarks for the CPU work done on every request: tweet classification, the
+API tweet to VNF mapping, embed description cleanup, path matching, crawler
+classification, JSON serialization, API response parsing and template rendering, run
+against the recorded tweets in benchmarks/fixtures.
+
+Results are compared to benchmarks/micro_baseline.json and the run fails when a
+benchmark got slower than the threshold allows. Timings are scaled by a calibration
+loop first, so a baseline recorded on one machine stays usable on another.
+
+Run from the `src` directory:
+
+    python -m benchmarks.micro                  # compare against the baseline
+    python -m benchmarks.micro --save           # record a new baseline
+    python -m benchmarks.micro --filter render  # only the matching benchmarks
+"""
+import argparse
+import asyncio
+import copy
+import json
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict
+
+from jinja2 import Environment, FileSystemLoader
+
+from twitfix import serialization
+from twitfix.crawlers import PROFILES, CrawlerClassifier, Profile
+from twitfix.twitfix_app import (
+    embed_description,
+    pathregex,
+    render_fields,
+    tweetType,
+    vnf_from_api_tweet,
+)
+from twitfix.twitter_api import parse_tweets_response
+
+HERE = Path(__file__).resolve().parent
+FIXTURES = json.loads((HERE / "fixtures" / "tweets.json").read_text())
+TWEETS_V2 = json.loads((HERE / "fixtures" / "tweets_v2.json").read_text())
+BASELINE = HERE / "micro_baseline.json"
+TEMPLATES = HERE.parent / "templates"
+
+# Paths as they arrive at the catch-all route, including the ones that do not match.
+PATHS = [
+    "clipper/status/1532095328450719744",
+    "painter/status/1532095328450719745/photo/2",
+    "engineer/statuses/1532095328450719746?s=20&t=AbCdEfGhIjKlMnOp",
+    "https://twitter.com/replier/status/1532095328450719747",
+    "i/web/status/1532095328450719748",
+    "explore/tabs/trending",
+    "favicon.ico",
+]
+USER_AGENTS = [
+    "Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)",
+    "TelegramBot (like TwitterBot)",
+    "Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:101.0) Gecko/20100101 Firefox/101.0",
+]
+TEMPLATE_FOR_TYPE = {"Video": "video.html", "Image": "image.html", "Text": "text.html"}
+
+# name -> function running the benchmarked code `loops` times and returning the seconds taken
+benchmarks: Dict[str, Callable[[int], float]] = {}
+
+
+def benchmark(name: str):
+    def decorator(f):
+        benchmarks[name] = f
+        return f
+
+    return decorator
+
+
+def calibration(loops: int) -> float:
+    """
+    Fixed interpreter workload, used to scale the baseline to the current machine.
+    """
+    started = time.perf_counter()
+    for _ in range(loops):
+        table = {str(i): i * i for i in range(64)}
+        sum(value for key, value in table.items() if key.endswith("3"))
+    return time.perf_counter() - started
+
+
+def timed_loop(function, *args) -> Callable[[int], float]:
+    def run(loops: int) -> float:
+        started = time.perf_counter()
+        for _ in range(loops):
+            function(*args)
+        return time.perf_counter() - started
+
+    return run
+
+
+def link_for(tweet: dict) -> str:
+    return (
+        f"https://twitter.com/{tweet['user']['screen_name']}/status/{tweet['id_str']}"
+    )
+
+
+def vnf_for(tweet: dict) -> dict:
+    return vnf_from_api_tweet(copy.deepcopy(tweet), link_for(tweet))
+
+
+for kind, tweet in FIXTURES.items():
+    benchmark(f"tweet_type[{kind}]")(timed_loop(tweetType, tweet))
+    benchmark(f"vnf_from_api_tweet[{kind}]")(
+        timed_loop(vnf_from_api_tweet, tweet, link_for(tweet))
+    )
+    benchmark(f"embed_description[{kind}]")(
+        timed_loop(embed_description, vnf_for(tweet))
+    )
+    benchmark(f"render_fields[{kind}]")(timed_loop(render_fields, vnf_for(tweet)))
+
+
+@benchmark("pathregex")
+def path_matching(loops: int) -> float:
+    started = time.perf_counter()
+    for _ in range(loops):
+        for path in PATHS:
+            pathregex.search(path)
+    return time.perf_counter() - started
+
+
+def classify_benchmark(classifier: CrawlerClassifier, memo: bool):
+    classify = classifier.classify if memo else classifier._classify
+
+    def run(loops: int) -> float:
+        started = time.perf_counter()
+        for _ in range(loops):
+            for user_agent in USER_AGENTS:
+                classify(user_agent)
+        return time.perf_counter() - started
+
+    return run
+
+
+# The shipped profiles, then padded with made up crawlers to see how the cost grows.
+# User agents repeat, the memo keeps their cost flat; a new one is searched against
+# every pattern.
+for size in (len(PROFILES), 100, 1000):
+    classifier = CrawlerClassifier(
+        PROFILES
+        + tuple(
+            Profile(f"crawler{i}", (f"ExampleBot{i}/",))
+            for i in range(size - len(PROFILES))
+        )
+    )
+    benchmark(f"crawler_classify[{size}]")(classify_benchmark(classifier, memo=True))
+    if size == len(PROFILES):
+        benchmark(f"crawler_classify_uncached[{size}]")(
+            classify_benchmark(classifier, memo=False)
+        )
+
+
+def with_codec(name: str, run: Callable[[int], float]) -> Callable[[int], float]:
+    def run_with(loops: int) -> float:
+        previous = serialization.codec
+        serialization.use_codec(name)
+        try:
+            return run(loops)
+        finally:
+            serialization.codec = previous
+
+    return run_with
+
+
+def codecs():
+    for name in ("json", "orjson"):
+        try:
+            serialization.initialize_codec(name)
+        except LookupError:
+            continue
+        yield name
+
+
+def tweets_response(size: int) -> bytes:
+    """
+    A /2/tweets response of `size` tweets, up to 100 can be asked for at once.
+    """
+    tweets = TWEETS_V2["data"]
+    data = [
+        {**tweets[i % len(tweets)], "id": str(1532095328450719744 + i)}
+        for i in range(size)
+    ]
+    return json.dumps({**TWEETS_V2, "data": data}).encode()
+
+
+def namespace_parse(payload: bytes):
+    # How twitter_api parsed responses before, one SimpleNamespace per object.
+    return json.loads(payload, object_hook=lambda d: SimpleNamespace(**d))
+
+
+for size in (5, 100):
+    payload = tweets_response(size)
+    benchmark(f"tweets_v2_parse[{size}:namespace]")(
+        timed_loop(namespace_parse, payload)
+    )
+    for name in codecs():
+        benchmark(f"tweets_v2_parse[{size}:{name}]")(
+            with_codec(name, timed_loop(parse_tweets_response, payload))
+        )
+
+for name in codecs():
+    for kind in ("video", "quote"):
+        vnf = vnf_for(FIXTURES[kind])
+        vnf["render"] = render_fields(vnf)
+        benchmark(f"vnf_dumps[{kind}:{name}]")(
+            with_codec(name, timed_loop(serialization.dumpb, vnf))
+        )
+        benchmark(f"vnf_loads[{kind}:{name}]")(
+            with_codec(name, timed_loop(serialization.loads, json.dumps(vnf).encode()))
+        )
+
+
+def render_benchmark(template_name: str, vnf: dict):
+    environment = Environment(enable_async=True, loader=FileSystemLoader(TEMPLATES))
+    template = environment.get_template(template_name)
+    link = vnf["tweet"]
+    context = dict(
+        likes=vnf["likes"],
+        rts=vnf["rts"],
+        time=vnf["time"],
+        screenName=vnf["screen_name"],
+        vidlink=vnf["url"],
+        pfp=vnf["pfp"],
+        vidurl=vnf["url"],
+        desc=embed_description(dict(vnf)),
+        pic=vnf["images"][0],
+        user=vnf["uploader"],
+        userScreenName=f'{vnf["uploader"]} (@{vnf["screen_name"]})',
+        video_link=link,
+        color="#7FFFD4",
+        appname="TwitFix",
+        repo="https://github.com/stormydragon/twitfix",
+        url="https://fxtwitter.com",
+        message="This doesn't appear to be a twitter URL",
+    )
+
+    async def render(loops: int) -> float:
+        started = time.perf_counter()
+        for _ in range(loops):
+            await template.render_async(context)
+        return time.perf_counter() - started
+
+    loop = asyncio.new_event_loop()
+    return lambda loops: loop.run_until_complete(render(loops))
+
+
+for kind in ("video", "images", "quote"):
+    vnf = vnf_for(FIXTURES[kind])
+    template_name = TEMPLATE_FOR_TYPE[vnf["type"]]
+    benchmark(f"render[{template_name}:{kind}]")(render_benchmark(template_name, vnf))
+benchmark("render[default.html]")(
+    render_benchmark("default.html", vnf_for(FIXTURES["text"]))
+)
+
+
+def measure(run: Callable[[int], float], repeat: int, min_time: float) -> float:
+    """
+    Nanoseconds per call, the best of `repeat` runs lasting at least `min_time` each.
+    """
+    loops = 1
+    while run(loops) < min_time:
+        loops *= 2
+    return min(run(loops) for _ in range(repeat)) / loops * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--save", action="store_true", help="record a new baseline")
+    parser.add_argument("--filter", default="", help="only run matching benchmarks")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.3,
+        help="fail when slower than baseline times this",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05, help="seconds per run")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    calibration_ns = measure(calibration, args.repeat, args.min_time)
+    results = {
+        name: measure(run, args.repeat, args.min_time)
+        for name, run in benchmarks.items()
+        if args.filter in name
+    }
+
+    if args.save:
+        if args.filter and BASELINE.exists():
+            # Keep the benchmarks that were not run, rescaled to this machine.
+            stored = json.loads(BASELINE.read_text())
+            scale = calibration_ns / stored["calibration_ns"]
+            results = {
+                **{name: ns * scale for name, ns in stored["results"].items()},
+                **results,
+            }
+        BASELINE.write_text(
+            json.dumps(
+                {
+                    "calibration_ns": round(calibration_ns, 1),
+                    "results": {name: round(ns, 1) for name, ns in results.items()},
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+        print(f"Baseline of {len(results)} benchmarks saved to {BASELINE}")
+        return 0
+
+    baseline = (
+        json.loads(BASELINE.read_text())
+        if BASELINE.exists()
+        else {"calibration_ns": calibration_ns, "results": {}}
+    )
+    scale = calibration_ns / baseline["calibration_ns"]
+    failures = 0
+    print(f"{'benchmark':<36} {'ns/call':>10} {'baseline':>10} {'ratio':>6}")
+    for name, ns in results.items():
+        if name not in baseline["results"]:
+            print(f"{name:<36} {ns:>10.0f} {'-':>10} {'-':>6}")
+            continue
+        expected = baseline["results"][name] * scale
+        ratio = ns / expected
+        slower = ratio > args.threshold
+        failures += slower
+        print(
+            f"{name:<36} {ns:>10.0f} {expected:>10.0f} {ratio:>6.2f}"
+            + ("  REGRESSION" if slower else "")
+        )
+
+    if args.json:
+        Path(args.json).write_text(
+            json.dumps({"calibration_ns": calibration_ns, "results": results}, indent=2)
+        )
+    if failures:
+        print(f"{failures} benchmarks slower than {args.threshold}x the baseline")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
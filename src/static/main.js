@@ -1,5 +1,6 @@
 var tweetCount = 1,
-    page = 0,
+    cursor = null,
+    exhausted = false,
     loading = false,
     bigArray = [],
     isNSFWSHOW = false;
@@ -56,31 +57,27 @@ function cookieTime() {
 }
 function forNow() {
     document.querySelector("#block").style.display = "none";
-    fetchNApply(page)
-    page++;
+    fetchNApply()
     const tweetCont = document.querySelector(".tweetCont");
     tweetCont.onscroll = async () => {
-        if (tweetCont.scrollTop > tweetCont.scrollHeight - tweetCont.offsetHeight - 100 && loading == false) {
-            await fetchNApply(page);
-            //console.log(page);
-            page++;
+        if (tweetCont.scrollTop > tweetCont.scrollHeight - tweetCont.offsetHeight - 100 && loading == false && exhausted == false) {
+            await fetchNApply();
         }
     };
 }
-function fetchNApply(page) {
-    try {
-        loading = true;
-        fetch(`/api/latest/?tweets=10&page=${page}`)
-            .then(response => response.json())
-            .then(data => {
-                data.forEach(e => createTweet(e));
-            })
-            .then(setTimeout(() => loading = false, 500));
-    } catch (error) {
-        console.log(error);
-        alert(error)
-    }
-
+function fetchNApply() {
+    loading = true;
+    // Each page continues from the cursor of the previous one.
+    const after = cursor ? `&cursor=${encodeURIComponent(cursor)}` : "";
+    return fetch(`/api/latest?tweets=30${after}`)
+        .then(response => response.json())
+        .then(data => {
+            data.tweets.forEach(e => createTweet(e));
+            cursor = data.cursor;
+            exhausted = cursor === null;
+        })
+        .catch(error => console.log(error))
+        .finally(() => setTimeout(() => loading = false, 500));
 }
 
 function imgPrev(img) {
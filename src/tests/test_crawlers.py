@@ -0,0 +1,52 @@
+import pytest
+
+from twitfix.crawlers import PROFILES, crawler_profile
+
+# One user agent for every pattern in PROFILES, in the same order.
+USER_AGENTS = [
+    ("discord", "Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)"),
+    (
+        "discord",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.10; rv:38.0) Gecko/20100101 Firefox/38.0",
+    ),
+    ("telegram", "TelegramBot (like TwitterBot)"),
+    ("slack", "Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)"),
+    (
+        "facebook",
+        "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)",
+    ),
+    ("facebook", "Facebot"),
+    ("steam", "Mozilla/5.0 (Windows; Valve Steam Client/default/1665786434)"),
+    ("revolt", "Mozilla/5.0 (compatible; January/1.0; +https://github.com/revoltchat)"),
+    (
+        "other",
+        "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/31.0.1650.57 Safari/537.36",
+    ),
+    ("other", "test"),
+]
+
+
+def test_every_pattern_has_a_user_agent():
+    assert [name for name, _ in USER_AGENTS] == [
+        profile.name for profile in PROFILES for _ in profile.patterns
+    ]
+
+
+@pytest.mark.parametrize("name, user_agent", USER_AGENTS)
+def test_crawlers_are_recognised(name, user_agent):
+    assert crawler_profile(user_agent).name == name
+
+
+@pytest.mark.parametrize(
+    "user_agent",
+    [
+        None,
+        "",
+        "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/118.0",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.10; rv:38.0) Gecko/20100101 Firefox/38.0 Extra",
+        "testing",
+    ],
+)
+def test_browsers_are_not_crawlers(user_agent):
+    assert crawler_profile(user_agent) is None
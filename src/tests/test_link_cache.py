@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from sanic.config import Config
+
+from twitfix.exceptions import InvalidCursor
+from twitfix.link_cache import JSONCache, RedisCache, encode_cursor
+
+
+def redis_cache(index_size: int) -> RedisCache:
+    fakeredis = pytest.importorskip("fakeredis.aioredis")
+    pytest.importorskip("redis.asyncio")
+    cache = RedisCache(
+        Config({"REDIS_URL": "redis://localhost", "REDIS_INDEX_SIZE": index_size})
+    )
+    cache.redis = fakeredis.FakeRedis(decode_responses=True)
+    return cache
+
+
+def tweet(number: int) -> str:
+    return f"https://twitter.com/user/status/{number}"
+
+
+def test_new_links_are_counted_once_the_index_is_full():
+    async def scenario():
+        cache = redis_cache(index_size=2)
+        for number in range(3):
+            await cache.add_link_to_cache(tweet(number), {"url": str(number)})
+            for _ in range(number + 1):
+                await cache.get_link_from_cache(tweet(number))
+        await cache.add_link_to_cache(tweet(3), {"url": "3"})
+        for _ in range(5):
+            vnf = await cache.get_link_from_cache(tweet(3))
+        top = await cache.get_links_from_cache("hits", 10)
+        return vnf, top
+
+    vnf, top = asyncio.run(scenario())
+    assert vnf["hits"] == 5
+    assert [(vnf["url"], vnf["hits"]) for vnf in top] == [("3", 5), ("2", 3)]
+
+
+def test_listings_are_trimmed_when_read():
+    async def scenario():
+        cache = redis_cache(index_size=2)
+        for number in range(4):
+            await cache.add_link_to_cache(tweet(number), {"url": str(number)})
+        before = await cache.redis.zcard(cache.indexes["_id"])
+        latest = await cache.get_links_from_cache("_id", 10)
+        after = await cache.redis.zcard(cache.indexes["_id"])
+        return before, latest, after
+
+    before, latest, after = asyncio.run(scenario())
+    assert before == 4
+    assert [vnf["url"] for vnf in latest] == ["3", "2"]
+    assert after == 2
+
+
+def test_misses_are_not_counted():
+    async def scenario():
+        cache = redis_cache(index_size=2)
+        vnf = await cache.get_link_from_cache(tweet(0))
+        listed = await cache.redis.zcard(cache.indexes["hits"])
+        return vnf, listed
+
+    assert asyncio.run(scenario()) == (None, 0)
+
+
+@pytest.mark.parametrize(
+    "cursor", ["WzEsIDJd", encode_cursor(1), encode_cursor(), "not base64 at all!"]
+)
+def test_malformed_cursors_are_invalid_for_json(tmp_path, cursor):
+    cache = JSONCache(Config({"JSON_CACHE_FILE": str(tmp_path / "links.json")}))
+    with pytest.raises(InvalidCursor):
+        asyncio.run(cache.get_links_from_cache("hits", 10, cursor=cursor))
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [encode_cursor("https://twitter.com/user/status/1"), encode_cursor("1", "2")],
+)
+def test_malformed_cursors_are_invalid_for_redis(cursor):
+    cache = redis_cache(index_size=2)
+    with pytest.raises(InvalidCursor):
+        asyncio.run(cache.get_links_from_cache("hits", 10, cursor=cursor))
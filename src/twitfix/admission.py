@@ -0,0 +1,84 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict
+
+import sanic
+
+from .exceptions import Overloaded
+from .metrics import ADMISSION_ACTIVE, ADMISSION_REJECTED, ADMISSION_WAITING
+
+# Concurrent requests per worker and how many more may queue for a slot.
+DEFAULT_BUDGETS = {
+    "render": (256, 1024),
+    "extract": (32, 64),
+    "download": (8, 16),
+}
+
+
+class Budget:
+    """
+    A limit on concurrent work of one kind, with a short bounded queue in front.
+
+    Anything arriving when the queue is full, or waiting longer than `wait` seconds,
+    is turned away with Overloaded instead of piling up.
+    """
+
+    def __init__(self, name: str, limit: int, queue: int, wait: float) -> None:
+        self.name = name
+        self.queue = queue
+        self.wait = wait
+        self.waiting = 0
+        self.slots = asyncio.Semaphore(limit)
+        self.active = ADMISSION_ACTIVE.labels(name)
+        self.queued = ADMISSION_WAITING.labels(name)
+
+    def reject(self):
+        ADMISSION_REJECTED.labels(self.name).inc()
+        raise Overloaded(self.name)
+
+    @asynccontextmanager
+    async def admit(self):
+        if self.slots.locked():
+            if self.waiting >= self.queue:
+                self.reject()
+            self.waiting += 1
+            self.queued.inc()
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.wait)
+            except asyncio.TimeoutError:
+                self.reject()
+            finally:
+                self.waiting -= 1
+                self.queued.dec()
+        else:
+            await self.slots.acquire()
+        self.active.inc()
+        try:
+            yield
+        finally:
+            self.active.dec()
+            self.slots.release()
+
+
+def admission(request: sanic.Request, budget: str):
+    return request.app.config.ADMISSION[budget].admit()
+
+
+def initialize_admission(app: sanic.Sanic):
+    """
+    Separate budgets keep cache hits rendering while cold extractions and media
+    downloads are limited. Set with ADMISSION_<BUDGET>_LIMIT and _QUEUE.
+    """
+
+    @app.before_server_start
+    def create_budgets(app: sanic.Sanic, loop):
+        wait = app.config.get("ADMISSION_WAIT", 5.0)
+        budgets: Dict[str, Budget] = {}
+        for name, (limit, queue) in DEFAULT_BUDGETS.items():
+            budgets[name] = Budget(
+                name,
+                app.config.get(f"ADMISSION_{name.upper()}_LIMIT", limit),
+                app.config.get(f"ADMISSION_{name.upper()}_QUEUE", queue),
+                wait,
+            )
+        app.config.update({"ADMISSION": budgets})
@@ -0,0 +1,313 @@
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import sanic
+
+from .exceptions import CircuitOpen, InvalidCursor
+from .link_cache import LinkCacheBase
+from .metrics import BREAKER_REJECTED, BREAKER_STATE
+from .stats_module import StatsBase
+from .storage_module import StorageBase
+from .structured_logging import log_event
+
+# Every external dependency gets its own breaker.
+BREAKERS = ("twitter_api", "youtube_dl", "link_cache", "stats", "storage")
+STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+DEFAULT_SETTINGS = {
+    # Seconds of calls the error rate is computed over.
+    "window": 30.0,
+    # Calls needed in the window before the breaker may open.
+    "min_calls": 20,
+    "error_rate": 0.5,
+    # Seconds an open breaker rejects calls before letting probes through.
+    "open_seconds": 15.0,
+    # Probes let through when half open, all must succeed to close again.
+    "probes": 3,
+}
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency that keeps failing.
+
+    Closed, calls go through and their outcomes are counted in one second buckets
+    over a rolling window. Once enough calls failed the breaker opens and calls are
+    rejected with CircuitOpen without waiting on the dependency. After `open_seconds`
+    it turns half open and lets a few probes through, which close it when they all
+    succeed or open it again on the first failure.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: float,
+        min_calls: int,
+        error_rate: float,
+        open_seconds: float,
+        probes: int,
+    ) -> None:
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        # [second, calls, failures]
+        self.buckets: deque = deque()
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = 0
+        self.probes_passed = 0
+        self.gauge = BREAKER_STATE.labels(name)
+        self.gauge.set(STATES["closed"])
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        log_event(
+            "breaker",
+            f" ➤ [ ! ] Circuit breaker {state.replace('_', ' ')}",
+            breaker=self.name,
+            previous=self.state,
+        )
+        self.state = state
+        self.gauge.set(STATES[state])
+        if state == "open":
+            self.opened_at = time.monotonic()
+        elif state == "half_open":
+            self.probing = self.probes_passed = 0
+        else:
+            self.buckets.clear()
+
+    def _counts(self, now: float) -> Tuple[int, int]:
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            self.buckets.popleft()
+        return (
+            sum(bucket[1] for bucket in self.buckets),
+            sum(bucket[2] for bucket in self.buckets),
+        )
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self.probing >= self.probes:
+                return False
+            self.probing += 1
+        return True
+
+    def record(self, success: bool):
+        if self.state == "half_open":
+            self.probing -= 1
+            if not success:
+                self._transition("open")
+            else:
+                self.probes_passed += 1
+                if self.probes_passed >= self.probes:
+                    self._transition("closed")
+            return
+        now = time.monotonic()
+        second = int(now)
+        if self.buckets and self.buckets[-1][0] == second:
+            bucket = self.buckets[-1]
+        else:
+            bucket = [second, 0, 0]
+            self.buckets.append(bucket)
+        bucket[1] += 1
+        bucket[2] += not success
+        calls, failures = self._counts(now)
+        if (
+            self.state == "closed"
+            and calls >= self.min_calls
+            and failures / calls >= self.error_rate
+        ):
+            self._transition("open")
+
+    def release(self):
+        # A probe that neither failed nor succeeded, like a cancelled one.
+        if self.state == "half_open":
+            self.probing -= 1
+
+    @asynccontextmanager
+    async def guard(self, ignore: Tuple[type, ...] = ()):
+        """
+        Run the body through the breaker, exceptions in `ignore` count as successes.
+        """
+        if not self.allow():
+            BREAKER_REJECTED.labels(self.name).inc()
+            raise CircuitOpen(self.name)
+        try:
+            yield
+        except ignore:
+            self.record(True)
+            raise
+        except Exception:
+            self.record(False)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        else:
+            self.record(True)
+
+    def snapshot(self) -> dict:
+        calls, failures = self._counts(time.monotonic())
+        snapshot = {"state": self.state, "calls": calls, "failures": failures}
+        if self.state == "open":
+            snapshot["retry_in"] = round(
+                max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)), 1
+            )
+        return snapshot
+
+
+def breaker(request: sanic.Request, name: str) -> CircuitBreaker:
+    return request.app.config.BREAKERS[name]
+
+
+class BreakerLinkCache(LinkCacheBase):
+    """
+    While open, lookups are misses and writes are skipped, tiers in front keep
+    serving what they hold.
+    """
+
+    def __init__(self, breaker: CircuitBreaker, backend: LinkCacheBase) -> None:
+        self.breaker = breaker
+        self.backend = backend
+
+    async def add_link_to_cache(self, video_link: str, vnf) -> bool:
+        try:
+            async with self.breaker.guard():
+                return await self.backend.add_link_to_cache(video_link, vnf)
+        except CircuitOpen:
+            return False
+
+    async def get_link_from_cache(self, video_link: str) -> Optional[Any]:
+        try:
+            async with self.breaker.guard():
+                return await self.backend.get_link_from_cache(video_link)
+        except CircuitOpen:
+            return None
+
+    async def get_links_from_cache(
+        self, field, count, offset=0, projection=None, cursor=None
+    ) -> List[Any]:
+        async with self.breaker.guard(ignore=(InvalidCursor,)):
+            return await self.backend.get_links_from_cache(
+                field, count, offset, projection, cursor
+            )
+
+    async def get_links_batch(self, video_links: List[str]) -> Dict[str, Any]:
+        try:
+            async with self.breaker.guard():
+                return await self.backend.get_links_batch(video_links)
+        except CircuitOpen:
+            return {}
+
+    async def increment_hits(self, video_link: str, hits: int = 1):
+        async with self.breaker.guard():
+            await self.backend.increment_hits(video_link, hits)
+
+    async def update_link(self, video_link: str, fields: dict):
+        async with self.breaker.guard():
+            await self.backend.update_link(video_link, fields)
+
+
+class BreakerStats(StatsBase):
+    """
+    While open, counters are dropped and reads fail fast.
+    """
+
+    def __init__(self, breaker: CircuitBreaker, backend: StatsBase) -> None:
+        self.breaker = breaker
+        self.backend = backend
+
+    async def add_to_stat(self, metric: str):
+        try:
+            async with self.breaker.guard():
+                await self.backend.add_to_stat(metric)
+        except CircuitOpen:
+            pass
+
+    async def get_stats(self, day: str):
+        async with self.breaker.guard():
+            return await self.backend.get_stats(day)
+
+    async def add_rollup(self, hour: str, rollup: dict):
+        async with self.breaker.guard():
+            await self.backend.add_rollup(hour, rollup)
+
+    async def get_rollups(self, start: str, end: str):
+        async with self.breaker.guard():
+            return await self.backend.get_rollups(start, end)
+
+
+class BreakerStorage(StorageBase):
+    """
+    While open, calls fail fast with CircuitOpen and downloads redirect to Twitter.
+    """
+
+    def __init__(self, breaker: CircuitBreaker, backend: StorageBase) -> None:
+        self.breaker = breaker
+        self.backend = backend
+        self.config = backend.config
+
+    async def store_media(self, url: str):
+        async with self.breaker.guard():
+            return await self.backend.store_media(url)
+
+    async def retrieve_media(self, own_identifier: str):
+        async with self.breaker.guard():
+            return await self.backend.retrieve_media(own_identifier)
+
+
+def wraps(module, kind: type) -> bool:
+    while module is not None:
+        if isinstance(module, kind):
+            return True
+        module = getattr(module, "backend", None)
+    return False
+
+
+def initialize_breakers(app: sanic.Sanic):
+    """
+    Settings apply to every breaker as BREAKER_<SETTING>, or to one of them as
+    BREAKER_<NAME>_<SETTING>, for example BREAKER_STORAGE_OPEN_SECONDS.
+    """
+
+    def setting(name: str, key: str):
+        default = app.config.get(f"BREAKER_{key.upper()}", DEFAULT_SETTINGS[key])
+        return type(DEFAULT_SETTINGS[key])(
+            app.config.get(f"BREAKER_{name.upper()}_{key.upper()}", default)
+        )
+
+    @app.before_server_start
+    def wrap_backends(app: sanic.Sanic, loop):
+        if "BREAKERS" not in app.config:
+            breakers: Dict[str, CircuitBreaker] = {
+                name: CircuitBreaker(
+                    name, **{key: setting(name, key) for key in DEFAULT_SETTINGS}
+                )
+                for name in BREAKERS
+            }
+            app.config.update({"BREAKERS": breakers})
+        breakers = app.config.BREAKERS
+        # Other tiers may have wrapped the backends since, they keep them as `backend`.
+        if not wraps(app.config.STORAGE_MODULE, BreakerStorage):
+            app.config.update(
+                {
+                    "LINKS_MODULE": BreakerLinkCache(
+                        breakers["link_cache"], app.config.LINKS_MODULE
+                    ),
+                    "STAT_MODULE": BreakerStats(
+                        breakers["stats"], app.config.STAT_MODULE
+                    ),
+                    "STORAGE_MODULE": BreakerStorage(
+                        breakers["storage"], app.config.STORAGE_MODULE
+                    ),
+                }
+            )
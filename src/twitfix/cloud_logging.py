@@ -1,15 +1,20 @@
-import re
+import logging
 from contextvars import ContextVar
+from functools import partial
 
+import google.cloud.logging_v2
 import google.cloud.logging_v2.handlers.handlers
+import google.cloud.logging_v2.handlers.transports
 import sanic
 import sanic.log
 
+from .tracing import current_span, parse_xcloud_trace
 
-def initialize_app(app: sanic.Sanic):
+
+def initialize_app(app: sanic.Sanic, client: google.cloud.logging_v2.Client):
     @app.on_request
     async def set_trace_data(request: sanic.Request):
-        trace_id, span_id, trace_sampled = _parse_xcloud_trace(
+        trace_id, span_id, trace_sampled = parse_xcloud_trace(
             request.headers.get("X_CLOUD_TRACE_CONTEXT")
         )
         http_request = {
@@ -32,6 +37,10 @@ def initialize_app(app: sanic.Sanic):
                 return None, None, None, False
 
             [http_request, trace_id, span_id, trace_sampled] = trace_data
+            # Attribute the record to the pipeline stage it was logged from.
+            span = current_span.get()
+            if span is not None:
+                span_id = span.span_id
             return http_request, trace_id, span_id, trace_sampled
         except LookupError:
             print("Cloud logging; no request in trace context")
@@ -46,26 +55,35 @@ def initialize_app(app: sanic.Sanic):
         get_request_data_from_sanic
     )
 
+    def capture_request_data(record: logging.LogRecord):
+        # Records are shipped from a queue listener thread which cannot see the
+        # request context, fix the request data on the record while we still can.
+        http_request, trace_id, span_id, trace_sampled = get_request_data_from_sanic()
+        if trace_id is not None:
+            record.trace = f"projects/{client.project}/traces/{trace_id}"
+            record.span_id = span_id
+            record.trace_sampled = trace_sampled
+        if http_request is not None:
+            record.http_request = http_request
+        return True
 
-def _parse_xcloud_trace(header):
-    """Given an X_CLOUD_TRACE header, extract the trace and span ids.
-    Args:
-        header (str): the string extracted from the X_CLOUD_TRACE header
-    Returns:
-        Tuple[Optional[dict], Optional[str], bool]:
-            The trace_id, span_id and trace_sampled extracted from the header
-            Each field will be None if not found.
-    """
-    trace_id = span_id = None
-    trace_sampled = False
-    # see https://cloud.google.com/trace/docs/setup for X-Cloud-Trace_Context format
-    if header:
-        try:
-            regex = r"([\w-]+)?(\/?([\w-]+))?(;?o=(\d))?"
-            match = re.match(regex, header)
-            trace_id = match.group(1)
-            span_id = match.group(3)
-            trace_sampled = match.group(5) == "1"
-        except IndexError:
-            pass
-    return trace_id, span_id, trace_sampled
+    @app.before_server_start
+    def batched_shipping(app, loop):
+        # The background transport runs a thread which does not survive the fork
+        # into workers, so each worker sets up its own.
+        batch_size = app.config.get("LOG_BATCH_SIZE", 0)
+        if not batch_size:
+            return
+        transport = partial(
+            google.cloud.logging_v2.handlers.transports.BackgroundThreadTransport,
+            batch_size=batch_size,
+            max_latency=app.config.get("LOG_BATCH_LATENCY", 1.0),
+        )
+        # Replaces the handler put in place by `client.setup_logging`.
+        logging.getLogger().handlers = [
+            google.cloud.logging_v2.handlers.CloudLoggingHandler(
+                client, transport=transport
+            )
+        ]
+
+    return capture_request_data
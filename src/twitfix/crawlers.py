@@ -0,0 +1,89 @@
+import re
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+
+# Template for each kind of tweet, "" is what youtube-dl extractions get.
+TEMPLATES = {
+    "Video": "video.html",
+    "": "video.html",
+    "Image": "image.html",
+    "Text": "text.html",
+}
+
+
+class Profile(NamedTuple):
+    """
+    A client that unfurls links, recognised by any of its user agent `patterns`.
+    `deadline` is the seconds it waits for an embed, None waits as long as it takes.
+    """
+
+    name: str
+    patterns: Tuple[str, ...]
+    deadline: Optional[float] = None
+    templates: Dict[str, str] = TEMPLATES
+
+
+# Where may our links be posted? Patterns are regular expressions searched in the
+# user agent, so version bumps keep matching.
+PROFILES = (
+    Profile(
+        "discord",
+        (
+            r"Discordbot/",
+            # Discord fetches with this one as well.
+            r"^Mozilla/5\.0 \(Macintosh; Intel Mac OS X 10\.10; rv:38\.0\) Gecko/20100101 Firefox/38\.0$",
+        ),
+        deadline=4.0,
+    ),
+    Profile("telegram", (r"TelegramBot",), deadline=4.0),
+    Profile("slack", (r"Slackbot",), deadline=2.5),
+    Profile("facebook", (r"facebookexternalhit/", r"Facebot"), deadline=4.0),
+    Profile("steam", (r"Valve Steam (?:Client|FriendsUI)",)),
+    # January, the image proxy of RevoltChat.
+    Profile("revolt", (r"January/",)),
+    Profile(
+        "other",
+        (
+            r"^Mozilla/5\.0 \(Windows NT 6\.1; WOW64\) AppleWebKit/537\.36 \(KHTML, like Gecko\) Chrome/31\.0\.1650\.57 Safari/537\.36$",
+            r"^test$",
+        ),
+    ),
+)
+
+
+class CrawlerClassifier:
+    """
+    Tells which profile a user agent belongs to, None for everyone else.
+
+    Every pattern is searched at once as one alternation, the profile of the first
+    pattern matching at the earliest position wins. Decisions are remembered for the
+    `memo` most recently seen user agents.
+    """
+
+    def __init__(self, profiles: Sequence[Profile], memo: int = 4096) -> None:
+        self.profiles: Dict[str, Profile] = {}
+        alternatives = []
+        for profile in profiles:
+            for pattern in profile.patterns:
+                group = f"p{len(alternatives)}"
+                self.profiles[group] = profile
+                alternatives.append(f"(?P<{group}>{pattern})")
+        self.expression = re.compile("|".join(alternatives)) if alternatives else None
+        self.classify = lru_cache(maxsize=memo)(self._classify)
+
+    def _classify(self, user_agent: str) -> Optional[Profile]:
+        if self.expression is None:
+            return None
+        match = self.expression.search(user_agent)
+        return None if match is None else self.profiles[match.lastgroup]
+
+
+crawlers = CrawlerClassifier(PROFILES)
+
+
+def crawler_profile(user_agent: Optional[str]) -> Optional[Profile]:
+    return crawlers.classify(user_agent or "")
+
+
+def is_crawler(user_agent: Optional[str]) -> bool:
+    return crawler_profile(user_agent) is not None
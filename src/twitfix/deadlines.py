@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import sanic
+
+from .crawlers import crawler_profile
+from .metrics import EMBED_DEADLINE_RESULTS
+from .structured_logging import log_event
+
+
+def parse_deadlines(value) -> Dict[str, float]:
+    """
+    Deadlines come as a mapping, or as "profile=seconds,profile=seconds" from the environment.
+    """
+    if isinstance(value, dict):
+        return {profile: float(seconds) for profile, seconds in value.items()}
+    deadlines = {}
+    for item in str(value or "").split(","):
+        if "=" in item:
+            profile, seconds = item.split("=", 1)
+            deadlines[profile.strip()] = float(seconds)
+    return deadlines
+
+
+def embed_deadline(request: sanic.Request) -> Optional[float]:
+    """
+    Seconds left for this request to answer, None when it may take as long as it needs.
+    """
+    profile = crawler_profile(request.headers.get("user-agent"))
+    if profile is None:
+        deadline = request.app.config.get("EMBED_DEADLINE", 0)
+    else:
+        deadline = request.app.config.EMBED_DEADLINES.get(
+            profile.name, profile.deadline
+        )
+    if not deadline:
+        return None
+    started = getattr(request.ctx, "started", None)
+    if started is not None:
+        deadline -= time.perf_counter() - started
+    return max(deadline, 0)
+
+
+class BackgroundExtractions:
+    """
+    Extractions that outlive the request which started them.
+
+    Requests for the same link share one extraction. A request running out of time
+    leaves it running, so the result still ends up in the link cache for the retry.
+    """
+
+    def __init__(self) -> None:
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.late: Set[asyncio.Task] = set()
+
+    def start(self, video_link: str, extract: Callable[[], Awaitable]) -> asyncio.Task:
+        task = self.tasks.get(video_link)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(extract())
+            self.tasks[video_link] = task
+            task.add_done_callback(lambda _: self.tasks.pop(video_link, None))
+        return task
+
+    async def wait(
+        self,
+        video_link: str,
+        extract: Callable[[], Awaitable],
+        timeout: Optional[float],
+    ):
+        """
+        Result of the extraction, or asyncio.TimeoutError once `timeout` seconds passed.
+        """
+        task = self.start(video_link, extract)
+        try:
+            # Shielded, a timeout or a disconnecting client must not cancel the work.
+            result = await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            EMBED_DEADLINE_RESULTS.labels("missed").inc()
+            if task not in self.late:
+                self.late.add(task)
+                started = time.perf_counter()
+                task.add_done_callback(
+                    lambda task: finished_late(task, video_link, started)
+                )
+                task.add_done_callback(self.late.discard)
+            raise
+        EMBED_DEADLINE_RESULTS.labels("in_time").inc()
+        return result
+
+
+def finished_late(task: asyncio.Task, video_link: str, started: float):
+    overrun = round(time.perf_counter() - started, 3)
+    if task.cancelled():
+        EMBED_DEADLINE_RESULTS.labels("cancelled").inc()
+    elif task.exception() is not None:
+        EMBED_DEADLINE_RESULTS.labels("failed_late").inc()
+        log_event(
+            "extract",
+            " ➤ [ X ] Background extraction failed",
+            level=logging.WARNING,
+            tweet=video_link,
+            overrun=overrun,
+            error=repr(task.exception()),
+        )
+    else:
+        EMBED_DEADLINE_RESULTS.labels("completed_late").inc()
+        log_event(
+            "extract",
+            " ➤ [ ✔ ] Background extraction cached",
+            tweet=video_link,
+            overrun=overrun,
+        )
+
+
+def initialize_deadlines(app: sanic.Sanic):
+    """
+    EMBED_DEADLINES overrides the deadlines of crawler profiles by name,
+    EMBED_DEADLINE applies to everyone else and defaults to no deadline.
+    """
+
+    @app.before_server_start
+    def configure_deadlines(app: sanic.Sanic, loop):
+        app.config.update(
+            {
+                "EMBED_DEADLINES": parse_deadlines(app.config.get("EMBED_DEADLINES")),
+                "BACKGROUND_EXTRACTIONS": BackgroundExtractions(),
+            }
+        )
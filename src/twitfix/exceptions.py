@@ -1,2 +1,34 @@
 class TwitterUserProtected(Exception):
     pass
+
+
+class Overloaded(Exception):
+    def __init__(self, budget: str) -> None:
+        super().__init__(f"The {budget} budget is exhausted")
+        self.budget = budget
+
+
+class CircuitOpen(Exception):
+    def __init__(self, breaker: str) -> None:
+        super().__init__(f"The {breaker} circuit breaker is open")
+        self.breaker = breaker
+
+
+class InjectedFault(Exception):
+    def __init__(self, target: str, kind: str) -> None:
+        super().__init__(f"Injected {kind} in {target}")
+        self.target = target
+        self.kind = kind
+
+
+class InvalidCursor(ValueError):
+    def __init__(self, cursor: str) -> None:
+        super().__init__(f"Invalid cursor {cursor!r}")
+        self.cursor = cursor
+
+
+class MediaUnavailable(Exception):
+    def __init__(self, url: str, reason: str) -> None:
+        super().__init__(f"Could not store {url}: {reason}")
+        self.url = url
+        self.reason = reason
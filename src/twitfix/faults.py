@@ -0,0 +1,201 @@
+import asyncio
+import random
+from typing import Dict, List
+
+import sanic
+
+from .exceptions import InjectedFault
+from .link_cache import LinkCacheBase
+from .metrics import FAULT_INJECTIONS
+from .stats_module import StatsBase
+from .storage_module import StorageBase
+
+# Dependencies faults can be injected into.
+TARGETS = ("twitter_api", "youtube_dl", "link_cache", "stats", "storage")
+
+
+class Fault:
+    """
+    What happens to every call of one dependency: `latency` seconds plus up to
+    `jitter` more, then with `timeout_rate` probability a hang of `timeout` seconds
+    and with `error_rate` probability an error.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        timeout_rate: float = 0.0,
+        timeout: float = 30.0,
+    ) -> None:
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.error_rate = float(error_rate)
+        self.timeout_rate = float(timeout_rate)
+        self.timeout = float(timeout)
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def parse_faults(value) -> Dict[str, Fault]:
+    """
+    Faults come as a mapping of target to settings, or from the environment as
+    "target:setting=value,setting=value;target:setting=value".
+    """
+    if isinstance(value, dict):
+        return {target: Fault(**settings) for target, settings in value.items()}
+    faults = {}
+    for item in str(value or "").split(";"):
+        if ":" in item:
+            target, settings = item.split(":", 1)
+            faults[target.strip()] = Fault(
+                **{
+                    key.strip(): float(setting)
+                    for key, setting in (
+                        pair.split("=", 1) for pair in settings.split(",") if pair
+                    )
+                }
+            )
+    return faults
+
+
+class FaultInjector:
+    """
+    Faults of this worker, changed at runtime through /debug/faults.
+    """
+
+    def __init__(self, faults: Dict[str, Fault]) -> None:
+        self.faults: Dict[str, Fault] = {}
+        self.update(faults)
+
+    def update(self, faults: Dict[str, Fault]):
+        for target in faults:
+            if target not in TARGETS:
+                raise ValueError(f"Unknown fault target {target!r}")
+        self.faults.update(faults)
+
+    def clear(self):
+        self.faults.clear()
+
+    def to_dict(self) -> dict:
+        return {target: fault.to_dict() for target, fault in self.faults.items()}
+
+    async def inject(self, target: str):
+        fault = self.faults.get(target)
+        if fault is None:
+            return
+        delay = fault.latency + random.uniform(0, fault.jitter)
+        if delay:
+            FAULT_INJECTIONS.labels(target, "latency").inc()
+            await asyncio.sleep(delay)
+        if random.random() < fault.timeout_rate:
+            FAULT_INJECTIONS.labels(target, "timeout").inc()
+            await asyncio.sleep(fault.timeout)
+            raise InjectedFault(target, "timeout")
+        if random.random() < fault.error_rate:
+            FAULT_INJECTIONS.labels(target, "error").inc()
+            raise InjectedFault(target, "error")
+
+
+async def inject_fault(request: sanic.Request, target: str):
+    injector = request.app.config.get("FAULT_INJECTOR")
+    if injector is not None:
+        await injector.inject(target)
+
+
+class FaultyLinkCache(LinkCacheBase):
+    def __init__(self, injector: FaultInjector, backend: LinkCacheBase) -> None:
+        self.injector = injector
+        self.backend = backend
+
+    async def add_link_to_cache(self, video_link: str, vnf) -> bool:
+        await self.injector.inject("link_cache")
+        return await self.backend.add_link_to_cache(video_link, vnf)
+
+    async def get_link_from_cache(self, video_link: str):
+        await self.injector.inject("link_cache")
+        return await self.backend.get_link_from_cache(video_link)
+
+    async def get_links_from_cache(
+        self, field, count, offset=0, projection=None, cursor=None
+    ):
+        await self.injector.inject("link_cache")
+        return await self.backend.get_links_from_cache(
+            field, count, offset, projection, cursor
+        )
+
+    async def get_links_batch(self, video_links: List[str]):
+        await self.injector.inject("link_cache")
+        return await self.backend.get_links_batch(video_links)
+
+    async def increment_hits(self, video_link: str, hits: int = 1):
+        await self.injector.inject("link_cache")
+        await self.backend.increment_hits(video_link, hits)
+
+    async def update_link(self, video_link: str, fields: dict):
+        await self.injector.inject("link_cache")
+        await self.backend.update_link(video_link, fields)
+
+
+class FaultyStats(StatsBase):
+    def __init__(self, injector: FaultInjector, backend: StatsBase) -> None:
+        self.injector = injector
+        self.backend = backend
+
+    async def add_to_stat(self, metric: str):
+        await self.injector.inject("stats")
+        await self.backend.add_to_stat(metric)
+
+    async def get_stats(self, day: str):
+        await self.injector.inject("stats")
+        return await self.backend.get_stats(day)
+
+    async def add_rollup(self, hour: str, rollup: dict):
+        await self.injector.inject("stats")
+        await self.backend.add_rollup(hour, rollup)
+
+    async def get_rollups(self, start: str, end: str):
+        await self.injector.inject("stats")
+        return await self.backend.get_rollups(start, end)
+
+
+class FaultyStorage(StorageBase):
+    def __init__(self, injector: FaultInjector, backend: StorageBase) -> None:
+        self.injector = injector
+        self.backend = backend
+        self.config = backend.config
+
+    async def store_media(self, url: str):
+        await self.injector.inject("storage")
+        return await self.backend.store_media(url)
+
+    async def retrieve_media(self, own_identifier: str):
+        await self.injector.inject("storage")
+        return await self.backend.retrieve_media(own_identifier)
+
+
+def initialize_faults(app: sanic.Sanic):
+    """
+    With FAULT_INJECTION on, the backends are wrapped so latency, errors and hangs
+    from FAULTS can be injected, closest to the backend so breakers and caches in
+    front see them like real failures. Never turn it on in production.
+    """
+
+    @app.before_server_start
+    def wrap_backends(app: sanic.Sanic, loop):
+        if (
+            not app.config.get("FAULT_INJECTION", False)
+            or "FAULT_INJECTOR" in app.config
+        ):
+            return
+        injector = FaultInjector(parse_faults(app.config.get("FAULTS")))
+        app.config.update(
+            {
+                "FAULT_INJECTOR": injector,
+                "LINKS_MODULE": FaultyLinkCache(injector, app.config.LINKS_MODULE),
+                "STAT_MODULE": FaultyStats(injector, app.config.STAT_MODULE),
+                "STORAGE_MODULE": FaultyStorage(injector, app.config.STORAGE_MODULE),
+            }
+        )
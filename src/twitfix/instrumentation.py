@@ -0,0 +1,72 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+import sanic
+from sanic.log import logger
+
+from .metrics import STAGE_SECONDS
+from .structured_logging import route_name
+from .timeseries import TimeSeries
+from .tracing import span
+
+
+def initialize_instrumentation(app: sanic.Sanic):
+    app.config.update(
+        {"TIMESERIES": TimeSeries(app.config.get("TIMESERIES_MINUTES", 120))}
+    )
+
+    @app.on_request
+    async def start_timer(request: sanic.Request):
+        request.ctx.started = time.perf_counter()
+
+    @app.on_response
+    async def record_route(request: sanic.Request, response):
+        started = getattr(request.ctx, "started", None)
+        if started is None:
+            return
+        series = request.app.config.TIMESERIES
+        series.observe(
+            f"route:{route_name(request)}", (time.perf_counter() - started) * 1000
+        )
+        if response is not None and response.status >= 500:
+            series.increment("status:5xx")
+
+    @app.after_server_start
+    async def start_rollups(app: sanic.Sanic, loop):
+        app.add_task(rollup_loop(app))
+
+    @app.before_server_stop
+    async def final_rollup(app: sanic.Sanic, loop):
+        await flush_rollups(app, include_current=True)
+
+
+@contextmanager
+def stage(request: sanic.Request, name: str):
+    """
+    Time one step of the request pipeline.
+    """
+    started = time.perf_counter()
+    try:
+        with span(name):
+            yield
+    finally:
+        elapsed = time.perf_counter() - started
+        request.app.config.TIMESERIES.observe(f"stage:{name}", elapsed * 1000)
+        STAGE_SECONDS.labels(name).observe(elapsed)
+
+
+async def flush_rollups(app: sanic.Sanic, include_current: bool = False):
+    series: TimeSeries = app.config.TIMESERIES
+    for hour, rollup in series.pending_hours(include_current).items():
+        try:
+            await app.config.STAT_MODULE.add_rollup(hour, rollup.to_dict())
+        except Exception as e:
+            logger.error(f" ➤ [ X ] Failed to store stats rollup for {hour}: {e}")
+
+
+async def rollup_loop(app: sanic.Sanic):
+    interval = app.config.get("STATS_ROLLUP_INTERVAL", 60)
+    while True:
+        await asyncio.sleep(interval)
+        await flush_rollups(app)
@@ -1,16 +1,60 @@
-import json
+import base64
+import logging
+import time
 from contextlib import suppress
 from itertools import islice
-from typing import Any, List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Sequence
 from uuid import UUID, uuid5
 
-from sanic.log import logger
+from . import serialization
+from .exceptions import InvalidCursor
+from .startup import lazy_import
+from .structured_logging import log_event
+from .tracing import span
 
 with suppress(ImportError):
-    import pymongo
+    pymongo = lazy_import("pymongo")
+    bson = lazy_import("bson")
 
 with suppress(ImportError):
-    import google.cloud.firestore
+    firestore = lazy_import("google.cloud.firestore")
+
+with suppress(ImportError):
+    aioredis = lazy_import("redis.asyncio")
+
+
+class LinkPage(list):
+    """
+    Links listed by get_links_from_cache, `cursor` continues after the last of them
+    and is None once the listing is exhausted.
+    """
+
+    def __init__(self, vnfs: Iterable[Any] = (), cursor: Optional[str] = None):
+        super().__init__(vnfs)
+        self.cursor = cursor
+
+
+def encode_cursor(*values) -> str:
+    payload = serialization.dumpb(values)
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types) -> list:
+    """
+    The values of `cursor`, one of each of `types` in that order. Cursors come from
+    clients, anything else in them is an InvalidCursor.
+    """
+    try:
+        values = serialization.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+    except ValueError:
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(types):
+        raise InvalidCursor(cursor)
+    if not all(isinstance(value, kind) for value, kind in zip(values, types)):
+        raise InvalidCursor(cursor)
+    return values
 
 
 class LinkCacheBase:
@@ -23,7 +67,35 @@ class LinkCacheBase:
     async def get_link_from_cache(self, video_link: str) -> Optional[Any]:
         pass
 
-    async def get_links_from_cache(self, field: str, count: int, offset: int) -> List[Any]:
+    async def get_links_from_cache(
+        self,
+        field: str,
+        count: int,
+        offset: int = 0,
+        projection: Optional[Sequence[str]] = None,
+        cursor: Optional[str] = None,
+    ) -> List[Any]:
+        """
+        A LinkPage of `count` links by `field`, descending. Pages continue from the
+        `cursor` of the previous one, which unlike an `offset` costs the same however
+        deep it is. With a `projection` only those fields need to be fetched.
+        """
+        pass
+
+    async def get_links_batch(self, video_links: List[str]) -> Dict[str, Any]:
+        """
+        The cached links among `video_links` in one lookup, by link. Links that are
+        not cached are left out, and unlike single lookups nothing counts as a hit.
+        """
+        pass
+
+    async def increment_hits(self, video_link: str, hits: int = 1) -> None:
+        pass
+
+    async def update_link(self, video_link: str, fields: dict) -> None:
+        """
+        Overwrite some fields of a cached link, nothing happens when it is not cached.
+        """
         pass
 
 
@@ -36,10 +108,17 @@ class MongoDBCache(LinkCacheBase):
     async def add_link_to_cache(self, video_link: str, vnf):
         try:
             out = self.db.linkCache.insert_one(vnf)
-            logger.info(" ➤ [ + ] Link added to DB cache ")
+            log_event(
+                "cache_write", " ➤ [ + ] Link added to DB cache ", tweet=video_link
+            )
             return True
         except Exception:
-            logger.info(" ➤ [ X ] Failed to add link to DB cache")
+            log_event(
+                "cache_write",
+                " ➤ [ X ] Failed to add link to DB cache",
+                level=logging.WARNING,
+                tweet=video_link,
+            )
         return False
 
     async def get_link_from_cache(self, video_link: str):
@@ -47,23 +126,56 @@ class MongoDBCache(LinkCacheBase):
         vnf = collection.find_one({"tweet": video_link})
         if vnf != None:
             hits = vnf.get("hits", 0) + 1
-            logger.info(
-                f" ➤ [ ✔ ] Link located in DB cache. hits on this link so far: [{hits}]"
+            log_event(
+                "cache_hit",
+                " ➤ [ ✔ ] Link located in DB cache",
+                tweet=video_link,
+                hits=hits,
             )
-            query = {"tweet": video_link}
-            change = {"$inc": {"hits": 1}}
-            out = self.db.linkCache.update_one(query, change)
+            with span("cache.hit_count"):
+                await self.increment_hits(video_link)
             return vnf
         else:
-            logger.info(" ➤ [ X ] Link not in DB cache")
+            log_event("cache_miss", " ➤ [ X ] Link not in DB cache", tweet=video_link)
 
-    async def get_links_from_cache(self, field: str, count: int, offset: int):
-        collection = self.db.linkCache
-        return list(
-            collection.find(sort=[(field, pymongo.DESCENDING)])
-            .skip(offset)
-            .limit(count)
+    async def get_links_batch(self, video_links: List[str]):
+        vnfs = self.db.linkCache.find({"tweet": {"$in": list(video_links)}})
+        return {vnf["tweet"]: vnf for vnf in vnfs}
+
+    async def increment_hits(self, video_link: str, hits: int = 1):
+        query = {"tweet": video_link}
+        change = {"$inc": {"hits": hits}}
+        self.db.linkCache.update_one(query, change)
+
+    async def update_link(self, video_link: str, fields: dict):
+        self.db.linkCache.update_one({"tweet": video_link}, {"$set": fields})
+
+    async def get_links_from_cache(
+        self, field, count, offset=0, projection=None, cursor=None
+    ):
+        # Ties are broken by _id, an index on (field, _id) serves every page.
+        sort = [(field, pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+        if field == "_id":
+            sort = sort[1:]
+        query = {}
+        if cursor is not None:
+            value, last = decode_cursor(cursor, object, str)
+            if not bson.ObjectId.is_valid(last):
+                raise InvalidCursor(cursor)
+            last = bson.ObjectId(last)
+            query = {"_id": {"$lt": last}}
+            if field != "_id":
+                query = {"$or": [{field: {"$lt": value}}, {field: value, **query}]}
+            offset = 0
+        fields = None if projection is None else {name: 1 for name in projection}
+        if fields is not None:
+            fields[field] = 1
+        vnfs = list(
+            self.db.linkCache.find(query, fields, sort=sort).skip(offset).limit(count)
         )
+        if len(vnfs) < count:
+            return LinkPage(vnfs)
+        return LinkPage(vnfs, encode_cursor(vnfs[-1].get(field), str(vnfs[-1]["_id"])))
 
 
 class FirestoreCache(LinkCacheBase):
@@ -71,7 +183,7 @@ class FirestoreCache(LinkCacheBase):
     namespace = UUID("135679dc-738a-4596-8bd2-9a70c1cea8c2")
 
     def __init__(self, config) -> None:
-        self.fire = google.cloud.firestore.AsyncClient()
+        self.fire = firestore.AsyncClient()
         self.links = self.fire.collection("links")
 
     def _hash(self, link: str):
@@ -82,7 +194,7 @@ class FirestoreCache(LinkCacheBase):
     async def add_link_to_cache(self, video_link: str, vnf):
         id_ = self._hash(video_link)
         await self.links.document(id_).set(
-            {**vnf, "_id": id_, "created_at": google.cloud.firestore.SERVER_TIMESTAMP}
+            {**vnf, "_id": id_, "created_at": firestore.SERVER_TIMESTAMP}
         )
 
     async def get_link_from_cache(self, video_link: str):
@@ -90,33 +202,65 @@ class FirestoreCache(LinkCacheBase):
         doc = await ref.get()
         if not doc.exists:
             return None
-        await ref.update({"hits": google.cloud.firestore.Increment(1)})
+        with span("cache.hit_count"):
+            await ref.update({"hits": firestore.Increment(1)})
         return doc.to_dict()
 
-    async def get_links_from_cache(self, field: str, count: int, offset: int):
-        docs = (
-            await self.links.order_by(field, direction="DESCENDING")
-            .offset(offset)
-            .limit(count)
-            .get()
-        )
-        return [doc.to_dict() for doc in docs]
+    async def get_links_batch(self, video_links: List[str]):
+        links = {self._hash(video_link): video_link for video_link in video_links}
+        refs = [self.links.document(id_) for id_ in links]
+        return {
+            links[doc.id]: doc.to_dict()
+            async for doc in self.fire.get_all(refs)
+            if doc.exists
+        }
+
+    async def increment_hits(self, video_link: str, hits: int = 1):
+        ref = self.links.document(self._hash(video_link))
+        await ref.update({"hits": firestore.Increment(hits)})
+
+    async def update_link(self, video_link: str, fields: dict):
+        ref = self.links.document(self._hash(video_link))
+        if (await ref.get()).exists:
+            await ref.update(fields)
+
+    async def get_links_from_cache(
+        self, field, count, offset=0, projection=None, cursor=None
+    ):
+        # Document ids are hashes, the latest links are found by creation time.
+        order = "created_at" if field == "_id" else field
+        query = self.links.order_by(order, direction="DESCENDING")
+        if projection is not None:
+            query = query.select(list(projection))
+        if cursor is not None:
+            [id_] = decode_cursor(cursor, str)
+            last = await self.links.document(id_).get()
+            if not last.exists:
+                raise InvalidCursor(cursor)
+            query = query.start_after(last)
+        else:
+            query = query.offset(offset)
+        docs = await query.limit(count).get()
+        vnfs = [doc.to_dict() for doc in docs]
+        if len(docs) < count:
+            return LinkPage(vnfs)
+        return LinkPage(vnfs, encode_cursor(docs[-1].id))
 
 
 # This might be fine to use under local development, but once you got a huge site running or you need
 # to spread the load, this local-only system will not be useful.
 class JSONCache(LinkCacheBase):
     def __init__(self, config) -> None:
-        self.links_cache_filename = "links.json"
+        self.links_cache_filename = config.get("JSON_CACHE_FILE", "links.json")
         try:
-            with open(self.links_cache_filename) as f:
-                self.link_cache = json.load(f)
+            with open(self.links_cache_filename, "rb") as f:
+                self.link_cache = serialization.loads(f.read())
         except FileNotFoundError:
             self.link_cache = {}
 
     def _write_cache(self):
-        with open(self.links_cache_filename, "w") as outfile:
-            json.dump(self.link_cache, outfile, indent=4, sort_keys=True)
+        with open(self.links_cache_filename, "wb") as outfile:
+            outfile.write(serialization.dumpb(self.link_cache, pretty=True))
 
     async def add_link_to_cache(self, video_link, vnf):
         self.link_cache[video_link] = vnf
@@ -124,20 +268,201 @@ class JSONCache(LinkCacheBase):
 
     async def get_link_from_cache(self, video_link):
         if video_link in self.link_cache:
-            logger.info(" ➤ [ ✔ ] Link located in json cache")
+            log_event(
+                "cache_hit", " ➤ [ ✔ ] Link located in json cache", tweet=video_link
+            )
             vnf = self.link_cache[video_link]
-            vnf["hits"] += 1
-            self._write_cache()
+            with span("cache.hit_count"):
+                await self.increment_hits(video_link)
             return vnf
         else:
-            logger.info(" ➤ [ X ] Link not in json cache")
+            log_event("cache_miss", " ➤ [ X ] Link not in json cache", tweet=video_link)
             return None
 
-    async def get_links_from_cache(self, field: str, count: int, offset: int):
-        sorted_cache = sorted(
-            self.link_cache.values(), key=lambda l: l.get(field), reverse=True
+    async def get_links_batch(self, video_links: List[str]):
+        return {
+            video_link: self.link_cache[video_link]
+            for video_link in video_links
+            if video_link in self.link_cache
+        }
+
+    async def increment_hits(self, video_link: str, hits: int = 1):
+        if video_link in self.link_cache:
+            self.link_cache[video_link]["hits"] += hits
+            self._write_cache()
+
+    async def update_link(self, video_link: str, fields: dict):
+        if video_link in self.link_cache:
+            self.link_cache[video_link].update(fields)
+            self._write_cache()
+
+    async def get_links_from_cache(
+        self, field, count, offset=0, projection=None, cursor=None
+    ):
+        if field == "_id":
+            # Nothing here has an _id, the latest links are the last ones added.
+            ordered = list(reversed(self.link_cache.items()))
+        else:
+            ordered = sorted(
+                self.link_cache.items(),
+                key=lambda item: (item[1].get(field) or 0, item[0]),
+                reverse=True,
+            )
+        if cursor is not None:
+            [last] = decode_cursor(cursor, str)
+            links = [link for link, _ in ordered]
+            offset = links.index(last) + 1 if last in links else len(links)
+        page = list(islice(ordered, offset, offset + count))
+        vnfs = [vnf for _, vnf in page]
+        if len(page) < count:
+            return LinkPage(vnfs)
+        return LinkPage(vnfs, encode_cursor(page[-1][0]))
+
+
+class RedisCache(LinkCacheBase):
+    """
+    Links are kept as JSON strings that expire after LINK_CACHE_TTL seconds, hit
+    counts and insertion order live in sorted sets which back the top and latest
+    listings. Stale members of those are dropped, and the sets trimmed to
+    REDIS_INDEX_SIZE, when they are listed.
+    """
+
+    def __init__(self, config) -> None:
+        self.redis = aioredis.from_url(config.REDIS_URL, decode_responses=True)
+        prefix = config.get("REDIS_PREFIX", "twitfix")
+        self.prefix = f"{prefix}:link:"
+        self.ttl = config.get("LINK_CACHE_TTL", 30 * 24 * 3600) or None
+        self.index_size = config.get("REDIS_INDEX_SIZE", 10000)
+        self.indexes = {"hits": f"{prefix}:top", "_id": f"{prefix}:latest"}
+
+    async def add_link_to_cache(self, video_link: str, vnf):
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.set(
+                    self.prefix + video_link, serialization.dumps(vnf), ex=self.ttl
+                )
+                pipe.zadd(self.indexes["_id"], {video_link: time.time()})
+                pipe.zadd(
+                    self.indexes["hits"], {video_link: vnf.get("hits", 0)}, nx=True
+                )
+                await pipe.execute()
+            log_event(
+                "cache_write", " ➤ [ + ] Link added to redis cache", tweet=video_link
+            )
+            return True
+        except Exception:
+            log_event(
+                "cache_write",
+                " ➤ [ X ] Failed to add link to redis cache",
+                level=logging.WARNING,
+                tweet=video_link,
+            )
+        return False
+
+    async def get_link_from_cache(self, video_link: str):
+        # The lookup and the hit count share one round trip, links trimmed from
+        # the top listing come back with the hits they get from now on.
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.prefix + video_link)
+            pipe.zincrby(self.indexes["hits"], 1, video_link)
+            with span("cache.hit_count"):
+                payload, hits = await pipe.execute()
+        if payload is None:
+            await self.redis.zrem(self.indexes["hits"], video_link)
+            log_event(
+                "cache_miss", " ➤ [ X ] Link not in redis cache", tweet=video_link
+            )
+            return None
+        log_event(
+            "cache_hit",
+            " ➤ [ ✔ ] Link located in redis cache",
+            tweet=video_link,
+            hits=hits,
+        )
+        vnf = serialization.loads(payload)
+        if hits is not None:
+            vnf["hits"] = int(hits)
+        return vnf
+
+    async def get_links_from_cache(
+        self, field, count, offset=0, projection=None, cursor=None
+    ):
+        index = self.indexes.get(field, self.indexes["_id"])
+        await self.trim_indexes()
+        if cursor is not None:
+            score, last = decode_cursor(cursor, (int, float), str)
+            rank = await self.redis.zrevrank(index, last)
+            if rank is not None:
+                offset = rank + 1
+            else:
+                # The last link left the index since, continue where it would be.
+                # Equal scores are listed by member, descending.
+                ties = await self.redis.zrevrangebyscore(index, score, score)
+                above = await self.redis.zcount(index, f"({score}", "+inf")
+                offset = above + sum(tie > last for tie in ties)
+        links = await self.redis.zrevrange(
+            index, offset, offset + count - 1, withscores=True
         )
-        return list(islice(sorted_cache, offset, offset + count))
+        if not links:
+            return LinkPage()
+        payloads = await self.redis.mget([self.prefix + link for link, _ in links])
+        expired = [
+            link for (link, _), payload in zip(links, payloads) if payload is None
+        ]
+        if expired:
+            await self.redis.zrem(index, *expired)
+        vnfs = []
+        for (link, score), payload in zip(links, payloads):
+            if payload is not None:
+                vnf = serialization.loads(payload)
+                if field == "hits":
+                    vnf["hits"] = int(score)
+                vnfs.append(vnf)
+        if len(links) < count:
+            return LinkPage(vnfs)
+        return LinkPage(vnfs, encode_cursor(links[-1][1], links[-1][0]))
+
+    async def get_links_batch(self, video_links: List[str]):
+        video_links = list(video_links)
+        if not video_links:
+            return {}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.mget([self.prefix + video_link for video_link in video_links])
+            for video_link in video_links:
+                pipe.zscore(self.indexes["hits"], video_link)
+            payloads, *scores = await pipe.execute()
+        vnfs = {}
+        for video_link, payload, hits in zip(video_links, payloads, scores):
+            if payload is not None:
+                vnf = serialization.loads(payload)
+                if hits is not None:
+                    vnf["hits"] = int(hits)
+                vnfs[video_link] = vnf
+        return vnfs
+
+    async def increment_hits(self, video_link: str, hits: int = 1):
+        await self.redis.zincrby(self.indexes["hits"], hits, video_link)
+
+    async def trim_indexes(self):
+        """
+        Keep the REDIS_INDEX_SIZE highest ranked members of the listings. This runs
+        as they are read, trimming on insert would drop new links before any hits.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for index in self.indexes.values():
+                pipe.zremrangebyrank(index, 0, -self.index_size - 1)
+            await pipe.execute()
+
+    async def update_link(self, video_link: str, fields: dict):
+        payload = await self.redis.get(self.prefix + video_link)
+        if payload is not None:
+            vnf = {**serialization.loads(payload), **fields}
+            await self.redis.set(
+                self.prefix + video_link,
+                serialization.dumps(vnf),
+                keepttl=True,
+                xx=True,
+            )
 
 
 def initialize_link_cache(link_cache_type: str, config) -> LinkCacheBase:
@@ -147,11 +472,16 @@ def initialize_link_cache(link_cache_type: str, config) -> LinkCacheBase:
         return MongoDBCache(config)
 
     if link_cache_type == "firestore":
-        if not globals().get("google"):
-            raise LookupError("the pymongo library was not included during build.")
+        if not globals().get("firestore"):
+            raise LookupError("the firestore library was not included during build.")
         return FirestoreCache(config)
 
     if link_cache_type == "json":
         return JSONCache(config)
 
+    if link_cache_type == "redis":
+        if not globals().get("aioredis"):
+            raise LookupError("the redis library was not included during build.")
+        return RedisCache(config)
+
     raise LookupError("Cache system not recognized.")
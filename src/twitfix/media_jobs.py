@@ -0,0 +1,336 @@
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import sanic
+
+from .exceptions import MediaUnavailable
+from .metrics import MEDIA_JOBS
+from .storage_module import StorageBase, process_alive
+from .structured_logging import log_event
+
+# Lower runs first: downloads somebody is waiting for go ahead of prefetches.
+PRIORITY_USER = 0
+PRIORITY_PREFETCH = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media_jobs (
+    url TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    owner INTEGER,
+    identifier TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_jobs_ready ON media_jobs (state, priority, created);
+"""
+
+
+class JobQueue:
+    """
+    Media downloads of every worker of a node, kept in SQLite so they survive the
+    workers and each URL is downloaded by one of them at a time.
+
+    Jobs are "queued", "running", "done" or "failed". Failed attempts are retried
+    after an exponential backoff until `attempts` ran out. Calls block on SQLite,
+    they run on a thread of their own.
+    """
+
+    def __init__(self, path: str, attempts: int, backoff: float, per_host: int) -> None:
+        self.path = path
+        self.attempts = attempts
+        self.backoff = backoff
+        self.per_host = per_host
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="media-jobs")
+        self.connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    async def call(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, method, *args
+        )
+
+    def job(self, url: str) -> Optional[sqlite3.Row]:
+        return self.connection.execute(
+            "SELECT * FROM media_jobs WHERE url = ?", (url,)
+        ).fetchone()
+
+    def enqueue(self, url: str, priority: int) -> bool:
+        """
+        Queue `url` unless it is queued, running or done already, raising the
+        priority of a waiting job when needed. Jobs that failed for good start over.
+        """
+        now = time.time()
+        cursor = self.connection.execute(
+            """
+            INSERT INTO media_jobs (url, host, priority, state, created, updated)
+            VALUES (?, ?, ?, 'queued', ?, ?)
+            ON CONFLICT (url) DO UPDATE SET
+                priority = MIN(priority, excluded.priority),
+                state = CASE state WHEN 'failed' THEN 'queued' ELSE state END,
+                attempts = CASE state WHEN 'failed' THEN 0 ELSE attempts END,
+                not_before = CASE state WHEN 'failed' THEN 0 ELSE not_before END,
+                updated = excluded.updated
+            WHERE state != 'done'
+            """,
+            (url, urllib.parse.urlsplit(url).netloc, priority, now, now),
+        )
+        return cursor.rowcount > 0
+
+    def claim(self) -> Optional[sqlite3.Row]:
+        """
+        Take the most urgent queued job that is due and whose host has a free slot.
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            job = self.connection.execute(
+                """
+                SELECT * FROM media_jobs AS job
+                WHERE state = 'queued' AND not_before <= ?
+                AND (
+                    SELECT COUNT(*) FROM media_jobs
+                    WHERE state = 'running' AND host = job.host
+                ) < ?
+                ORDER BY priority, created
+                LIMIT 1
+                """,
+                (now, self.per_host),
+            ).fetchone()
+            if job is not None:
+                self.connection.execute(
+                    """
+                    UPDATE media_jobs
+                    SET state = 'running', owner = ?, attempts = attempts + 1, updated = ?
+                    WHERE url = ?
+                    """,
+                    (os.getpid(), now, job["url"]),
+                )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return job
+
+    def finish(self, url: str, identifier: str):
+        self.connection.execute(
+            """
+            UPDATE media_jobs SET state = 'done', identifier = ?, error = NULL, updated = ?
+            WHERE url = ?
+            """,
+            (identifier, time.time(), url),
+        )
+
+    def fail(self, url: str, attempts: int, error: str) -> bool:
+        """
+        Queue the job again after a backoff, returns False when it failed for good.
+        """
+        retry = attempts < self.attempts
+        delay = self.backoff * 2 ** (attempts - 1) * random.uniform(1, 1.5)
+        self.connection.execute(
+            """
+            UPDATE media_jobs SET state = ?, not_before = ?, error = ?, updated = ?
+            WHERE url = ?
+            """,
+            (
+                "queued" if retry else "failed",
+                time.time() + delay,
+                error,
+                time.time(),
+                url,
+            ),
+        )
+        return retry
+
+    def recover(self, retention: float) -> int:
+        """
+        Queue again the jobs of workers that died while running them, and forget
+        finished jobs older than `retention` seconds.
+        """
+        owners = self.connection.execute(
+            "SELECT DISTINCT owner FROM media_jobs WHERE state = 'running'"
+        ).fetchall()
+        recovered = 0
+        for (owner,) in owners:
+            if owner is not None and not process_alive(owner):
+                recovered += self.connection.execute(
+                    """
+                    UPDATE media_jobs SET state = 'queued', owner = NULL
+                    WHERE state = 'running' AND owner = ?
+                    """,
+                    (owner,),
+                ).rowcount
+        self.connection.execute(
+            "DELETE FROM media_jobs WHERE state IN ('done', 'failed') AND updated < ?",
+            (time.time() - retention,),
+        )
+        return recovered
+
+
+class QueuedStorage(StorageBase):
+    """
+    Media downloads go through the job queue. A URL stored before is checked with
+    the storage right away, others are queued and waited for.
+    """
+
+    def __init__(
+        self, queue: JobQueue, backend: StorageBase, workers: int, wait: float
+    ) -> None:
+        self.queue = queue
+        self.backend = backend
+        self.config = backend.config
+        self.workers = workers
+        self.wait = wait
+        # Set whenever jobs are queued or finished by this worker.
+        self.changed = asyncio.Event()
+
+    async def store_media(self, url: str) -> Tuple[bool, str]:
+        job = await self.queue.call(self.queue.job, url)
+        if job is not None and job["state"] == "done":
+            return await self.backend.store_media(url)
+        await self.enqueue(url, PRIORITY_USER)
+        return False, await self.result(url)
+
+    async def retrieve_media(self, own_identifier: str):
+        return await self.backend.retrieve_media(own_identifier)
+
+    async def enqueue(self, url: str, priority: int):
+        if await self.queue.call(self.queue.enqueue, url, priority):
+            MEDIA_JOBS.labels("queued").inc()
+        self.notify()
+
+    async def result(self, url: str) -> str:
+        deadline = time.monotonic() + self.wait
+        while time.monotonic() < deadline:
+            job = await self.queue.call(self.queue.job, url)
+            if job["state"] == "done":
+                return job["identifier"]
+            if job["state"] == "failed":
+                raise MediaUnavailable(url, job["error"])
+            # Other workers finish jobs too, without telling this one.
+            await self.changes(0.25)
+        raise MediaUnavailable(url, "Timed out waiting for the download")
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def changes(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def start(self, app: sanic.Sanic):
+        for _ in range(self.workers):
+            app.add_task(self.run())
+
+    async def run(self):
+        backoff = 0.0
+        while True:
+            try:
+                await self.step()
+            except Exception as e:
+                # The queue itself failed, a locked database for one. Jobs left running
+                # are queued again by `recover` on the next start.
+                backoff = min(max(backoff * 2, 1.0), 60.0)
+                log_event(
+                    "storage",
+                    " ➤ [ X ] Media job queue failed",
+                    error=repr(e),
+                    backoff=backoff,
+                )
+                await asyncio.sleep(backoff)
+            else:
+                backoff = 0.0
+
+    async def step(self):
+        job = await self.queue.call(self.queue.claim)
+        if job is None:
+            await self.changes(1.0)
+            return
+        try:
+            _, identifier = await self.backend.store_media(job["url"])
+        except Exception as e:
+            retry = await self.queue.call(
+                self.queue.fail, job["url"], job["attempts"] + 1, repr(e)
+            )
+            MEDIA_JOBS.labels("retried" if retry else "failed").inc()
+            log_event(
+                "storage",
+                " ➤ [ X ] Media download failed",
+                url=job["url"],
+                attempt=job["attempts"] + 1,
+                retry=retry,
+                error=repr(e),
+            )
+        else:
+            await self.queue.call(self.queue.finish, job["url"], identifier)
+            MEDIA_JOBS.labels("done").inc()
+        self.notify()
+
+
+def queued_storage(storage: StorageBase) -> Optional[QueuedStorage]:
+    # Other tiers in front keep what they wrap as `backend`.
+    while storage is not None and not isinstance(storage, QueuedStorage):
+        storage = getattr(storage, "backend", None)
+    return storage
+
+
+def initialize_media_jobs(app: sanic.Sanic):
+    """
+    With MEDIA_JOBS on, media downloads of every worker go through a job queue kept
+    in SQLite at MEDIA_JOBS_PATH, run by MEDIA_JOBS_WORKERS tasks per worker.
+    """
+    if not app.config.get("MEDIA_JOBS", False):
+        return
+
+    @app.before_server_start
+    def wrap_storage(app: sanic.Sanic, loop):
+        if "MEDIA_JOBS_QUEUE" in app.config:
+            return
+        queue = JobQueue(
+            app.config.get(
+                "MEDIA_JOBS_PATH",
+                os.path.join(tempfile.gettempdir(), "twitfix-jobs.sqlite3"),
+            ),
+            attempts=app.config.get("MEDIA_JOBS_ATTEMPTS", 4),
+            backoff=app.config.get("MEDIA_JOBS_BACKOFF", 1.0),
+            per_host=app.config.get("MEDIA_JOBS_PER_HOST", 4),
+        )
+        recovered = queue.recover(app.config.get("MEDIA_JOBS_RETENTION", 86400))
+        if recovered:
+            log_event("storage", " ➤ [ ! ] Recovered media jobs", jobs=recovered)
+        app.config.update(
+            {
+                "MEDIA_JOBS_QUEUE": queue,
+                "STORAGE_MODULE": QueuedStorage(
+                    queue,
+                    app.config.STORAGE_MODULE,
+                    workers=app.config.get("MEDIA_JOBS_WORKERS", 4),
+                    wait=app.config.get("MEDIA_JOBS_WAIT", 60.0),
+                ),
+            }
+        )
+
+    @app.after_server_start
+    async def start_workers(app: sanic.Sanic, loop):
+        storage = queued_storage(app.config.STORAGE_MODULE)
+        # The event belongs to the loop of the server started last.
+        storage.changed = asyncio.Event()
+        storage.start(app)
@@ -0,0 +1,195 @@
+import atexit
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+
+def remove_multiproc_dir(owner: int, path: str):
+    # Forked workers inherit this hook, only the process that made the directory
+    # removes it.
+    if os.getpid() == owner:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# Sanic forks one process per worker, every worker writes its samples to this
+# directory and the /metrics endpoint sums them up. prometheus_client picks it up
+# on import, so without PROMETHEUS_MULTIPROC_DIR a temporary one is made here and
+# removed again when the process exits.
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="twitfix-metrics-")
+    atexit.register(
+        remove_multiproc_dir, os.getpid(), os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    )
+
+import prometheus_client
+import prometheus_client.multiprocess
+import sanic
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+STAGE_SECONDS = prometheus_client.Histogram(
+    "twitfix_stage_seconds",
+    "Time spent in each step of the request pipeline.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_LOOKUPS = prometheus_client.Counter(
+    "twitfix_cache_lookups",
+    "Link cache lookups by result.",
+    ["result"],
+)
+EXTRACTION_SECONDS = prometheus_client.Histogram(
+    "twitfix_extraction_seconds",
+    "Time spent extracting tweet information, by method and outcome.",
+    ["method", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+EXTRACTION_FALLBACKS = prometheus_client.Counter(
+    "twitfix_extraction_fallbacks",
+    "Hybrid mode extractions where the API failed and youtube-dl took over.",
+)
+EXTRACTION_HEDGES = prometheus_client.Counter(
+    "twitfix_extraction_hedges",
+    "Hybrid mode extractions, whether youtube-dl was started alongside a slow API call and which method won.",
+    ["hedged", "winner"],
+)
+STORAGE_SECONDS = prometheus_client.Histogram(
+    "twitfix_storage_seconds",
+    "Time spent storing and retrieving media, by operation and cache result.",
+    ["operation", "result"],
+    buckets=LATENCY_BUCKETS,
+)
+DOWNLOAD_BYTES = prometheus_client.Counter(
+    "twitfix_download_bytes",
+    "Bytes of media downloaded from upstream for rehosting.",
+)
+STORAGE_DEDUPED = prometheus_client.Counter(
+    "twitfix_storage_deduped",
+    "Downloads of media that was already stored under another URL.",
+)
+STORAGE_TIER_LOOKUPS = prometheus_client.Counter(
+    "twitfix_storage_tier_lookups",
+    "Media lookups answered by the hot tier on local disk or passed to the storage behind it.",
+    ["tier"],
+)
+PREFETCHES = prometheus_client.Counter(
+    "twitfix_prefetches",
+    "Videos stored ahead of their downloads, by result.",
+    ["result"],
+)
+PREFETCH_QUEUED = prometheus_client.Gauge(
+    "twitfix_prefetch_queued",
+    "Videos waiting to be prefetched.",
+    multiprocess_mode="livesum",
+)
+MEDIA_JOBS = prometheus_client.Counter(
+    "twitfix_media_jobs",
+    "Media download jobs queued, done, retried and failed for good.",
+    ["result"],
+)
+VIDEO_VARIANTS = prometheus_client.Counter(
+    "twitfix_video_variants",
+    "Videos handed out, by route and resolution (short side, 0 when unknown).",
+    ["route", "resolution"],
+)
+RENDER_SECONDS = prometheus_client.Histogram(
+    "twitfix_render_seconds",
+    "Time spent rendering templates.",
+    ["template"],
+    buckets=LATENCY_BUCKETS,
+)
+YOUTUBE_DL_SECONDS = prometheus_client.Histogram(
+    "twitfix_youtube_dl_seconds",
+    "Time spent in youtube-dl extraction, by extractor and outcome.",
+    ["extractor", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+YOUTUBE_DL_QUEUE_SECONDS = prometheus_client.Histogram(
+    "twitfix_youtube_dl_queue_seconds",
+    "Time extractions waited for a free youtube-dl thread.",
+    buckets=LATENCY_BUCKETS,
+)
+SHARED_CACHE_OPERATIONS = prometheus_client.Counter(
+    "twitfix_shared_cache_operations",
+    "Shared memory VNF cache lookups and stores, by result.",
+    ["operation", "result"],
+)
+ADMISSION_ACTIVE = prometheus_client.Gauge(
+    "twitfix_admission_active",
+    "Requests holding a slot of each admission budget.",
+    ["budget"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_WAITING = prometheus_client.Gauge(
+    "twitfix_admission_waiting",
+    "Requests queued for a slot of each admission budget.",
+    ["budget"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_REJECTED = prometheus_client.Counter(
+    "twitfix_admission_rejected",
+    "Requests turned away because an admission budget was exhausted.",
+    ["budget"],
+)
+EMBED_DEADLINE_RESULTS = prometheus_client.Counter(
+    "twitfix_embed_deadline_results",
+    "Cold embeds answered within their deadline, and how the ones that missed it ended.",
+    ["result"],
+)
+BREAKER_STATE = prometheus_client.Gauge(
+    "twitfix_breaker_state",
+    "Circuit breaker state per dependency, 0 closed, 1 half open, 2 open, worst worker.",
+    ["breaker"],
+    multiprocess_mode="max",
+)
+BREAKER_REJECTED = prometheus_client.Counter(
+    "twitfix_breaker_rejected",
+    "Calls not made because the dependency's circuit breaker was open.",
+    ["breaker"],
+)
+FAULT_INJECTIONS = prometheus_client.Counter(
+    "twitfix_fault_injections",
+    "Faults injected into dependency calls while fault injection is on.",
+    ["target", "kind"],
+)
+STARTUP_SECONDS = prometheus_client.Gauge(
+    "twitfix_startup_seconds",
+    "Seconds from process start until each startup phase finished, slowest worker.",
+    ["phase"],
+    multiprocess_mode="max",
+)
+
+
+def initialize_metrics(app: sanic.Sanic):
+    @app.main_process_start
+    def clear_stale_samples(app, loop):
+        # Sample files left over from an earlier run would be counted again.
+        for path in Path(os.environ["PROMETHEUS_MULTIPROC_DIR"]).glob("*.db"):
+            if not path.stem.endswith(f"_{os.getpid()}"):
+                path.unlink()
+
+    @app.after_server_stop
+    def mark_worker_dead(app, loop):
+        prometheus_client.multiprocess.mark_process_dead(os.getpid())
+
+
+def generate_metrics() -> bytes:
+    registry = prometheus_client.CollectorRegistry()
+    prometheus_client.multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry)
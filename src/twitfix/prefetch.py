@@ -0,0 +1,141 @@
+import asyncio
+from collections import OrderedDict
+
+import sanic
+
+from .media_jobs import PRIORITY_PREFETCH, queued_storage
+from .metrics import PREFETCH_QUEUED, PREFETCHES
+from .structured_logging import log_event
+from .variants import select_variant, variant_policy
+
+
+class Prefetcher:
+    """
+    Stores videos in the background before anyone asks to download them.
+
+    At most `concurrency` videos are stored at once, and their starts are spaced so
+    they average no more than `bandwidth` bytes a second going by the sizes known
+    of them. Videos queued recently are not queued again, and storing one that is
+    stored already does not download it.
+    """
+
+    def __init__(
+        self,
+        app: sanic.Sanic,
+        concurrency: int,
+        bandwidth: float,
+        queue_size: int,
+        memo: int = 4096,
+    ) -> None:
+        self.app = app
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.queued: OrderedDict = OrderedDict()
+        self.memo = memo
+        self.next_start = 0.0
+
+    def enqueue(self, variant: dict) -> bool:
+        url = variant["url"]
+        if url in self.queued:
+            self.queued.move_to_end(url)
+            return False
+        try:
+            self.queue.put_nowait(variant)
+        except asyncio.QueueFull:
+            PREFETCHES.labels("dropped").inc()
+            return False
+        PREFETCH_QUEUED.inc()
+        self.queued[url] = None
+        if len(self.queued) > self.memo:
+            self.queued.popitem(last=False)
+        return True
+
+    def start(self):
+        for _ in range(self.concurrency):
+            self.app.add_task(self.run())
+
+    async def run(self):
+        while True:
+            variant = await self.queue.get()
+            PREFETCH_QUEUED.dec()
+            try:
+                await self.prefetch(variant)
+            finally:
+                self.queue.task_done()
+
+    async def prefetch(self, variant: dict):
+        delay = self.reserve(variant.get("size") or 0)
+        if delay:
+            await asyncio.sleep(delay)
+        jobs = queued_storage(self.app.config.STORAGE_MODULE)
+        if jobs is not None:
+            # The job queue downloads it once nobody waits for a download.
+            await jobs.enqueue(variant["url"], PRIORITY_PREFETCH)
+            PREFETCHES.labels("queued").inc()
+            return
+        try:
+            cache_hit, _ = await self.app.config.STORAGE_MODULE.store_media(
+                variant["url"]
+            )
+        except Exception as e:
+            PREFETCHES.labels("failed").inc()
+            log_event(
+                "storage", " ➤ [ X ] Prefetch failed", url=variant["url"], error=repr(e)
+            )
+            return
+        if cache_hit:
+            # Nothing was downloaded, the next video may start in its place.
+            self.reserve(-(variant.get("size") or 0))
+        PREFETCHES.labels("present" if cache_hit else "stored").inc()
+
+    def reserve(self, size: int) -> float:
+        """
+        Take `size` bytes of the bandwidth, returns the seconds to wait before using them.
+        """
+        if not self.bandwidth:
+            return 0.0
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_start)
+        self.next_start = start + size / self.bandwidth
+        return start - now
+
+
+def prefetch_video(request: sanic.Request, vnf: dict):
+    """
+    Queue the video of `vnf` to be stored, when it has reached PREFETCH_HITS hits.
+    The variant is the one downloads of this client would get, links cached before
+    variants were kept and youtube-dl links, which have no type, store their `url`.
+    """
+    prefetcher = request.app.config.get("PREFETCHER")
+    if prefetcher is None or vnf.get("type") not in ("Video", ""):
+        return
+    if vnf.get("hits", 0) < request.app.config.get("PREFETCH_HITS", 0):
+        return
+    variant = select_variant(
+        vnf.get("variants") or [], variant_policy(request, "download")
+    )
+    if variant is None and vnf.get("url"):
+        variant = {"url": vnf["url"]}
+    if variant is not None:
+        prefetcher.enqueue(variant)
+
+
+def initialize_prefetch(app: sanic.Sanic):
+    """
+    With PREFETCH on, every worker stores videos of tweets as they are cached, or
+    once they reached PREFETCH_HITS hits, ahead of their downloads.
+    """
+    if not app.config.get("PREFETCH", False):
+        return
+
+    @app.after_server_start
+    async def start_prefetcher(app: sanic.Sanic, loop):
+        prefetcher = Prefetcher(
+            app,
+            concurrency=app.config.get("PREFETCH_CONCURRENCY", 2),
+            bandwidth=app.config.get("PREFETCH_BANDWIDTH", 8) * 2**20,
+            queue_size=app.config.get("PREFETCH_QUEUE", 256),
+        )
+        app.config.update({"PREFETCHER": prefetcher})
+        prefetcher.start()
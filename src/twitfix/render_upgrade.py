@@ -0,0 +1,65 @@
+import asyncio
+import multiprocessing
+
+import sanic
+
+from .structured_logging import log_event
+from .twitfix_app import RENDER_VERSION, legacy_vnf, render_fields
+
+
+async def upgrade_links(app: sanic.Sanic, page: int = 100, pause: float = 0.1):
+    """
+    Walk the whole link cache, oldest last, and store render fields on the links that
+    lack them or have outdated ones.
+    """
+    upgraded = scanned = 0
+    cursor = None
+    while True:
+        vnfs = await app.config.LINKS_MODULE.get_links_from_cache(
+            "_id", page, cursor=cursor
+        )
+        for vnf in vnfs:
+            if vnf.get("render", {}).get("version") == RENDER_VERSION:
+                continue
+            render = render_fields(legacy_vnf(vnf))
+            await app.config.LINKS_MODULE.update_link(vnf["tweet"], {"render": render})
+            upgraded += 1
+        scanned += len(vnfs)
+        cursor = vnfs.cursor
+        if cursor is None:
+            break
+        # Leave room for the requests this worker is serving.
+        await asyncio.sleep(pause)
+    log_event(
+        "upgrade",
+        " ➤ [ ✔ ] Render fields upgraded",
+        upgraded=upgraded,
+        scanned=scanned,
+    )
+
+
+def initialize_render_upgrade(app: sanic.Sanic):
+    """
+    With RENDER_UPGRADE on, one worker upgrades every cached link after starting.
+    Links are upgraded when embedded regardless, this catches the rest.
+    """
+    if not app.config.get("RENDER_UPGRADE", False):
+        return
+
+    @app.main_process_start
+    def create_upgrade_lock(app: sanic.Sanic, loop):
+        app.config.update({"RENDER_UPGRADE_LOCK": multiprocessing.Lock()})
+
+    @app.after_server_start
+    async def start_upgrade(app: sanic.Sanic, loop):
+        lock = app.config.get("RENDER_UPGRADE_LOCK")
+        # The lock is never released, so only the first worker to start runs it.
+        if lock is None or lock.acquire(block=False):
+            app.add_task(run_upgrade(app))
+
+
+async def run_upgrade(app: sanic.Sanic):
+    try:
+        await upgrade_links(app)
+    except Exception as e:
+        log_event("upgrade", " ➤ [ X ] Render field upgrade failed", error=repr(e))
@@ -1,25 +1,45 @@
+import asyncio
 from pathlib import Path
 
 import sanic
 import sanic.response
-import twitter
 from sanic.log import logger
 from sanic_ext.extensions.http.extension import HTTPExtension
-from sanic_ext.extensions.openapi.extension import OpenAPIExtension
 
+from .admission import initialize_admission
+from .breakers import initialize_breakers
 from .config import load_json_config
+from .deadlines import initialize_deadlines
+from .faults import initialize_faults
+from .instrumentation import initialize_instrumentation
 from .link_cache import initialize_link_cache
+from .media_jobs import initialize_media_jobs
+from .metrics import initialize_metrics
+from .prefetch import initialize_prefetch
+from .render_upgrade import initialize_render_upgrade
 from .sanic_jinja import configure_jinja
+from .serialization import dumpb, use_codec
+from .shared_cache import initialize_shared_cache
+from .startup import initialize_startup_report, lazy_import, mark_phase, startup_phase
 from .stats_module import initialize_stats
-from .storage_module import initialize_storage
+from .storage_module import StorageBase, initialize_storage
+from .storage_tiers import initialize_hot_tier
+from .tracing import initialize_tracing
 from .twitfix_app import twitfix_app
 from .twitfix_debug import debug
+from .twitfix_metrics import metrics
 from .twitfix_stats import stats
 from .twitfix_toys import toy
+from .variants import initialize_variants
+from .youtube_dl_pool import initialize_youtube_dl
+
+twitter = lazy_import("twitter")
 
 
 @stats.middleware
 async def lock_stats(request):
+    if request.app.config.get("STATS_PAGES", False):
+        return
     logger.info(" ➤ [ X ] Stats have been disabled.")
     return sanic.response.empty(status=401)
 
@@ -28,43 +48,90 @@ app = sanic.Sanic(
     "twitfix",
     env_prefix="TWITFIX_",
     configure_logging=False,
+    dumps=dumpb,
 )
 app.blueprint(twitfix_app)
 app.blueprint(stats)
 app.blueprint(debug)
 app.blueprint(toy)
+app.blueprint(metrics)
+
+extensions = [HTTPExtension]
+if app.config.get("OPENAPI", True):
+    from sanic_ext.extensions.openapi.extension import OpenAPIExtension
+
+    extensions.append(OpenAPIExtension)
+app.extend(built_in_extensions=False, extensions=extensions)
 
-app.extend(built_in_extensions=False, extensions=[HTTPExtension, OpenAPIExtension])
 
-# If method is set to API or Hybrid, attempt to auth with the Twitter API
-if app.config.DOWNLOAD_METHOD in ("api", "hybrid"):
-    auth = twitter.oauth.OAuth(
-        app.config.TWITTER_ACCESS_TOKEN,
-        app.config.TWITTER_ACCESS_SECRET,
-        app.config.TWITTER_API_KEY,
-        app.config.TWITTER_API_SECRET,
-    )
-    twitter_api = twitter.Twitter(auth=auth)
-    app.config.update({"TWITTER": twitter_api})
+def initialize_twitter(config):
+    # If method is set to API or Hybrid, attempt to auth with the Twitter API
+    if config.DOWNLOAD_METHOD in ("api", "hybrid"):
+        auth = twitter.oauth.OAuth(
+            config.TWITTER_ACCESS_TOKEN,
+            config.TWITTER_ACCESS_SECRET,
+            config.TWITTER_API_KEY,
+            config.TWITTER_API_SECRET,
+        )
+        twitter_api = twitter.Twitter(
+            auth=auth,
+            domain=config.get("TWITTER_API_DOMAIN", "api.twitter.com"),
+            secure=config.get("TWITTER_API_SECURE", True),
+        )
+        config.update({"TWITTER": twitter_api})
 
-link_cache_system = app.config.LINK_CACHE
-storage_module_type = app.config.STORAGE_MODULE
-STAT_MODULE = initialize_stats(link_cache_system, app.config)
-LINKS_MODULE = initialize_link_cache(link_cache_system, app.config)
-STORAGE_MODULE = initialize_storage(storage_module_type, app.config)
 
-base_url = app.config.BASE_URL
+@app.before_server_start
+async def initialize_backends(app: sanic.Sanic, loop):
+    """
+    Backends are set up by every worker once it starts rather than on import, the
+    constructors may connect to remote services and should not run before the fork.
+    They run side by side on the default executor as some of them block.
+    """
+    if isinstance(app.config.STORAGE_MODULE, StorageBase):
+        # Already set up, the server is being started again in the same process.
+        return
+    with startup_phase("backends"):
+        link_cache_system = app.config.LINK_CACHE
+        storage_module_type = app.config.STORAGE_MODULE
+        STAT_MODULE, LINKS_MODULE, STORAGE_MODULE, _ = await asyncio.gather(
+            loop.run_in_executor(None, initialize_stats, link_cache_system, app.config),
+            loop.run_in_executor(
+                None, initialize_link_cache, link_cache_system, app.config
+            ),
+            loop.run_in_executor(
+                None, initialize_storage, storage_module_type, app.config
+            ),
+            loop.run_in_executor(None, initialize_twitter, app.config),
+        )
+        app.config.update(
+            {
+                "STAT_MODULE": STAT_MODULE,
+                "LINKS_MODULE": LINKS_MODULE,
+                "STORAGE_MODULE": STORAGE_MODULE,
+            }
+        )
+
 
 static_folder = Path("static").resolve()
 template_folder = Path("templates").resolve()
 configure_jinja(app, template_folder)
+initialize_metrics(app)
+initialize_instrumentation(app)
+initialize_tracing(app)
+initialize_startup_report(app)
+initialize_youtube_dl(app)
+initialize_faults(app)
+initialize_media_jobs(app)
+initialize_breakers(app)
+initialize_shared_cache(app)
+initialize_hot_tier(app)
+initialize_admission(app)
+initialize_deadlines(app)
+initialize_variants(app)
+initialize_prefetch(app)
+initialize_render_upgrade(app)
 load_json_config(app)
+use_codec(app.config.get("JSON_SERIALIZER", "auto"))
 app.static("/static", static_folder)
-app.config.update(
-    {
-        "STAT_MODULE": STAT_MODULE,
-        "LINKS_MODULE": LINKS_MODULE,
-        "STORAGE_MODULE": STORAGE_MODULE,
-        "BASE_URL": base_url,
-    }
-)
+mark_phase("app_created")
@@ -1,9 +1,13 @@
+import time
 from functools import wraps
 from pathlib import Path
 
 import sanic
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
+from .instrumentation import stage
+from .metrics import RENDER_SECONDS
+
 
 def configure_jinja(app: sanic.Sanic, templates_path: Path):
     app.config.update(
@@ -36,7 +40,9 @@ def using_template(template_name: str):
 
 
 async def render_template(request, template_name, **kwargs):
-    template = request.app.config.JINJA.get_template(template_name)
-    return sanic.html(
-        await template.render_async(kwargs), headers={"cache-control": "no-cache"}
-    )
+    with stage(request, "render"):
+        started = time.perf_counter()
+        template = request.app.config.JINJA.get_template(template_name)
+        body = await template.render_async(kwargs)
+        RENDER_SECONDS.labels(template_name).observe(time.perf_counter() - started)
+    return sanic.html(body, headers={"cache-control": "no-cache"})
@@ -0,0 +1,86 @@
+import json
+from contextlib import suppress
+from typing import Any, Union
+
+with suppress(ImportError):
+    import orjson
+
+
+class JSONCodec:
+    """
+    JSON through the standard library. Values JSON has no type for, like dates and
+    Mongo ObjectIds, are written as their str().
+    """
+
+    name = "json"
+
+    def dumps(self, value: Any, pretty: bool = False) -> str:
+        if pretty:
+            return json.dumps(value, indent=2, sort_keys=True, default=str)
+        return json.dumps(value, separators=(",", ":"), default=str)
+
+    def dumpb(self, value: Any, pretty: bool = False) -> bytes:
+        return self.dumps(value, pretty).encode()
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    JSON through orjson, several times faster at both ends. Dates are written in ISO
+    format instead of str().
+    """
+
+    name = "orjson"
+
+    def dumpb(self, value: Any, pretty: bool = False) -> bytes:
+        options = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            options |= orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        return orjson.dumps(value, default=str, option=options)
+
+    def dumps(self, value: Any, pretty: bool = False) -> str:
+        return self.dumpb(value, pretty).decode()
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+
+def initialize_codec(name: str) -> JSONCodec:
+    if name == "auto":
+        name = "orjson" if globals().get("orjson") else "json"
+
+    if name == "orjson":
+        if not globals().get("orjson"):
+            raise LookupError("the orjson library was not included during build.")
+        return OrjsonCodec()
+
+    if name == "json":
+        return JSONCodec()
+
+    raise LookupError("JSON serializer not recognized.")
+
+
+codec = initialize_codec("auto")
+
+
+def use_codec(name: str):
+    """
+    Switch every caller of this module over to another codec.
+    """
+    global codec
+    codec = initialize_codec(name)
+
+
+def dumps(value: Any, pretty: bool = False) -> str:
+    return codec.dumps(value, pretty)
+
+
+def dumpb(value: Any, pretty: bool = False, **_: Any) -> bytes:
+    # Sanic passes its json() keyword arguments along, they have no use here.
+    return codec.dumpb(value, pretty)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    return codec.loads(data)
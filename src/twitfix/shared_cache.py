@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import mmap
+import multiprocessing
+import struct
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import sanic
+from sanic.log import logger
+
+from . import serialization
+from .link_cache import LinkCacheBase
+from .metrics import SHARED_CACHE_OPERATIONS
+
+# key hash, last access (monotonic), payload length
+SLOT_HEADER = struct.Struct("<QdI")
+
+
+class SharedTable:
+    """
+    Fixed size hash table of serialized VNFs in an anonymous shared mapping.
+
+    Created in the main process before the workers are forked, so every worker on the
+    node sees the same memory. Keys hash to a set of `ways` consecutive slots and a
+    full set evicts its least recently used slot. Sets are guarded by a fixed number
+    of process shared locks, striped over the sets.
+    """
+
+    def __init__(
+        self, size: int, slot_size: int = 2048, ways: int = 8, stripes: int = 64
+    ) -> None:
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = max(1, size // (slot_size * ways))
+        self.memory = mmap.mmap(-1, self.sets * ways * slot_size)
+        self.locks = [multiprocessing.Lock() for _ in range(stripes)]
+
+    @staticmethod
+    def key(video_link: str) -> int:
+        # 0 marks an empty slot.
+        digest = hashlib.blake2b(video_link.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def _locate(self, key: int):
+        index = key % self.sets
+        return index * self.ways * self.slot_size, self.locks[index % len(self.locks)]
+
+    def get(self, video_link: str) -> Optional[bytes]:
+        key = self.key(video_link)
+        base, lock = self._locate(key)
+        with lock:
+            for way in range(self.ways):
+                offset = base + way * self.slot_size
+                slot_key, _, length = SLOT_HEADER.unpack_from(self.memory, offset)
+                if slot_key == key:
+                    SLOT_HEADER.pack_into(
+                        self.memory, offset, key, time.monotonic(), length
+                    )
+                    start = offset + SLOT_HEADER.size
+                    return self.memory[start : start + length]
+        return None
+
+    def put(self, video_link: str, payload: bytes) -> str:
+        if len(payload) > self.slot_size - SLOT_HEADER.size:
+            return "too_large"
+        key = self.key(video_link)
+        base, lock = self._locate(key)
+        with lock:
+            target, oldest, result = None, None, "stored"
+            for way in range(self.ways):
+                offset = base + way * self.slot_size
+                slot_key, accessed, _ = SLOT_HEADER.unpack_from(self.memory, offset)
+                if slot_key == key or slot_key == 0:
+                    target, result = offset, "stored"
+                    break
+                if oldest is None or accessed < oldest:
+                    target, oldest, result = offset, accessed, "evicted"
+            start = target + SLOT_HEADER.size
+            self.memory[start : start + len(payload)] = payload
+            SLOT_HEADER.pack_into(
+                self.memory, target, key, time.monotonic(), len(payload)
+            )
+        return result
+
+
+class SharedMemoryCache(LinkCacheBase):
+    """
+    Serves lookups from the node wide shared table and falls through to the
+    configured link cache, which stays the source of truth.
+
+    Hits served from memory are counted locally and handed to the backing cache in
+    batches by `flush_hits`, so a hit costs no round trip.
+    """
+
+    def __init__(self, table: SharedTable, backend: LinkCacheBase) -> None:
+        self.table = table
+        self.backend = backend
+        self.pending_hits = Counter()
+
+    def _store(self, video_link: str, vnf):
+        payload = serialization.dumpb(vnf)
+        SHARED_CACHE_OPERATIONS.labels("put", self.table.put(video_link, payload)).inc()
+
+    async def add_link_to_cache(self, video_link: str, vnf) -> bool:
+        res = await self.backend.add_link_to_cache(video_link, vnf)
+        self._store(video_link, vnf)
+        return res
+
+    async def get_link_from_cache(self, video_link: str) -> Optional[Any]:
+        payload = self.table.get(video_link)
+        if payload is not None:
+            SHARED_CACHE_OPERATIONS.labels("get", "hit").inc()
+            self.pending_hits[video_link] += 1
+            return serialization.loads(payload)
+        SHARED_CACHE_OPERATIONS.labels("get", "miss").inc()
+        vnf = await self.backend.get_link_from_cache(video_link)
+        if vnf is not None:
+            self._store(video_link, vnf)
+        return vnf
+
+    async def get_links_from_cache(
+        self, field, count, offset=0, projection=None, cursor=None
+    ) -> List[Any]:
+        return await self.backend.get_links_from_cache(
+            field, count, offset, projection, cursor
+        )
+
+    async def get_links_batch(self, video_links: List[str]) -> Dict[str, Any]:
+        vnfs, misses = {}, []
+        for video_link in video_links:
+            payload = self.table.get(video_link)
+            if payload is None:
+                misses.append(video_link)
+            else:
+                vnfs[video_link] = serialization.loads(payload)
+        SHARED_CACHE_OPERATIONS.labels("get", "hit").inc(len(vnfs))
+        SHARED_CACHE_OPERATIONS.labels("get", "miss").inc(len(misses))
+        if misses:
+            found = await self.backend.get_links_batch(misses)
+            for video_link, vnf in found.items():
+                self._store(video_link, vnf)
+            vnfs.update(found)
+        return vnfs
+
+    async def increment_hits(self, video_link: str, hits: int = 1):
+        await self.backend.increment_hits(video_link, hits)
+
+    async def update_link(self, video_link: str, fields: dict):
+        await self.backend.update_link(video_link, fields)
+        payload = self.table.get(video_link)
+        if payload is not None:
+            self._store(video_link, {**serialization.loads(payload), **fields})
+
+    async def flush_hits(self):
+        pending, self.pending_hits = self.pending_hits, Counter()
+        for video_link, hits in pending.items():
+            try:
+                await self.backend.increment_hits(video_link, hits)
+            except Exception as e:
+                logger.error(f" ➤ [ X ] Failed to record hits for {video_link}: {e}")
+
+
+def initialize_shared_cache(app: sanic.Sanic):
+    """
+    Set up the shared table when SHARED_CACHE_SIZE (in megabytes) is given, the
+    workers put it in front of their link cache once started.
+    """
+    size = app.config.get("SHARED_CACHE_SIZE", 0) * 2**20
+    if not size:
+        return
+
+    def create_table():
+        app.config.update(
+            {
+                "SHARED_CACHE": SharedTable(
+                    size,
+                    slot_size=app.config.get("SHARED_CACHE_SLOT_SIZE", 2048),
+                    ways=app.config.get("SHARED_CACHE_WAYS", 8),
+                )
+            }
+        )
+
+    @app.main_process_start
+    def create_shared_table(app: sanic.Sanic, loop):
+        create_table()
+
+    @app.before_server_start
+    def wrap_link_cache(app: sanic.Sanic, loop):
+        if not isinstance(app.config.LINKS_MODULE, SharedMemoryCache):
+            if "SHARED_CACHE" not in app.config:
+                # Not started through app.run, there is only this process to share with.
+                create_table()
+            app.config.update(
+                {
+                    "LINKS_MODULE": SharedMemoryCache(
+                        app.config.SHARED_CACHE, app.config.LINKS_MODULE
+                    )
+                }
+            )
+
+    @app.after_server_start
+    async def start_hit_flushing(app: sanic.Sanic, loop):
+        app.add_task(hit_flush_loop(app))
+
+    @app.before_server_stop
+    async def final_hit_flush(app: sanic.Sanic, loop):
+        await app.config.LINKS_MODULE.flush_hits()
+
+
+async def hit_flush_loop(app: sanic.Sanic):
+    interval = app.config.get("SHARED_CACHE_HIT_FLUSH_INTERVAL", 10)
+    while True:
+        await asyncio.sleep(interval)
+        await app.config.LINKS_MODULE.flush_hits()
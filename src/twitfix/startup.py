@@ -0,0 +1,104 @@
+import importlib.util
+import os
+import sys
+import time
+from contextlib import contextmanager
+from types import ModuleType
+from typing import Dict
+
+import sanic
+
+from .metrics import STARTUP_SECONDS
+from .structured_logging import log_event
+
+
+def process_started() -> float:
+    """
+    The perf_counter() reading at which this process was started, so interpreter
+    startup and imports count towards the startup phases too. Falls back to now
+    where /proc is not available.
+    """
+    now = time.perf_counter()
+    try:
+        with open("/proc/self/stat") as stat:
+            # The command name may contain spaces, fields are counted after it.
+            start_ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime:
+            up = float(uptime.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return now
+    return now - max(0.0, up - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+# Workers are forked from the main process and share its start.
+STARTED = process_started()
+
+# Seconds since STARTED at which each phase of startup finished, and how long it took.
+phases: Dict[str, float] = {}
+durations: Dict[str, float] = {}
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Import a module on first attribute access instead of right away.
+
+    Raises ImportError like a plain import when the module is not installed, so it
+    fits the usual `with suppress(ImportError)` guard around optional dependencies.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def mark_phase(name: str):
+    phases[name] = time.perf_counter() - STARTED
+    STARTUP_SECONDS.labels(name).set(phases[name])
+
+
+@contextmanager
+def startup_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        durations[name] = time.perf_counter() - started
+        mark_phase(name)
+
+
+def initialize_startup_report(app: sanic.Sanic):
+    """
+    Log how long each worker took to become ready and to serve its first response.
+    """
+    first_response = True
+
+    @app.after_server_start
+    async def report_ready(app: sanic.Sanic, loop):
+        if "ready" in phases:
+            return
+        mark_phase("ready")
+        log_event(
+            "startup",
+            " ➤ [ S ] Worker ready",
+            **{f"{name}_ms": round(at * 1000, 1) for name, at in phases.items()},
+            **{f"{name}_took_ms": round(d * 1000, 1) for name, d in durations.items()},
+        )
+
+    @app.on_response
+    async def report_first_response(request: sanic.Request, response):
+        nonlocal first_response
+        if first_response:
+            first_response = False
+            mark_phase("first_response")
+            log_event(
+                "startup",
+                " ➤ [ S ] First response",
+                first_response_ms=round(phases["first_response"] * 1000, 1),
+            )
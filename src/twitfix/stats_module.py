@@ -1,14 +1,19 @@
 from contextlib import suppress
 from datetime import date
-from typing import Any
+from typing import Any, List
 
 from sanic.log import logger
 
+from .startup import lazy_import
+
+with suppress(ImportError):
+    pymongo = lazy_import("pymongo")
+
 with suppress(ImportError):
-    import pymongo
+    firestore = lazy_import("google.cloud.firestore")
 
 with suppress(ImportError):
-    import google.cloud.firestore
+    aioredis = lazy_import("redis.asyncio")
 
 
 class StatsBase:
@@ -21,6 +26,28 @@ class StatsBase:
     async def get_stats(self, day: str) -> Any:
         pass
 
+    async def add_rollup(self, hour: str, rollup: dict) -> None:
+        """
+        Merge an hourly rollup of counters and latency histograms into storage.
+        Every worker flushes its own rollups, so implementations must add to what
+        is already stored for that hour.
+        """
+        pass
+
+    async def get_rollups(self, start: str, end: str) -> List[dict]:
+        """
+        Fetch the stored hourly rollups between the two hours, both inclusive.
+        """
+        pass
+
+
+def _flatten(rollup: dict, prefix: str = ""):
+    for key, value in rollup.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
 
 class MongoStats(StatsBase):
     def __init__(self, config) -> None:
@@ -44,22 +71,37 @@ class MongoStats(StatsBase):
         collection = self.db.stats.find_one({"date": day})
         return collection
 
+    async def add_rollup(self, hour: str, rollup: dict):
+        self.db.stats_hourly.update_one(
+            {"hour": hour}, {"$inc": dict(_flatten(rollup))}, upsert=True
+        )
+
+    async def get_rollups(self, start: str, end: str):
+        return list(
+            self.db.stats_hourly.find(
+                {"hour": {"$gte": start, "$lte": end}},
+                projection={"_id": False},
+                sort=[("hour", pymongo.ASCENDING)],
+            )
+        )
+
 
 class FirestoreStats(StatsBase):
     def __init__(self, config) -> None:
-        self.fire = google.cloud.firestore.AsyncClient()
+        self.fire = firestore.AsyncClient()
         self.stats = self.fire.collection("statistics")
+        self.hourly = self.fire.collection("statistics_hourly")
 
     async def add_to_stat(self, metric: str):
         today = str(date.today())
         update = {
             "date": today,
-            "embeds": google.cloud.firestore.Increment(0),
-            "linksCached": google.cloud.firestore.Increment(0),
-            "api": google.cloud.firestore.Increment(0),
-            "downloads": google.cloud.firestore.Increment(0),
+            "embeds": firestore.Increment(0),
+            "linksCached": firestore.Increment(0),
+            "api": firestore.Increment(0),
+            "downloads": firestore.Increment(0),
         }
-        update[metric] = google.cloud.firestore.Increment(1)
+        update[metric] = firestore.Increment(1)
         await self.stats.document(today).set(update, merge=True)
 
     async def get_stats(self, day: str):
@@ -73,6 +115,99 @@ class FirestoreStats(StatsBase):
             **doc.to_dict(),
         }
 
+    async def add_rollup(self, hour: str, rollup: dict):
+        def increments(values: dict):
+            return {
+                key: increments(value)
+                if isinstance(value, dict)
+                else firestore.Increment(value)
+                for key, value in values.items()
+            }
+
+        await self.hourly.document(hour).set(
+            {"hour": hour, **increments(rollup)}, merge=True
+        )
+
+    async def get_rollups(self, start: str, end: str):
+        docs = (
+            await self.hourly.where("hour", ">=", start)
+            .where("hour", "<=", end)
+            .order_by("hour")
+            .get()
+        )
+        return [doc.to_dict() for doc in docs]
+
+
+def _unflatten(fields: dict) -> dict:
+    out = {}
+    for key, value in fields.items():
+        *parents, name = key.split(".")
+        node = out
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = int(value) if value.lstrip("-").isdigit() else float(value)
+    return out
+
+
+class RedisStats(StatsBase):
+    """
+    Daily counters and hourly rollups are hashes incremented in place, the hours
+    that have a rollup are listed in a sorted set for range queries. Both expire
+    after STATS_TTL seconds when that is set.
+    """
+
+    def __init__(self, config) -> None:
+        self.redis = aioredis.from_url(config.REDIS_URL, decode_responses=True)
+        self.prefix = config.get("REDIS_PREFIX", "twitfix")
+        self.ttl = config.get("STATS_TTL", 0) or None
+
+    async def add_to_stat(self, metric: str):
+        key = f"{self.prefix}:stats:{date.today()}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hincrby(key, metric, 1)
+            if self.ttl:
+                pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def get_stats(self, day: str):
+        stored = await self.redis.hgetall(f"{self.prefix}:stats:{day}")
+        return {
+            "date": day,
+            "embeds": 0,
+            "linksCached": 0,
+            "api": 0,
+            "downloads": 0,
+            **{metric: int(value) for metric, value in stored.items()},
+        }
+
+    async def add_rollup(self, hour: str, rollup: dict):
+        key = f"{self.prefix}:stats_hourly:{hour}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for field, value in _flatten(rollup):
+                if isinstance(value, int):
+                    pipe.hincrby(key, field, value)
+                else:
+                    pipe.hincrbyfloat(key, field, value)
+            # Equal scores sort by member, so hours can be selected by range.
+            pipe.zadd(f"{self.prefix}:stats_hours", {hour: 0})
+            if self.ttl:
+                pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def get_rollups(self, start: str, end: str):
+        hours = await self.redis.zrangebylex(
+            f"{self.prefix}:stats_hours", f"[{start}", f"[{end}"
+        )
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for hour in hours:
+                pipe.hgetall(f"{self.prefix}:stats_hourly:{hour}")
+            stored = await pipe.execute()
+        return [
+            {"hour": hour, **_unflatten(fields)}
+            for hour, fields in zip(hours, stored)
+            if fields
+        ]
+
 
 class NoStats(StatsBase):
     def __init__(self, config) -> None:
@@ -84,6 +219,12 @@ class NoStats(StatsBase):
     async def get_stats(self, day: str):
         return {"date": day, "embeds": 0, "linksCached": 0, "api": 0, "downloads": 0}
 
+    async def add_rollup(self, hour: str, rollup: dict):
+        pass
+
+    async def get_rollups(self, start: str, end: str):
+        return []
+
 
 def initialize_stats(stat_module: str, config) -> StatsBase:
     if stat_module == "db":
@@ -92,11 +233,17 @@ def initialize_stats(stat_module: str, config) -> StatsBase:
         return MongoStats(config)
 
     if stat_module == "firestore":
-        if not globals().get("google"):
+        if not globals().get("firestore"):
             raise LookupError("the firestore library was not included during build.")
         logger.info(" ➤ [ ✔ ] Stats module backed by Firestore")
         return FirestoreStats(config)
 
+    if stat_module == "redis":
+        if not globals().get("aioredis"):
+            raise LookupError("the redis library was not included during build.")
+        logger.info(" ➤ [ ✔ ] Stats module backed by Redis")
+        return RedisStats(config)
+
     if stat_module in ["none", "json"]:
         logger.info(" ➤ [ X ] Stats module disabled")
         return NoStats(config)
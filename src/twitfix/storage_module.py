@@ -1,18 +1,24 @@
+import asyncio
+import hashlib
 import os
 import pathlib
-import shutil
+import tempfile
+import urllib.parse
 import urllib.request
 from contextlib import suppress
 from datetime import timedelta
-from typing import Tuple
-from uuid import UUID, uuid5
+from typing import BinaryIO, Tuple
 
-from sanic.log import logger
+from .metrics import DOWNLOAD_BYTES, STORAGE_DEDUPED
+from .startup import lazy_import
+from .structured_logging import log_event
 
 with suppress(ImportError):
-    import google.auth.compute_engine
-    import google.auth.transport.requests
-    import google.cloud.storage
+    google_auth = lazy_import("google.auth")
+    api_exceptions = lazy_import("google.api_core.exceptions")
+    compute_engine = lazy_import("google.auth.compute_engine")
+    auth_requests = lazy_import("google.auth.transport.requests")
+    cloud_storage = lazy_import("google.cloud.storage")
 
 
 class StorageBase:
@@ -22,7 +28,8 @@ class StorageBase:
 
     async def store_media(self, url: str) -> Tuple[bool, str]:
         """
-        Download the given url for rehosting by our own system.
+        Download the given url for rehosting by our own system. The same video is
+        stored once, whichever url it was downloaded from.
         """
         pass
 
@@ -33,36 +40,113 @@ class StorageBase:
         pass
 
 
+def media_key(url: str) -> str:
+    """
+    The name a media URL is indexed by. Twitter serves a file from any of its media
+    hosts and ignores the query, so only the path tells videos apart.
+    """
+    path = urllib.parse.urlsplit(url).path
+    return hashlib.blake2b(path.encode(), digest_size=16).hexdigest()
+
+
+def download(url: str, output: BinaryIO) -> Tuple[str, str]:
+    """
+    Copy `url` into `output`, hashing it on the way. Returns the SHA-256 of the
+    content and its content type.
+    """
+    digest = hashlib.sha256()
+    media = urllib.request.urlopen(url)
+    with media:
+        while chunk := media.read(2**18):
+            digest.update(chunk)
+            output.write(chunk)
+            DOWNLOAD_BYTES.inc(len(chunk))
+    return digest.hexdigest(), media.headers.get("content-type") or "video/mp4"
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def partial_file(directory: pathlib.Path):
+    """
+    A file to download into before moving it in place, named after this process so
+    it can be told apart from the leftovers of dead ones.
+    """
+    return tempfile.NamedTemporaryFile(
+        dir=directory, prefix=f"{os.getpid()}-", suffix=".mp4", delete=False
+    )
+
+
+def remove_partials(directory: pathlib.Path):
+    """
+    Remove the partial downloads of processes that died while writing them.
+    """
+    for entry in os.scandir(directory):
+        pid = entry.name.split("-", 1)[0]
+        if pid.isdigit() and not process_alive(int(pid)):
+            with suppress(FileNotFoundError):
+                os.unlink(entry.path)
+                log_event(
+                    "storage", " ➤ [ - ] Removed partial download", file=entry.name
+                )
+
+
 class LocalFilesystem(StorageBase):
+    """
+    Each video is stored once under its content hash in media/, and every URL it was
+    downloaded from is a hardlink to it in urls/.
+    """
+
     def __init__(self, config) -> None:
         super().__init__(config)
         self.base_url = config.BASE_URL
-        self.basepath = pathlib.Path(config.STORAGE_LOCAL_BASE)
+        self.basepath = pathlib.Path(config.STORAGE_LOCAL_BASE).resolve()
+        for directory in ("media", "urls", "partial"):
+            (self.basepath / directory).mkdir(parents=True, exist_ok=True)
+        remove_partials(self.basepath / "partial")
 
     async def store_media(self, url: str):
-        filename = url.rsplit("/", 1)[-1].split(".mp4")[0] + ".mp4"
-
-        PATH = (self.basepath / filename).resolve()
-        if not PATH.is_relative_to(self.basepath):
-            raise OSError("Invalid media identifier.")
-        if PATH.exists() and PATH.is_file() and os.access(PATH, os.R_OK):
-            logger.info(" ➤ [[ FILE EXISTS ]]")
+        filename = f"urls/{media_key(url)}.mp4"
+        PATH = self.basepath / filename
+        if PATH.is_file() and os.access(PATH, os.R_OK):
+            log_event("storage", " ➤ [[ FILE EXISTS ]]", file=filename)
             return True, filename
 
-        logger.info(" ➤ [[ FILE DOES NOT EXIST, DOWNLOADING... ]]")
-        mp4file = urllib.request.urlopen(url)
-        with PATH.open("wb") as output:
-            shutil.copyfileobj(mp4file, output)
+        log_event("storage", " ➤ [[ FILE DOES NOT EXIST, DOWNLOADING... ]]", url=url)
+        # Downloads block, off the loop they do not stall the other requests.
+        await asyncio.get_running_loop().run_in_executor(None, self.fetch, url, PATH)
         return False, filename
 
+    def fetch(self, url: str, PATH: pathlib.Path):
+        with partial_file(self.basepath / "partial") as output:
+            try:
+                content_hash, _ = download(url, output)
+            except BaseException:
+                os.unlink(output.name)
+                raise
+        blob = self.basepath / "media" / f"{content_hash}.mp4"
+        if blob.exists():
+            STORAGE_DEDUPED.inc()
+            log_event("storage", " ➤ [[ CONTENT ALREADY STORED ]]", file=blob.name)
+            os.unlink(output.name)
+        else:
+            os.replace(output.name, blob)
+        with suppress(FileExistsError):
+            os.link(blob, PATH)
+
     async def retrieve_media(self, own_identifier: str):
         PATH = (self.basepath / own_identifier).resolve()
         if not PATH.is_relative_to(self.basepath):
             raise OSError("Invalid media identifier.")
         if PATH.exists() and PATH.is_file() and os.access(PATH, os.R_OK):
-            logger.info(
-                f" ➤ [[ PRESENTING FILE: {own_identifier!r}, URL: {self.base_url}/media/{own_identifier} ]]"
-            )
+            log_event("storage", " ➤ [[ PRESENTING FILE ]]", file=own_identifier)
             return {
                 "output": "file",
                 "content": PATH,
@@ -71,34 +155,43 @@ class LocalFilesystem(StorageBase):
 
 
 class GoogleCloudStorage(StorageBase):
-    STORAGE_NAMESPACE = UUID("dbc14e27-a6ed-4343-98ef-285aa17cacfd")
+    """
+    Each video is stored once as media/<content hash>, urls/<key> objects hold the
+    content hash of what was downloaded from a URL.
+    """
 
     def __init__(self, config) -> None:
         bucket = config.STORAGE_BUCKET
-        self.client = google.cloud.storage.Client()
+        self.client = cloud_storage.Client()
         self.bucket = self.client.get_bucket(bucket)
-        credentials, project = google.auth.default()
-        request = google.auth.transport.requests.Request()
+        credentials, project = google_auth.default()
+        request = auth_requests.Request()
         credentials.refresh(request)
-        self.signing_credentials = google.auth.compute_engine.IDTokenCredentials(
+        self.signing_credentials = compute_engine.IDTokenCredentials(
             request,
             "",
             service_account_email=credentials.service_account_email,
         )
 
     async def store_media(self, url: str) -> Tuple[bool, str]:
-        name = str(uuid5(self.STORAGE_NAMESPACE, url))
-        blob = self.bucket.blob(name, chunk_size=2**18)
-        if blob.exists():
-            return True, name
-        else:
-            mp4file = urllib.request.urlopen(url)
-            mime = mp4file.getheader("content-type")
-            url = blob.create_resumable_upload_session(mime)
-            req = urllib.request.Request(
-                url, mp4file, method="PUT", headers={"content-type": mime}
-            )
-            urllib.request.urlopen(req, req.data)
+        # The client blocks, off the loop it does not stall the other requests.
+        return await asyncio.get_running_loop().run_in_executor(None, self.store, url)
+
+    def store(self, url: str) -> Tuple[bool, str]:
+        index = self.bucket.blob(f"urls/{media_key(url)}")
+        with suppress(api_exceptions.NotFound):
+            return True, index.download_as_text()
+        # The name depends on the content, so it is spooled before uploading.
+        with tempfile.SpooledTemporaryFile(max_size=2**24) as output:
+            content_hash, mime = download(url, output)
+            name = f"media/{content_hash}"
+            blob = self.bucket.blob(name, chunk_size=2**18)
+            if blob.exists():
+                STORAGE_DEDUPED.inc()
+                log_event("storage", " ➤ [[ CONTENT ALREADY STORED ]]", file=name)
+            else:
+                blob.upload_from_file(output, content_type=mime, rewind=True)
+        index.upload_from_string(name, content_type="text/plain")
         return False, name
 
     async def retrieve_media(self, own_identifier: str):
@@ -124,6 +217,6 @@ def initialize_storage(storage_type: str, config) -> StorageBase:
         return GoogleCloudStorage(config)
 
     if storage_type == "none":
-        return NoStorage()
+        return NoStorage(config)
 
     raise LookupError(f"Unrecognized storage {storage_type}")
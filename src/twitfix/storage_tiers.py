@@ -0,0 +1,141 @@
+import asyncio
+import os
+import pathlib
+import shutil
+import tempfile
+from contextlib import suppress
+from typing import Dict
+
+import sanic
+
+from .metrics import STORAGE_TIER_LOOKUPS
+from .storage_module import (
+    StorageBase,
+    download,
+    media_key,
+    partial_file,
+    remove_partials,
+)
+from .structured_logging import log_event
+
+HOT_PREFIX = "hot:"
+
+
+class HotTier(StorageBase):
+    """
+    A bounded directory of recently downloaded videos on this instance's disk in
+    front of another storage, so popular videos are served from here instead of
+    another round trip to the backend.
+
+    Videos missing here are answered by the backend as usual while a copy is
+    fetched in the background. Backends answering with URLs are only copied from
+    once they had the video before, so what they just downloaded, or for NoStorage
+    what the client is about to, is not downloaded twice. Once the directory holds
+    more than `size` bytes the least recently used videos are removed, use is
+    tracked through the file times.
+    """
+
+    def __init__(self, backend: StorageBase, path: str, size: int) -> None:
+        self.backend = backend
+        self.config = backend.config
+        self.path = pathlib.Path(path).resolve()
+        self.size = size
+        self.populating: Dict[str, asyncio.Task] = {}
+        (self.path / "partial").mkdir(parents=True, exist_ok=True)
+        remove_partials(self.path / "partial")
+
+    async def store_media(self, url: str):
+        filename = f"{media_key(url)}.mp4"
+        with suppress(FileNotFoundError):
+            # Touching it marks it used, so it is the last to be evicted.
+            os.utime(self.path / filename)
+            STORAGE_TIER_LOOKUPS.labels("hot").inc()
+            return True, HOT_PREFIX + filename
+        STORAGE_TIER_LOOKUPS.labels("cold").inc()
+        cache_hit, identifier = await self.backend.store_media(url)
+        if filename not in self.populating:
+            task = asyncio.create_task(self.populate(filename, identifier, cache_hit))
+            self.populating[filename] = task
+            task.add_done_callback(lambda _: self.populating.pop(filename, None))
+        return cache_hit, identifier
+
+    async def retrieve_media(self, own_identifier: str):
+        if not own_identifier.startswith(HOT_PREFIX):
+            return await self.backend.retrieve_media(own_identifier)
+        PATH = (self.path / own_identifier[len(HOT_PREFIX) :]).resolve()
+        if PATH.parent != self.path:
+            raise OSError("Invalid media identifier.")
+        if PATH.is_file():
+            return {"output": "file", "content": PATH}
+        return None
+
+    async def populate(self, filename: str, identifier: str, cache_hit: bool):
+        try:
+            response = await self.backend.retrieve_media(identifier)
+            if response is None or (response["output"] == "url" and not cache_hit):
+                return
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.copy, response, filename)
+            await loop.run_in_executor(None, self.evict)
+        except Exception as e:
+            log_event(
+                "storage",
+                " ➤ [ X ] Failed to copy media to the hot tier",
+                file=filename,
+                error=repr(e),
+            )
+
+    def copy(self, response: dict, filename: str):
+        with partial_file(self.path / "partial") as output:
+            try:
+                if response["output"] == "url":
+                    download(response["url"], output)
+                else:
+                    with open(response["content"], "rb") as media:
+                        shutil.copyfileobj(media, output)
+            except BaseException:
+                os.unlink(output.name)
+                raise
+        os.replace(output.name, self.path / filename)
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        used = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if used <= self.size:
+                break
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+                log_event("storage", " ➤ [ - ] Evicted from the hot tier", file=path)
+            used -= size
+
+
+def initialize_hot_tier(app: sanic.Sanic):
+    """
+    With STORAGE_HOT_TIER_SIZE (in megabytes) set, every worker puts a hot tier kept
+    in STORAGE_HOT_TIER_PATH in front of its storage once started. The workers of an
+    instance share the directory.
+    """
+    size = app.config.get("STORAGE_HOT_TIER_SIZE", 0) * 2**20
+    if not size:
+        return
+
+    @app.before_server_start
+    def wrap_storage(app: sanic.Sanic, loop):
+        if not isinstance(app.config.STORAGE_MODULE, HotTier):
+            app.config.update(
+                {
+                    "STORAGE_MODULE": HotTier(
+                        app.config.STORAGE_MODULE,
+                        app.config.get(
+                            "STORAGE_HOT_TIER_PATH",
+                            os.path.join(tempfile.gettempdir(), "twitfix-hot"),
+                        ),
+                        size,
+                    )
+                }
+            )
@@ -0,0 +1,144 @@
+import logging
+import logging.handlers
+import queue
+import random
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable
+
+import sanic
+from sanic.log import logger
+
+# Fields added to every event logged while handling the current request.
+request_fields: ContextVar[dict] = ContextVar("request_fields", default={})
+
+# Share of INFO events kept per category, anything at WARNING and above is always kept.
+sampling_rates: Dict[str, float] = {}
+
+LOGGERS = (None, "sanic.root", "sanic.error")
+
+
+def log_event(category: str, message: str, *, level: int = logging.INFO, **fields):
+    """
+    Log a fixed message together with structured fields.
+
+    The message should be constant, variable parts go in the fields so they can be
+    queried as such once shipped. Routine events are dropped here according to the
+    sampling rate of their category, before any formatting is done.
+    """
+    if level < logging.WARNING:
+        rate = sampling_rates.get(category, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return
+    if not logger.isEnabledFor(level):
+        return
+    fields = {**request_fields.get(), **fields}
+    logger.log(
+        level,
+        message,
+        extra={
+            "category": category,
+            "fields": fields,
+            "json_fields": {"category": category, **fields},
+        },
+    )
+
+
+def route_name(request: sanic.Request) -> str:
+    # Route names are dotted ("twitfix.twitfix-embeds.dl"), which would nest in the stats backends.
+    if not request.route:
+        return "unrouted"
+    return request.route.name.split(".", 1)[-1].replace(".", "/")
+
+
+def parse_sampling(value) -> Dict[str, float]:
+    """
+    Sampling rates come as a mapping, or as "category=rate,category=rate" from the environment.
+    """
+    if isinstance(value, dict):
+        return {category: float(rate) for category, rate in value.items()}
+    rates = {}
+    for item in str(value or "").split(","):
+        if "=" in item:
+            category, rate = item.split("=", 1)
+            rates[category.strip()] = float(rate)
+    return rates
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Appends the structured fields of an event to the formatted line as key=value pairs.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if not fields:
+            return line
+        pairs = " ".join(
+            f"{key}={value!r}"
+            if isinstance(value, str) and " " in value
+            else f"{key}={value}"
+            for key, value in fields.items()
+        )
+        return f"{line} [{getattr(record, 'category', '-')}] {pairs}"
+
+
+class QueueingHandler(logging.handlers.QueueHandler):
+    """
+    Never block the event loop on a full queue, drop the record instead.
+    """
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def initialize_logging(
+    app: sanic.Sanic, record_filters: Iterable[Callable[[logging.LogRecord], bool]] = ()
+):
+    """
+    Move the configured log handlers behind a queue for every worker.
+
+    Records are put on the queue by the event loop and written out by a listener
+    thread, so slow handlers no longer stall request handling. Filters given here run
+    before queueing, on the thread that logged, which is the place to capture
+    anything held in context variables.
+    """
+    sampling_rates.update(parse_sampling(app.config.get("LOG_SAMPLING")))
+    queued = []
+
+    @app.on_request
+    async def bind_request_fields(request: sanic.Request):
+        request_fields.set({"route": route_name(request)})
+
+    @app.before_server_start
+    def start_log_queue(app, loop):
+        size = app.config.get("LOG_QUEUE_SIZE", 10000)
+        for name in LOGGERS:
+            log = logging.getLogger(name)
+            handlers = [
+                handler
+                for handler in log.handlers
+                if not isinstance(handler, logging.handlers.QueueHandler)
+            ]
+            if not handlers:
+                continue
+            log_queue = queue.Queue(size)
+            queue_handler = QueueingHandler(log_queue)
+            for record_filter in record_filters:
+                queue_handler.addFilter(record_filter)
+            listener = logging.handlers.QueueListener(
+                log_queue, *handlers, respect_handler_level=True
+            )
+            listener.start()
+            queued.append((log, log.handlers, listener))
+            log.handlers = [queue_handler]
+
+    @app.after_server_stop
+    def stop_log_queue(app, loop):
+        while queued:
+            log, handlers, listener = queued.pop()
+            log.handlers = handlers
+            listener.stop()
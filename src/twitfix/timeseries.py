@@ -0,0 +1,196 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Sequence
+
+# Upper bounds in milliseconds of the latency histogram buckets, the last bucket
+# catches everything slower than the final bound.
+LATENCY_BUCKETS_MS = (
+    1,
+    2,
+    5,
+    10,
+    25,
+    50,
+    100,
+    250,
+    500,
+    1000,
+    2500,
+    5000,
+    10000,
+    30000,
+)
+
+HOUR_FORMAT = "%Y-%m-%dT%H"
+
+
+class Histogram:
+    __slots__ = ("buckets", "count", "sum")
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, millis: float):
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, millis)] += 1
+        self.count += 1
+        self.sum += millis
+
+    def merge(self, other: "Histogram"):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Estimate the q-th percentile (0-100) by interpolating inside the bucket it falls in.
+        """
+        if not self.count:
+            return None
+        rank = self.count * q / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                if i == len(LATENCY_BUCKETS_MS):
+                    return float(LATENCY_BUCKETS_MS[-1])
+                lower = LATENCY_BUCKETS_MS[i - 1] if i else 0
+                upper = LATENCY_BUCKETS_MS[i]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return float(LATENCY_BUCKETS_MS[-1])
+
+    def summary(self, percentiles: Iterable[float]) -> dict:
+        out = {
+            "count": self.count,
+            "mean": round(self.sum / self.count, 3) if self.count else None,
+        }
+        for q in percentiles:
+            value = self.percentile(q)
+            out[f"p{q:g}"] = round(value, 3) if value is not None else None
+        return out
+
+    def to_dict(self) -> Dict[str, float]:
+        out = {f"b{i}": n for i, n in enumerate(self.buckets) if n}
+        out["count"] = self.count
+        out["sum"] = self.sum
+        return out
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        hist = cls()
+        for i in range(len(hist.buckets)):
+            hist.buckets[i] = int(data.get(f"b{i}", 0))
+        hist.count = int(data.get("count", 0))
+        hist.sum = float(data.get("sum", 0.0))
+        return hist
+
+
+class Rollup:
+    """
+    Counters and latency histograms gathered over a span of time.
+    """
+
+    __slots__ = ("counts", "latency")
+
+    def __init__(self) -> None:
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.latency: Dict[str, Histogram] = defaultdict(Histogram)
+
+    def merge(self, other: "Rollup"):
+        for name, n in other.counts.items():
+            self.counts[name] += n
+        for name, hist in other.latency.items():
+            self.latency[name].merge(hist)
+
+    def summary(self, percentiles: Sequence[float]) -> dict:
+        return {
+            "counts": dict(sorted(self.counts.items())),
+            "latency": {
+                name: hist.summary(percentiles)
+                for name, hist in sorted(self.latency.items())
+            },
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "counts": dict(self.counts),
+            "latency": {name: hist.to_dict() for name, hist in self.latency.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Rollup":
+        rollup = cls()
+        for name, n in (data.get("counts") or {}).items():
+            rollup.counts[name] += int(n)
+        for name, hist in (data.get("latency") or {}).items():
+            rollup.latency[name].merge(Histogram.from_dict(hist))
+        return rollup
+
+
+class MinuteBucket(Rollup):
+    __slots__ = ("minute",)
+
+    def __init__(self, minute: int) -> None:
+        super().__init__()
+        self.minute = minute
+
+
+class TimeSeries:
+    """
+    A ring buffer of per-minute buckets, local to the worker process.
+
+    Recording only touches the bucket of the current minute, so it is cheap enough
+    to call several times per request. Completed minutes are handed out by
+    `pending_hours` for downsampling into the stats backend.
+    """
+
+    def __init__(self, minutes: int = 120) -> None:
+        self.size = minutes
+        self.ring: List[Optional[MinuteBucket]] = [None] * minutes
+        self.flushed_through = int(time.time() // 60) - 1
+
+    def _bucket(self) -> MinuteBucket:
+        minute = int(time.time() // 60)
+        slot = minute % self.size
+        bucket = self.ring[slot]
+        if bucket is None or bucket.minute != minute:
+            bucket = self.ring[slot] = MinuteBucket(minute)
+        return bucket
+
+    def increment(self, name: str, amount: int = 1):
+        self._bucket().counts[name] += amount
+
+    def observe(self, name: str, millis: float):
+        self._bucket().latency[name].observe(millis)
+
+    def window(self, minutes: int) -> Rollup:
+        """
+        Merge the last `minutes` minutes, including the one in progress.
+        """
+        now = int(time.time() // 60)
+        rollup = Rollup()
+        for bucket in self.ring:
+            if bucket is not None and now - minutes < bucket.minute <= now:
+                rollup.merge(bucket)
+        return rollup
+
+    def pending_hours(self, include_current: bool = False) -> Dict[str, Rollup]:
+        """
+        Downsample every minute that has not been flushed yet into hourly rollups.
+        """
+        now = int(time.time() // 60)
+        until = now if include_current else now - 1
+        hours: Dict[str, Rollup] = defaultdict(Rollup)
+        for bucket in self.ring:
+            if bucket is not None and self.flushed_through < bucket.minute <= until:
+                hours[hour_key(bucket.minute * 60)].merge(bucket)
+        self.flushed_through = until
+        return dict(hours)
+
+
+def hour_key(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(HOUR_FORMAT)
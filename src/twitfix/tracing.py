@@ -0,0 +1,172 @@
+import json
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import List, Optional
+
+import sanic
+
+from .structured_logging import log_event, route_name
+
+
+class Span:
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start",
+        "duration",
+        "attributes",
+        "trace",
+    )
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], trace):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.attributes = {}
+        # Every span of a request, collected on the root for export in one go.
+        self.trace: List["Span"] = trace
+
+    def finish(self):
+        self.duration = time.time() - self.start
+        self.trace.append(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class TraceExporter:
+    def export(self, spans: List[Span]) -> None:
+        pass
+
+
+class LocalExporter(TraceExporter):
+    """
+    Appends every trace as one JSON line to a file, meant for development.
+    """
+
+    def __init__(self, config) -> None:
+        self.path = Path(config.get("TRACE_FILE", "traces.jsonl"))
+
+    def export(self, spans: List[Span]):
+        with self.path.open("a") as output:
+            output.write(json.dumps([span.to_dict() for span in spans]) + "\n")
+
+
+class LogExporter(TraceExporter):
+    """
+    Logs every span as a structured event, on GCP these end up next to the
+    request logs of the same trace.
+    """
+
+    def __init__(self, config) -> None:
+        pass
+
+    def export(self, spans: List[Span]):
+        for span in spans:
+            log_event("trace", " ➤ [ T ] Span", **span.to_dict())
+
+
+def initialize_tracing(app: sanic.Sanic):
+    exporter_type = app.config.get("TRACE_EXPORTER", "none")
+    if exporter_type == "none":
+        return
+    if exporter_type == "local":
+        exporter = LocalExporter(app.config)
+    elif exporter_type == "log":
+        exporter = LogExporter(app.config)
+    else:
+        raise LookupError(f"Trace exporter not recognized. {exporter_type}")
+    sample_rate = app.config.get("TRACE_SAMPLE_RATE", 1.0)
+
+    @app.on_request
+    async def start_trace(request: sanic.Request):
+        trace_id, parent_id, sampled = parse_xcloud_trace(
+            request.headers.get("X-Cloud-Trace-Context")
+        )
+        if not (sampled or random.random() < sample_rate):
+            return
+        root = Span(
+            "request",
+            trace_id or f"{random.getrandbits(128):032x}",
+            parent_id,
+            [],
+        )
+        root.attributes.update({"method": request.method, "path": request.path})
+        request.ctx.span = root
+        current_span.set(root)
+
+    @app.on_response
+    async def finish_trace(request: sanic.Request, response):
+        root: Optional[Span] = getattr(request.ctx, "span", None)
+        if root is None:
+            return
+        root.attributes["route"] = route_name(request)
+        root.attributes["status"] = response.status if response is not None else None
+        root.finish()
+        exporter.export(root.trace)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Record a child span of whatever span is current, if the request is traced.
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, parent.trace)
+    child.attributes.update(attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attributes["error"] = repr(e)
+        raise
+    finally:
+        current_span.reset(token)
+        child.finish()
+
+
+def parse_xcloud_trace(header):
+    """Given an X_CLOUD_TRACE header, extract the trace and span ids.
+    Args:
+        header (str): the string extracted from the X_CLOUD_TRACE header
+    Returns:
+        Tuple[Optional[dict], Optional[str], bool]:
+            The trace_id, span_id and trace_sampled extracted from the header
+            Each field will be None if not found.
+    """
+    trace_id = span_id = None
+    trace_sampled = False
+    # see https://cloud.google.com/trace/docs/setup for X-Cloud-Trace_Context format
+    if header:
+        try:
+            regex = r"([\w-]+)?(\/?([\w-]+))?(;?o=(\d))?"
+            match = re.match(regex, header)
+            trace_id = match.group(1)
+            span_id = match.group(3)
+            trace_sampled = match.group(5) == "1"
+        except IndexError:
+            pass
+    return trace_id, span_id, trace_sampled
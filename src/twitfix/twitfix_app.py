@@ -1,61 +1,60 @@
-import json
+import asyncio
+import logging
+import os
 import re
+import time
+from functools import partial
 
 import sanic
 import sanic.response
-import youtube_dl
 from sanic.log import logger
 
-from .exceptions import TwitterUserProtected
+from . import serialization
+from .admission import admission
+from .breakers import breaker
+from .crawlers import TEMPLATES, crawler_profile, is_crawler
+from .deadlines import embed_deadline
+from .exceptions import (
+    CircuitOpen,
+    MediaUnavailable,
+    Overloaded,
+    TwitterUserProtected,
+)
+from .faults import inject_fault
+from .instrumentation import stage
+from .metrics import (
+    CACHE_LOOKUPS,
+    EXTRACTION_FALLBACKS,
+    EXTRACTION_HEDGES,
+    EXTRACTION_SECONDS,
+    STORAGE_SECONDS,
+)
+from .prefetch import prefetch_video
 from .sanic_jinja import render_template
+from .structured_logging import log_event
+from .tracing import span
+from .variants import api_variants, video_variant, youtubedl_variants
 
 twitfix_app = sanic.Blueprint("twitfix-embeds")
 
 pathregex = re.compile("\\w{1,15}\\/(status|statuses)\\/\\d{2,20}")
 
-# Where may our links be posted?
-# And what is the default appearance of these?
-#
-# Discord
-# Telegram
-# Slack
-# Facebook
-# Valve Steam Client
-# Valve Steam FriendsUI
-# January (image proxy RevoltChat)
-generate_embed_user_agents = [
-    "facebookexternalhit/1.1",
-    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/31.0.1650.57 Safari/537.36",
-    "Mozilla/5.0 (Windows; U; Windows NT 10.0; en-US; Valve Steam Client/default/1596241936; ) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.117 Safari/537.36",
-    "Mozilla/5.0 (Windows; U; Windows NT 10.0; en-US; Valve Steam Client/default/0; ) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.117 Safari/537.36",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_1) AppleWebKit/601.2.4 (KHTML, like Gecko) Version/9.0.1 Safari/601.2.4 facebookexternalhit/1.1 Facebot Twitterbot/1.0",
-    "facebookexternalhit/1.1",
-    "Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; Valve Steam FriendsUI Tenfoot/0; ) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/84.0.4147.105 Safari/537.36",
-    "Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.10; rv:38.0) Gecko/20100101 Firefox/38.0",
-    "Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)",
-    "TelegramBot (like TwitterBot)",
-    "Mozilla/5.0 (compatible; January/1.0; +https://gitlab.insrt.uk/revolt/january)",
-    "test",
-]
-
 
 @twitfix_app.route(
     "/"
 )  # If the useragent is discord, return the embed, if not, redirect to configured repo directly
 async def default(request):
     user_agent = request.headers.get("user-agent")
-    if user_agent in generate_embed_user_agents:
+    if is_crawler(user_agent):
         return await message(
             request,
             "TwitFix is an attempt to fix twitter video embeds in discord! created by Robin Universe :)\n\n💖\n\nClick me to be redirected to the repo!",
         )
     else:
-        logger.info("Just redirecting to github")
+        log_event("redirect", "Just redirecting to github")
         return sanic.response.redirect(request.app.config.REPO, status=301)
 
 
-
 @twitfix_app.get("/<username:str>/status/<tweet_id:str>/photo/<item:int>")
 @twitfix_app.get("/<username:str>/status/<tweet_id:str>/video/<item:int>")
 async def handle_media(request: sanic.Request, username: str, tweet_id: str, item: int):
@@ -91,17 +90,17 @@ async def twitfix(request, sub_path):
     if request.host.startswith(
         f"d."
     ):  # Matches d.{fx}? Try to give the user a direct link
-        if user_agent in generate_embed_user_agents:
-            logger.info(f" ➤ [ D ] d. link shown to discord user-agent!")
+        if is_crawler(user_agent):
+            log_event("redirect", " ➤ [ D ] d. link shown to discord user-agent!")
             if request.url.endswith(".mp4") and "?" not in request.url:
-                return await dl(request, sub_path[:-4])
+                return await dl(request, sub_path[:-4], route="direct")
             else:
                 return await message(
                     request,
                     "To use a direct MP4 link in discord, remove anything past '?' and put '.mp4' at the end",
                 )
         else:
-            logger.info(f" ➤ [ R ] Redirect to MP4 using {request.host}")
+            log_event("redirect", " ➤ [ R ] Redirect to MP4", host=request.host)
             return await dir(request, sub_path)
 
     elif request.url.endswith((".mp4", "%2Emp4")):
@@ -122,15 +121,22 @@ async def twitfix(request, sub_path):
         else:
             clean = twitter_url
 
-        logger.info(" ➤ [ API ] VNF Json api hit!")
+        log_event("api", " ➤ [ API ] VNF Json api hit!")
 
-        vnf = link_to_vnf_from_api(request, clean.replace(".json", ""))
+        clean = clean.replace(".json", "")
+        vnf = (await resolve_links(request, [clean]))[clean]
+        if isinstance(vnf, TwitterUserProtected):
+            return await message(request, "This user is guarding their tweets!")
+        if isinstance(vnf, Overloaded):
+            raise vnf
+        if vnf is None or isinstance(vnf, Exception):
+            return await message(request, "Failed to scan your link!")
 
-        if user_agent in generate_embed_user_agents:
+        if is_crawler(user_agent):
             return await message(
                 request,
                 "VNF Data: ( discord useragent preview )\n\n"
-                + json.dumps(vnf, default=str),
+                + serialization.dumps(vnf),
             )
         else:
             return sanic.response.json(vnf)
@@ -141,21 +147,81 @@ async def twitfix(request, sub_path):
         if match.start() == 0:
             twitter_url = "https://twitter.com/" + sub_path
 
-        if user_agent in generate_embed_user_agents:
+        if is_crawler(user_agent):
             return await embed_video(request, twitter_url)
         else:
-            logger.info(" ➤ [ R ] Redirect to " + twitter_url)
+            log_event("redirect", " ➤ [ R ] Redirect to tweet", tweet=twitter_url)
             return sanic.response.redirect(twitter_url, status=301)
     else:
         return await message(request, "This doesn't appear to be a twitter URL")
 
 
+@twitfix_app.route("/api/batch", methods=["GET", "POST"])
+async def api_batch(request):
+    """
+    VNFs of many tweets in one response. Tweets are given as links or IDs, repeated
+    in the `tweet` query argument or posted as a JSON list.
+    """
+    if request.method == "POST":
+        tweets = request.load_json(loads=serialization.loads)
+        if isinstance(tweets, dict):
+            tweets = tweets.get("tweets")
+        if not isinstance(tweets, list):
+            return sanic.response.json(
+                {"error": "Post a JSON list of tweet links or IDs"}, status=400
+            )
+    else:
+        tweets = request.args.getlist("tweet", [])
+    limit = request.app.config.get("BATCH_SIZE", 100)
+    if len(tweets) > limit:
+        return sanic.response.json(
+            {"error": f"At most {limit} tweets per batch"}, status=400
+        )
+
+    log_event("api", " ➤ [ API ] VNF batch api hit!", tweets=len(tweets))
+    links = {str(tweet): batch_link(tweet) for tweet in tweets}
+    results = await resolve_links(
+        request, [link for link in links.values() if link is not None]
+    )
+    vnfs, errors = {}, {}
+    for tweet, link in links.items():
+        result = results.get(link)
+        if link is None:
+            errors[tweet] = "This doesn't appear to be a twitter URL"
+        elif isinstance(result, TwitterUserProtected):
+            errors[tweet] = "This user is guarding their tweets!"
+        elif isinstance(result, Overloaded):
+            errors[tweet] = "TwitFix is busy right now, try again shortly."
+        elif result is None or isinstance(result, BaseException):
+            errors[tweet] = "Failed to scan your link!"
+        else:
+            vnfs[tweet] = result
+    with span("stats"):
+        await request.app.config.STAT_MODULE.add_to_stat("api")
+    return sanic.response.json({"vnfs": vnfs, "errors": errors})
+
+
+def batch_link(tweet):
+    """
+    The link a tweet is cached under, tweets only given by ID are looked up as /i/.
+    Those bypass the entries cached under the tweet's link, which the ID alone does
+    not tell, and are cached once more on their own.
+    """
+    tweet = str(tweet).strip()
+    if tweet.isdigit():
+        return f"https://twitter.com/i/status/{tweet}"
+    match = pathregex.search(tweet)
+    if match is None:
+        return None
+    return "https://twitter.com/" + match.group(0)
+
+
 @twitfix_app.route(
     "/other/<sub_path:path>"
 )  # Show all info that Youtube-DL can get about a video as a json
 async def other(request, sub_path):
     otherurl = request.url.split("/other/", 1)[1].replace(":/", "://")
-    logger.info(" ➤ [ OTHER ]  Other URL embed attempted: " + otherurl)
+    log_event("other", " ➤ [ OTHER ]  Other URL embed attempted", url=otherurl)
     res = await embed_video(request, otherurl)
     return res
 
@@ -165,18 +231,14 @@ async def other(request, sub_path):
 )  # Show all info that Youtube-DL can get about a video as a json
 async def info(request, sub_path):
     infourl = request.url.split("/info/", 1)[1].replace(":/", "://")
-    logger.info(" ➤ [ INFO ] Info data requested: " + infourl)
-    with youtube_dl.YoutubeDL({"outtmpl": "%(id)s.%(ext)s"}) as ydl:
-        result = ydl.extract_info(infourl, download=False)
-
-    return result
+    log_event("other", " ➤ [ INFO ] Info data requested", url=infourl)
+    result = await request.app.config.YOUTUBE_DL.extract_info(infourl)
+    return sanic.response.json(result)
 
 
 @twitfix_app.route("/dl/<sub_path:path>")  # Download the tweets video, and rehost it
-async def dl(request, sub_path):
-    logger.info(
-        f" ➤ [[ !!! TRYING TO DOWNLOAD FILE !!! ]] Downloading file from {sub_path}"
-    )
+async def dl(request, sub_path, route="download"):
+    log_event("download", " ➤ [[ !!! TRYING TO DOWNLOAD FILE !!! ]]", path=sub_path)
     url = sub_path
     match = pathregex.search(url)
     if match is not None:
@@ -184,31 +246,52 @@ async def dl(request, sub_path):
         if match.start() == 0:
             twitter_url = "https://twitter.com/" + url
 
-    mp4link = await direct_video_link(request, twitter_url)
+    mp4link = await direct_video_link(request, twitter_url, route)
     if not isinstance(mp4link, str):
         return mp4link
 
     if not mp4link:
         return await message(request, "No video file in tweet.")
 
-    cache_hit, stored_identifier = await request.app.config.STORAGE_MODULE.store_media(
-        mp4link
-    )
-    if not cache_hit:
-        await request.app.config.STAT_MODULE.add_to_stat("downloads")
-    response = await request.app.config.STORAGE_MODULE.retrieve_media(stored_identifier)
+    try:
+        async with admission(request, "download"):
+            with stage(request, "storage_store"):
+                started = time.perf_counter()
+                (
+                    cache_hit,
+                    stored_identifier,
+                ) = await request.app.config.STORAGE_MODULE.store_media(mp4link)
+                STORAGE_SECONDS.labels("store", "hit" if cache_hit else "miss").observe(
+                    time.perf_counter() - started
+                )
+        if not cache_hit:
+            await request.app.config.STAT_MODULE.add_to_stat("downloads")
+        with stage(request, "storage_retrieve"):
+            started = time.perf_counter()
+            response = await request.app.config.STORAGE_MODULE.retrieve_media(
+                stored_identifier
+            )
+            STORAGE_SECONDS.labels(
+                "retrieve", "miss" if response is None else response["output"]
+            ).observe(time.perf_counter() - started)
+    except (CircuitOpen, MediaUnavailable):
+        log_event("download", " ➤ [ D ] Storage unavailable, redirecting to Twitter")
+        return sanic.response.redirect(mp4link)
 
     if response is None:
         return sanic.response.empty(status=404)
     if response["output"] == "url":
-        logger.info("Cache response>")
+        log_event("download", " ➤ [ D ] Redirecting to stored media")
         return sanic.response.redirect(response["url"])
     if response["output"] == "file":
-        return await sanic.response.file(
+        # Streamed from disk, videos are too large to read into memory for every request.
+        return await sanic.response.file_stream(
             response["content"],
+            chunk_size=2**18,
+            mime_type="video/mp4",
             headers={
                 "max-age": 3600,
-                "Content-Type": "video/mp4",
+                "Content-Length": str(os.path.getsize(response["content"])),
                 "Sec-Fetch-Site": "none",
                 "Sec-Fetch-User": "?1",
             },
@@ -229,12 +312,12 @@ async def dir(request, sub_path):
         if match.start() == 0:
             twitter_url = "https://twitter.com/" + url
 
-        if user_agent in generate_embed_user_agents:
+        if is_crawler(user_agent):
             res = await embed_video(request, twitter_url)
             return res
 
         else:
-            logger.info(" ➤ [ R ] Redirect to direct MP4 URL")
+            log_event("redirect", " ➤ [ R ] Redirect to direct MP4 URL")
             return await direct_video(request, twitter_url)
     else:
         return sanic.response.redirect(url, status=301)
@@ -245,17 +328,55 @@ async def favicon(request):
     return await sanic.response.file("static/favicon.ico", mime_type="image/x-icon")
 
 
-async def add_link_to_cache(request, video_link, vnf):
-    res = await request.app.config.LINKS_MODULE.add_link_to_cache(video_link, vnf)
+@twitfix_app.exception(Overloaded)
+async def overloaded(request, exception: Overloaded):
+    # Shed load quickly, crawlers retry and cache hits keep being served meanwhile.
+    log_event("admission", " ➤ [ X ] Request shed", budget=exception.budget)
+    headers = {
+        "Retry-After": str(request.app.config.get("ADMISSION_RETRY_AFTER", 5)),
+        "cache-control": "no-store",
+    }
+    if (
+        exception.budget == "extract"
+        and request.app.config.get("ADMISSION_FALLBACK", "503") == "embed"
+        and is_crawler(request.headers.get("user-agent"))
+    ):
+        response = await message(
+            request, "TwitFix is busy right now, this tweet will embed on a retry."
+        )
+        response.headers.update(headers)
+        return response
+    return sanic.response.text(
+        "TwitFix is busy right now, try again shortly.", status=503, headers=headers
+    )
+
+
+async def add_link_to_cache(request, video_link, vnf, prefetch=True):
+    if vnf is None:
+        # Failed extractions come back empty, caching them would break the link for good.
+        return False
+    vnf["render"] = render_fields(vnf)
+    with stage(request, "cache_write"):
+        res = await request.app.config.LINKS_MODULE.add_link_to_cache(video_link, vnf)
     if res:
-        await request.app.config.STAT_MODULE.add_to_stat("linksCached")
+        with span("stats"):
+            await request.app.config.STAT_MODULE.add_to_stat("linksCached")
+    if prefetch:
+        # Not every cache tells whether the write went through.
+        prefetch_video(request, vnf)
     return res
 
 
-async def get_link_from_cache(request, video_link):
-    res = await request.app.config.LINKS_MODULE.get_link_from_cache(video_link)
+async def get_link_from_cache(request, video_link, prefetch=True):
+    with stage(request, "cache"):
+        res = await request.app.config.LINKS_MODULE.get_link_from_cache(video_link)
+    request.app.config.TIMESERIES.increment("cache:hit" if res else "cache:miss")
+    CACHE_LOOKUPS.labels("hit" if res else "miss").inc()
     if res:
-        await request.app.config.STAT_MODULE.add_to_stat("embeds")
+        with span("stats"):
+            await request.app.config.STAT_MODULE.add_to_stat("embeds")
+        if prefetch:
+            prefetch_video(request, res)
     return res
 
 
@@ -265,39 +386,110 @@ async def direct_video(
     cached_vnf = await get_link_from_cache(request, video_link)
     if cached_vnf is None:
         try:
-            vnf = link_to_vnf(request, video_link)
+            vnf = await link_to_vnf(request, video_link)
             await add_link_to_cache(request, video_link, vnf)
-            logger.info(" ➤ [ D ] Redirecting to direct URL: " + vnf["url"])
-            return sanic.response.redirect(vnf["url"], status=301)
+            url = video_variant(request, vnf, "direct")["url"]
+            log_event("redirect", " ➤ [ D ] Redirecting to direct URL", url=url)
+            return sanic.response.redirect(url, status=301)
         except TwitterUserProtected:
             return await message(request, "This user is guarding their tweets!")
+        except Overloaded:
+            raise
         except Exception as e:
-            logger.info(e)
+            log_event(
+                "extract",
+                " ➤ [ X ] Failed to scan link",
+                level=logging.WARNING,
+                tweet=video_link,
+                error=repr(e),
+            )
             return await message(request, "Failed to scan your link!")
     else:
-        logger.info(f" ➤ [ D ] Redirecting to direct URL: {cached_vnf['url']}")
-        return sanic.response.redirect(cached_vnf["url"], status=301)
+        url = video_variant(request, cached_vnf, "direct")["url"]
+        log_event("redirect", " ➤ [ D ] Redirecting to direct URL", url=url)
+        return sanic.response.redirect(url, status=301)
 
 
 async def direct_video_link(
     request,
     video_link,
+    route="download",
 ):  # Just get a redirect to a MP4 link from any tweet link
-    cached_vnf = await get_link_from_cache(request, video_link)
+    # Downloads store the video themselves, a prefetch would fetch it a second time.
+    cached_vnf = await get_link_from_cache(request, video_link, prefetch=False)
     if cached_vnf is None:
         try:
-            vnf = link_to_vnf(request, video_link)
-            await add_link_to_cache(request, video_link, vnf)
-            logger.info(f" ➤ [ D ] Redirecting to direct URL: {vnf['url']}")
-            return vnf["url"]
+            vnf = await link_to_vnf(request, video_link)
+            await add_link_to_cache(request, video_link, vnf, prefetch=False)
+            url = video_variant(request, vnf, route)["url"]
+            log_event("redirect", " ➤ [ D ] Redirecting to direct URL", url=url)
+            return url
         except TwitterUserProtected:
             return await message(request, "This user is guarding their tweets!")
+        except Overloaded:
+            raise
         except Exception as e:
-            logger.info(e)
+            log_event(
+                "extract",
+                " ➤ [ X ] Failed to scan link",
+                level=logging.WARNING,
+                tweet=video_link,
+                error=repr(e),
+            )
             return await message(request, "Failed to scan your link!")
     else:
-        logger.info(f" ➤ [ D ] Redirecting to direct URL: {cached_vnf['url']}")
-        return cached_vnf["url"]
+        url = video_variant(request, cached_vnf, route)["url"]
+        log_event("redirect", " ➤ [ D ] Redirecting to direct URL", url=url)
+        return url
+
+
+async def extract_and_cache(request, video_link):
+    vnf = await link_to_vnf(request, video_link)
+    await add_link_to_cache(request, video_link, vnf)
+    return vnf
+
+
+async def resolve_links(request, video_links):
+    """
+    VNFs of `video_links` by link from one cache lookup, the misses are extracted
+    concurrently and cached. Failed extractions map to None or their exception.
+    """
+    video_links = list(dict.fromkeys(video_links))
+    with stage(request, "cache"):
+        cached = await request.app.config.LINKS_MODULE.get_links_batch(video_links)
+    misses = [video_link for video_link in video_links if video_link not in cached]
+    request.app.config.TIMESERIES.increment("cache:hit", len(cached))
+    request.app.config.TIMESERIES.increment("cache:miss", len(misses))
+    CACHE_LOOKUPS.labels("hit").inc(len(cached))
+    CACHE_LOOKUPS.labels("miss").inc(len(misses))
+    extractions = request.app.config.BACKGROUND_EXTRACTIONS
+    extracted = await asyncio.gather(
+        *(
+            # Shared with embeds of the same link, which must not see it cancelled.
+            asyncio.shield(
+                extractions.start(
+                    video_link, partial(extract_and_cache, request, video_link)
+                )
+            )
+            for video_link in misses
+        ),
+        return_exceptions=True,
+    )
+    return {**cached, **dict(zip(misses, extracted))}
+
+
+async def pending_embed(request, video_link):
+    # A plain link card, not cached by the crawler so its next look finds the full embed.
+    response = await render_template(
+        request,
+        "pending.html",
+        video_link=video_link,
+        message="Still fetching this tweet, it shows up in full shortly.",
+        color=request.app.config.COLOR,
+        appname=request.app.config.APP_NAME,
+    )
+    response.headers["cache-control"] = "no-store"
+    return response
 
 
 async def embed_video(request, video_link, image=0):  # Return Embed from any tweet link
@@ -305,16 +497,62 @@ async def embed_video(request, video_link, image=0):  # Return Embed from any tw
 
     if cached_vnf is None:
         try:
-            vnf = link_to_vnf(request, video_link)
-            await add_link_to_cache(request, video_link, vnf)
+            vnf = await request.app.config.BACKGROUND_EXTRACTIONS.wait(
+                video_link,
+                lambda: extract_and_cache(request, video_link),
+                embed_deadline(request),
+            )
             return await embed(request, video_link, vnf, image)
+        except asyncio.TimeoutError:
+            log_event(
+                "extract",
+                " ➤ [ ⏱ ] Embed deadline missed, finishing in background",
+                tweet=video_link,
+            )
+            return await pending_embed(request, video_link)
         except TwitterUserProtected:
             return await message(request, "This user is guarding their tweets!")
+        except Overloaded:
+            raise
         except Exception as e:
-            logger.info(e)
+            log_event(
+                "extract",
+                " ➤ [ X ] Failed to scan link",
+                level=logging.WARNING,
+                tweet=video_link,
+                error=repr(e),
+            )
             return await message(request, "Failed to scan your link!")
     else:
-        return await embed(request, video_link, cached_vnf, image)
+        return await embed(
+            request, video_link, upgrade_cached(request, video_link, cached_vnf), image
+        )
+
+
+def upgrade_cached(request, video_link, vnf):
+    """
+    Links cached before the render fields existed, or with older ones, get them now
+    and have them written back in the background.
+    """
+    if vnf.get("render", {}).get("version") == RENDER_VERSION:
+        return vnf
+    vnf = legacy_vnf(vnf)
+    vnf["render"] = render_fields(vnf)
+    request.app.add_task(store_render_fields(request.app, video_link, vnf["render"]))
+    return vnf
+
+
+async def store_render_fields(app, video_link, render):
+    try:
+        await app.config.LINKS_MODULE.update_link(video_link, {"render": render})
+    except Exception as e:
+        log_event(
+            "cache_write",
+            " ➤ [ X ] Failed to store render fields",
+            level=logging.WARNING,
+            tweet=video_link,
+            error=repr(e),
+        )
 
 
 def tweetInfo(
@@ -333,6 +571,7 @@ def tweetInfo(
     time="",
     qrt={},
     nsfw=False,
+    variants=None,
 ):  # Return a dict of video info with default values
     vnf = {
         "tweet": tweet,
@@ -350,18 +589,38 @@ def tweetInfo(
         "time": time,
         "qrt": qrt,
         "nsfw": nsfw,
+        # Every MP4 of the video smallest first, `url` is the best of them.
+        "variants": variants or [],
     }
     return vnf
 
 
-def link_to_vnf_from_api(request, video_link):
-    logger.info(" ➤ [ + ] Attempting to download tweet info from Twitter API")
+async def link_to_vnf_from_api(request, video_link):
+    log_event(
+        "extract",
+        " ➤ [ + ] Attempting to download tweet info from Twitter API",
+        tweet=video_link,
+    )
     twid = int(
         re.sub(r"\?.*$", "", video_link.rsplit("/", 1)[-1])
     )  # gets the tweet ID as a int from the passed url
-    tweet = request.app.config.TWITTER.statuses.show(_id=twid, tweet_mode="extended")
+    async with breaker(request, "twitter_api").guard():
+        await inject_fault(request, "twitter_api")
+        # The client blocks, off the loop it can be hedged and does not stall other requests.
+        tweet = await asyncio.get_running_loop().run_in_executor(
+            None,
+            partial(
+                request.app.config.TWITTER.statuses.show,
+                _id=twid,
+                tweet_mode="extended",
+            ),
+        )
     # For when I need to poke around and see what a tweet looks like
     # logger.info(tweet)
+    return vnf_from_api_tweet(tweet, video_link)
+
+
+def vnf_from_api_tweet(tweet, video_link):  # Map a v1.1 API tweet onto a VNF
     protected = tweet["user"]["protected"]
     if protected:
         raise TwitterUserProtected()
@@ -370,23 +629,19 @@ def link_to_vnf_from_api(request, video_link):
     nsfw = tweet.get("possibly_sensitive", False)
     qrt = {}
     url = ""
+    variants = []
     thumb = ""
     imgs = ["", "", "", "", ""]
-    logger.info(" ➤ [ + ] Tweet Type: " + tweetType(tweet))
+    log_event("extract", " ➤ [ + ] Tweet Type", type=tweetType(tweet))
     # Check to see if tweet has a video, if not, make the url passed to the VNF the first t.co link in the tweet
     if tweetType(tweet) == "Video":
         if tweet["extended_entities"]["media"][0]["video_info"]["variants"]:
-            best_bitrate = -1
             thumb = tweet["extended_entities"]["media"][0]["media_url"]
-            for video in tweet["extended_entities"]["media"][0]["video_info"][
-                "variants"
-            ]:
-                if (
-                    video["content_type"] == "video/mp4"
-                    and video["bitrate"] > best_bitrate
-                ):
-                    url = video["url"]
-                    best_bitrate = video["bitrate"]
+            variants = api_variants(
+                tweet["extended_entities"]["media"][0]["video_info"]
+            )
+            if variants:
+                url = variants[-1]["url"]
     elif tweetType(tweet) == "Text":
         pass
     else:
@@ -420,52 +675,72 @@ def link_to_vnf_from_api(request, video_link):
         qrt=qrt,
         images=imgs,
         nsfw=nsfw,
+        variants=variants,
     )
 
     return vnf
 
 
-def link_to_vnf_from_youtubedl(video_link):
-    logger.info(
-        f" ➤ [ X ] Attempting to download tweet info via YoutubeDL: {video_link}"
+async def link_to_vnf_from_youtubedl(request, video_link):
+    log_event(
+        "extract",
+        " ➤ [ X ] Attempting to download tweet info via YoutubeDL",
+        tweet=video_link,
     )
-    with youtube_dl.YoutubeDL({"outtmpl": "%(id)s.%(ext)s"}) as ydl:
-        result = ydl.extract_info(video_link, download=False)
-        vnf = tweetInfo(
-            result["url"],
-            video_link,
-            result["description"].rsplit(" ", 1)[0],
-            result["thumbnail"],
-            result["uploader"],
-        )
-        return vnf
+    async with breaker(request, "youtube_dl").guard():
+        await inject_fault(request, "youtube_dl")
+        result = await request.app.config.YOUTUBE_DL.extract_info(video_link)
+    vnf = tweetInfo(
+        result["url"],
+        video_link,
+        result["description"].rsplit(" ", 1)[0],
+        result["thumbnail"],
+        result["uploader"],
+        variants=youtubedl_variants(result),
+    )
+    return vnf
+
+
+async def link_to_vnf(request, video_link):  # Return a VideoInfo object or die trying
+    async with admission(request, "extract"):
+        with stage(request, "extract"):
+            return await _link_to_vnf(request, video_link)
 
 
-def link_to_vnf(request, video_link):  # Return a VideoInfo object or die trying
+async def _link_to_vnf(request, video_link):
     config_method = request.app.config.DOWNLOAD_METHOD
     if config_method == "hybrid":
-        try:
-            return link_to_vnf_from_api(request, video_link)
-        except TwitterUserProtected:
-            logger.info(" ➤ [ X ] User is protected, stop.")
-            raise
-        except Exception as e:
-            logger.error(f" ➤ [ !!! ] API Failed {e}")
-            return link_to_vnf_from_youtubedl(video_link)
+        return await hedged_extraction(request, video_link)
     elif config_method == "api":
         try:
-            return link_to_vnf_from_api(request, video_link)
+            return await timed_extraction(
+                "api", link_to_vnf_from_api, request, video_link
+            )
         except TwitterUserProtected:
-            logger.info(" ➤ [ X ] User is protected, stop.")
+            log_event("extract", " ➤ [ X ] User is protected, stop.", tweet=video_link)
             raise
         except Exception as e:
-            logger.error(f" ➤ [ X ] API Failed {e}")
+            log_event(
+                "extract",
+                " ➤ [ X ] API Failed",
+                level=logging.ERROR,
+                tweet=video_link,
+                error=repr(e),
+            )
             return None
     elif config_method == "youtube-dl":
         try:
-            return link_to_vnf_from_youtubedl(video_link)
+            return await timed_extraction(
+                "youtube-dl", link_to_vnf_from_youtubedl, request, video_link
+            )
         except Exception as e:
-            logger.error(f" ➤ [ X ] Youtube-DL Failed {e}")
+            log_event(
+                "extract",
+                " ➤ [ X ] Youtube-DL Failed",
+                level=logging.ERROR,
+                tweet=video_link,
+                error=repr(e),
+            )
             return None
     else:
         logger.info(
@@ -474,6 +749,89 @@ def link_to_vnf(request, video_link):  # Return a VideoInfo object or die trying
         return None
 
 
+async def hedged_extraction(request, video_link):
+    """
+    Try the API first, if it has not answered within HEDGE_DELAY seconds youtube-dl
+    starts alongside it. The first successful result wins and the other is cancelled.
+    """
+
+    def start(method, extractor):
+        running.add(
+            asyncio.ensure_future(
+                timed_extraction(method, extractor, request, video_link)
+            )
+        )
+
+    running = set()
+    start("api", link_to_vnf_from_api)
+    (api,) = running
+    try:
+        done, _ = await asyncio.wait(
+            running, timeout=request.app.config.get("HEDGE_DELAY", 1.0)
+        )
+        hedged = not done
+        if hedged:
+            start("youtube-dl", link_to_vnf_from_youtubedl)
+
+        while running:
+            done, running = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                error = task.exception()
+                if error is None:
+                    EXTRACTION_HEDGES.labels(
+                        str(hedged).lower(), "api" if task is api else "youtube-dl"
+                    ).inc()
+                    return task.result()
+                if isinstance(error, TwitterUserProtected):
+                    log_event(
+                        "extract", " ➤ [ X ] User is protected, stop.", tweet=video_link
+                    )
+                    raise error
+                log_event(
+                    "extract",
+                    " ➤ [ !!! ] API Failed"
+                    if task is api
+                    else " ➤ [ X ] Youtube-DL Failed",
+                    level=logging.ERROR,
+                    tweet=video_link,
+                    error=repr(error),
+                )
+                if task is api:
+                    EXTRACTION_FALLBACKS.inc()
+                    if not hedged:
+                        start("youtube-dl", link_to_vnf_from_youtubedl)
+        EXTRACTION_HEDGES.labels(str(hedged).lower(), "none").inc()
+        raise error
+    finally:
+        for task in running:
+            task.cancel()
+
+
+async def timed_extraction(method, extractor, *args):
+    started = time.perf_counter()
+    outcome = "failure"
+    try:
+        with span(f"extract.{method}"):
+            vnf = await extractor(*args)
+        outcome = "success"
+        return vnf
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        EXTRACTION_SECONDS.labels(method, outcome).observe(elapsed)
+        log_event(
+            "extract",
+            " ➤ [ + ] Extraction finished",
+            method=method,
+            outcome=outcome,
+            elapsed_ms=round(elapsed * 1000, 1),
+        )
+
+
 async def message(request, text):
     return await render_template(
         request,
@@ -486,11 +844,39 @@ async def message(request, text):
     )
 
 
-async def embed(request, video_link, vnf, image):
-    logger.info(
-        f" ➤ [ E ] Embedding {vnf['type']}: {vnf['url'] or (video_link, image)}"
-    )
+# Bumped whenever render_fields changes, cached links are upgraded when next seen.
+RENDER_VERSION = 1
+COLOR = "#7FFFD4"
+NSFW_COLOR = "#800020"
+
+
+def legacy_vnf(vnf):  # Fill in what VNFs cached by older versions are missing
+    return {
+        **tweetInfo(vnf.get("url", "")),
+        **vnf,
+    }
+
+
+def render_fields(vnf):
+    """
+    Everything an embed needs that only depends on the VNF, computed once when the
+    link is cached instead of on every hit.
+    """
+    if vnf["type"] == "Image":
+        images = [image for image in vnf["images"][:4] if image]
+    else:
+        images = [vnf["thumbnail"]]
+    return {
+        "version": RENDER_VERSION,
+        "description": embed_description(vnf),
+        "template": TEMPLATES[vnf["type"]],
+        # Change the theme color to red if this post is not worksafe.
+        "color": NSFW_COLOR if vnf.get("nsfw") else COLOR,
+        "images": images,
+    }
 
+
+def embed_description(vnf):  # Clean up the tweet text and append likes and the QRT
     desc = re.sub(r" http.*t\.co\S+", "", vnf["description"])
     likeDisplay = "\n\n💖 " + str(vnf["likes"]) + " 🔁 " + str(vnf["rts"]) + "\n"
 
@@ -516,42 +902,56 @@ async def embed(request, video_link, vnf, image):
         vnf["likes"] = 0
         vnf["rts"] = 0
         vnf["time"] = 0
-        logger.info(" ➤ [ X ] Failed QRT check - old VNF object")
-
-    if vnf["type"] == "Text":  # Change the template based on tweet type
-        template = "text.html"
-    if vnf["type"] == "Image":
-        image = vnf["images"][image]
-        template = "image.html"
-    if vnf["type"] == "Video":
-        template = "video.html"
-    if vnf["type"] == "":
-        template = "video.html"
+        log_event("embed", " ➤ [ X ] Failed QRT check - old VNF object")
+    return desc
 
-    # Change the theme color to red if this post is not worksafe.
-    color = "#800020" if vnf.get("nsfw") else "#7FFFD4"
 
-    return await render_template(
-        request,
-        template,
-        likes=vnf["likes"],
-        rts=vnf["rts"],
-        time=vnf["time"],
-        screenName=vnf["screen_name"],
-        vidlink=vnf["url"],
-        pfp=vnf["pfp"],
-        vidurl=vnf["url"],
-        desc=desc,
-        pic=image,
-        user=vnf["uploader"],
-        userScreenName=f'{vnf["uploader"]} (@{vnf["screen_name"]})',
-        video_link=video_link,
-        color=color,
-        appname=request.app.config.APP_NAME,
-        repo=request.app.config.REPO,
-        url=request.app.config.BASE_URL,
+async def embed(request, video_link, vnf, image):
+    log_event(
+        "embed",
+        " ➤ [ E ] Embedding",
+        tweet=video_link,
+        type=vnf["type"],
+        url=vnf["url"],
+        image=image,
     )
 
+    render = vnf["render"]
+    template = render["template"]
+    profile = crawler_profile(request.headers.get("user-agent"))
+    if profile is not None and profile.templates is not TEMPLATES:
+        template = profile.templates[vnf["type"]]
+    images = render["images"]
+    pic = images[image] if image < len(images) else images[0]
+    if vnf["type"] in ("Video", ""):
+        video = video_variant(request, vnf, "embed")
+    else:
+        video = {"url": vnf["url"], "width": 0, "height": 0}
+
+    async with admission(request, "render"):
+        return await render_template(
+            request,
+            template,
+            likes=vnf["likes"],
+            rts=vnf["rts"],
+            time=vnf["time"],
+            screenName=vnf["screen_name"],
+            vidlink=vnf["url"],
+            pfp=vnf["pfp"],
+            vidurl=video["url"],
+            vidwidth=video["width"] or 720,
+            vidheight=video["height"] or 480,
+            desc=render["description"],
+            pic=pic,
+            user=vnf["uploader"],
+            userScreenName=f'{vnf["uploader"]} (@{vnf["screen_name"]})',
+            video_link=video_link,
+            color=render["color"],
+            appname=request.app.config.APP_NAME,
+            repo=request.app.config.REPO,
+            url=request.app.config.BASE_URL,
+        )
+
 
 def tweetType(tweet):  # Are we dealing with a Video, Image, or Text tweet?
     if "extended_entities" in tweet:
@@ -1,8 +1,11 @@
 import asyncio
+import os
 
 import sanic
 import sanic.response
 
+from .faults import parse_faults
+
 debug = sanic.Blueprint("twitfix_debug")
 
 # https://ayytwitter.com/delay/102
@@ -37,3 +40,23 @@ async def delayed_response(request, millis: int):
     async with response as send:
         await asyncio.sleep(millis/1000)
         await send(response)
+
+
+# curl -X POST localhost:8080/debug/faults -d '{"link_cache": {"latency": 0.2, "error_rate": 0.1}}'
+# Needs TWITFIX_FAULT_INJECTION=true, and only changes the worker that answers.
+@debug.route("/debug/faults", methods=["GET", "POST", "DELETE"])
+async def faults(request):
+    injector = request.app.config.get("FAULT_INJECTOR")
+    if injector is None:
+        return sanic.response.empty(status=404)
+    if request.method == "POST":
+        try:
+            injector.update(parse_faults(request.json or {}))
+        except (TypeError, ValueError) as e:
+            return sanic.response.json({"error": str(e)}, status=400)
+    elif request.method == "DELETE":
+        injector.clear()
+    return sanic.response.json(
+        {"worker": os.getpid(), "faults": injector.to_dict()},
+        headers={"cache-control": "no-cache"},
+    )
@@ -0,0 +1,32 @@
+import os
+
+import prometheus_client
+import sanic
+import sanic.response
+
+from .metrics import generate_metrics
+
+metrics = sanic.Blueprint("twitfix_metrics")
+
+
+@metrics.route("/metrics")  # Prometheus scrape target, summed over every worker
+async def prometheus_metrics(request):
+    return sanic.response.raw(
+        generate_metrics(),
+        content_type=prometheus_client.CONTENT_TYPE_LATEST,
+        headers={"cache-control": "no-cache"},
+    )
+
+
+@metrics.route("/breakers")  # Circuit breaker state of the worker answering
+async def breaker_state(request):
+    return sanic.response.json(
+        {
+            "worker": os.getpid(),
+            "breakers": {
+                name: breaker.snapshot()
+                for name, breaker in request.app.config.BREAKERS.items()
+            },
+        },
+        headers={"cache-control": "no-cache"},
+    )
@@ -1,21 +1,45 @@
+import hashlib
 import re
 import urllib
-from datetime import date
+from datetime import date, datetime, timezone
 
 import sanic
 import sanic.response
 from sanic.log import logger
 
+from . import serialization
+from .exceptions import InvalidCursor
 from .sanic_jinja import render_template
+from .timeseries import HOUR_FORMAT, Rollup
 
 stats = sanic.Blueprint("twitfix_stats")
 
+# What the latest and top listings return of a tweet, enough to show it.
+LISTING_FIELDS = (
+    "tweet",
+    "url",
+    "description",
+    "thumbnail",
+    "uploader",
+    "screen_name",
+    "pfp",
+    "type",
+    "images",
+    "hits",
+    "likes",
+    "rts",
+    "nsfw",
+    "qrt",
+)
+MAX_PAGE = 50
+
 
 @stats.route("/stats/")
 async def statsPage(request):
     today = str(date.today())
-    stats = request.app.config.STAT_MODULE.get_stats(today)
-    return render_template(
+    stats = await request.app.config.STAT_MODULE.get_stats(today)
+    return await render_template(
+        request,
         "stats.html",
         embeds=stats["embeds"],
         downloadss=stats["downloads"],
@@ -27,19 +51,20 @@ async def statsPage(request):
 
 @stats.route("/latest/")
 async def latest(request):
-    return render_template("latest.html")
+    return await render_template(request, "latest.html")
 
 
 @stats.route("/top/")  # Try to return the most hit video
 async def top(request):
     try:
-        [vnf] = request.app.config.LINKS_MODULE.get_links_from_cache("hits", 1, 0)
+        [vnf] = await request.app.config.LINKS_MODULE.get_links_from_cache("hits", 1, 0)
     except ValueError:
         logger.info(" ➤ [ ✔ ] Top video page loaded: None yet...")
         return sanic.response.empty()
     desc = re.sub(r" http.*t\.co\S+", "", vnf["description"])
     logger.info(" ➤ [ ✔ ] Top video page loaded: " + vnf["tweet"])
-    return render_template(
+    return await render_template(
+        request,
         "inline.html",
         page="Top",
         vidlink=vnf["url"],
@@ -56,46 +81,103 @@ async def top(request):
     )
 
 
-@stats.route("/api/latest/")  # Return some raw VNF data sorted by top tweets
+@stats.route("/api/latest/")  # Return some raw VNF data sorted by newest tweets
 async def apiLatest(request):
-    tweets = request.args.get("tweets", default=10, type=int)
-    page = request.args.get("page", default=0, type=int)
-
-    if tweets > 15:
-        tweets = 1
-
-    vnf = request.app.config.LINKS_MODULE.get_links_from_cache("_id", tweets, tweets * page)
-
     logger.info(" ➤ [ ✔ ] Latest video API called")
-    request.app.config.STAT_MODULE.add_to_stat("api")
-    return sanic.response.json(vnf)
+    return await listing(request, "_id")
 
 
 @stats.route("/api/top/")  # Return some raw VNF data sorted by top tweets
 async def apiTop(request):
-    tweets = request.args.get("tweets", default=10, type=int)
-    page = request.args.get("page", default=0, type=int)
+    logger.info(" ➤ [ ✔ ] Top video API called")
+    return await listing(request, "hits")
 
-    if tweets > 15:
-        tweets = 1
 
-    vnf = request.app.config.LINKS_MODULE.get_links_from_cache("hits", tweets, tweets * page)
+async def listing(request, field):
+    """
+    One page of tweets with the LISTING_FIELDS asked for in `fields`, and the `cursor`
+    that fetches the next page. Repeated requests for an unchanged page get a 304.
+    """
+    try:
+        tweets = max(1, min(int(request.args.get("tweets", 10)), MAX_PAGE))
+        page = int(request.args.get("page", 0))
+    except ValueError:
+        return sanic.response.json({"error": "Invalid page"}, status=400)
+    fields = LISTING_FIELDS
+    if "fields" in request.args:
+        wanted = request.args.get("fields").split(",")
+        fields = tuple(name for name in LISTING_FIELDS if name in wanted)
+    try:
+        vnfs = await request.app.config.LINKS_MODULE.get_links_from_cache(
+            field,
+            tweets,
+            tweets * page,
+            projection=fields,
+            cursor=request.args.get("cursor"),
+        )
+    except InvalidCursor:
+        return sanic.response.json({"error": "Invalid cursor"}, status=400)
+    await request.app.config.STAT_MODULE.add_to_stat("api")
+
+    body = serialization.dumpb(
+        {
+            "tweets": [{name: vnf.get(name) for name in fields} for vnf in vnfs],
+            "cursor": getattr(vnfs, "cursor", None),
+        }
+    )
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    max_age = request.app.config.get("LISTING_MAX_AGE", 10)
+    headers = {"etag": etag, "cache-control": f"public, max-age={max_age}"}
+    matches = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in matches.split(",")):
+        return sanic.response.empty(status=304, headers=headers)
+    return sanic.response.raw(body, headers=headers, content_type="application/json")
 
-    logger.info(" ➤ [ ✔ ] Top video API called")
-    request.app.config.STAT_MODULE.add_to_stat("api")
-    return sanic.response.json(vnf)
 
 @stats.route(
     "/api/stats/"
 )  # Return a json of a usage stats for a given date (defaults to today)
 async def apiStats(request):
     try:
-        request.app.config.STAT_MODULE.add_to_stat("api")
-        today = str(date.today())
-        desiredDate = request.args.get("date", default=today, type=str)
-        stat = request.app.config.STAT_MODULE.get_stats(desiredDate)
+        await request.app.config.STAT_MODULE.add_to_stat("api")
+        percentiles = [
+            float(q)
+            for q in request.args.get("percentiles", default="50,90,99").split(",")
+        ]
+        if "minutes" in request.args:
+            # Recent traffic as seen by the worker answering this request, not yet rolled up.
+            minutes = int(request.args.get("minutes"))
+            stat = {
+                "minutes": minutes,
+                **request.app.config.TIMESERIES.window(minutes).summary(percentiles),
+            }
+        elif "from" in request.args:
+            start = request.args.get("from")
+            end = request.args.get(
+                "to", default=datetime.now(timezone.utc).strftime(HOUR_FORMAT)
+            )
+            hours = await request.app.config.STAT_MODULE.get_rollups(start, end)
+            total = Rollup()
+            for hour in hours:
+                total.merge(Rollup.from_dict(hour))
+            stat = {
+                "from": start,
+                "to": end,
+                **total.summary(percentiles),
+                "hours": [
+                    {
+                        "hour": hour["hour"],
+                        **Rollup.from_dict(hour).summary(percentiles),
+                    }
+                    for hour in hours
+                ],
+            }
+        else:
+            today = str(date.today())
+            desiredDate = request.args.get("date", today)
+            stat = await request.app.config.STAT_MODULE.get_stats(desiredDate)
         logger.info(" ➤ [ ✔ ] Stats API called")
         return sanic.response.json(stat)
     except:
         logger.info(" ➤ [ ✔ ] Stats API failed")
-        return sanic.response.empty(500)
+        return sanic.response.empty(status=500)
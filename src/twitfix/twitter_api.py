@@ -1,14 +1,18 @@
-import json
 from datetime import datetime, timedelta
-from types import SimpleNamespace
-from typing import Dict, Literal, Sequence, Tuple
+from typing import Dict, Literal, Sequence, Tuple, TypedDict
 
 import httpx
 
+from . import serialization
+
 TWITTER_CREDENTIAL_REFRESH = timedelta(minutes=110)
 
 
-class User:
+# Responses are decoded into plain dicts, these describe them. The API leaves out fields
+# of total=False structures when they do not apply.
+
+
+class User(TypedDict):
     id: str
     username: str
     name: str
@@ -16,19 +20,19 @@ class User:
     protected: bool
 
 
-class TweetReference:
+class TweetReference(TypedDict):
     type: str
     id: str  # Tweet ID
 
 
-class TweetAttachments:
+class TweetAttachments(TypedDict):
     media_keys: Sequence[str]  # Media IDs
 
 
-class Tweet:
+class Tweet(TypedDict, total=False):
     text: str
     id: str
-    in_reply_to_user_id: str | None
+    in_reply_to_user_id: str
     lang: str
     author_id: str
     possibly_sensitive: bool
@@ -38,13 +42,13 @@ class Tweet:
     created_at: str  # ISO datetime
 
 
-class MediaVideoItem:
-    bit_rate: int
+class MediaVideoItem(TypedDict, total=False):
+    bit_rate: int  # Missing on streaming playlists
     content_type: str
     url: str
 
 
-class MediaPhoto:
+class MediaPhoto(TypedDict):
     media_key: str
     type: Literal["photo"]
     width: int
@@ -52,30 +56,58 @@ class MediaPhoto:
     url: str
 
 
-class MediaVideo:
+class MediaVideo(TypedDict, total=False):
     media_key: str
     type: Literal["video", "animated_gif"]
     width: int
     height: int
+    duration_ms: int
     variants: Sequence[MediaVideoItem]
 
 
-class Includes:
-    media: Dict[str, MediaVideo | MediaPhoto]
-    users: Dict[str, User]
-    tweets: Dict[str, Tweet]
+class Includes(TypedDict):
+    media: Dict[str, MediaVideo | MediaPhoto]  # By media key
+    users: Dict[str, User]  # By user ID
+    tweets: Dict[str, Tweet]  # By tweet ID
 
 
-class TweetsResponse:
-    data: Sequence[Tweet]
+class TweetsResponse(TypedDict):
+    data: Dict[str, Tweet]  # By tweet ID
     includes: Includes
+    errors: Sequence[dict]  # Tweets that could not be returned
+
+
+class UsersResponse(TypedDict):
+    data: Dict[str, User]  # By user ID
+    errors: Sequence[dict]
+
 
+def parse_tweets_response(payload: str | bytes) -> TweetsResponse:
+    """
+    Decode a /2/tweets response, with the tweets and expansions mapped by their IDs.
+    """
+    response = serialization.loads(payload)
+    includes = response.get("includes", {})
+    return {
+        "data": {tweet["id"]: tweet for tweet in response.get("data", ())},
+        "includes": {
+            "media": {media["media_key"]: media for media in includes.get("media", ())},
+            "users": {user["id"]: user for user in includes.get("users", ())},
+            "tweets": {tweet["id"]: tweet for tweet in includes.get("tweets", ())},
+        },
+        "errors": response.get("errors", []),
+    }
 
-class UsersResponse:
-    data: Sequence[User]
 
+def parse_users_response(payload: str | bytes) -> UsersResponse:
+    response = serialization.loads(payload)
+    return {
+        "data": {user["id"]: user for user in response.get("data", ())},
+        "errors": response.get("errors", []),
+    }
 
-def credentialed_client(api_key: str, api_secret: str):
+
+def credentialed_client(api_key: str, api_secret: str, api_base: str):
     token: str
     expires: datetime = datetime.now()
     client = httpx.AsyncClient()
@@ -84,7 +116,7 @@ def credentialed_client(api_key: str, api_secret: str):
         nonlocal token, expires
         if expires < datetime.now():
             res = await client.post(
-                "https://api.twitter.com/oauth2/token",
+                f"{api_base}/oauth2/token",
                 data={"grant_type": "client_credentials"},
                 auth=(api_key, api_secret),
             )
@@ -97,31 +129,17 @@ def credentialed_client(api_key: str, api_secret: str):
     return httpx.AsyncClient(event_hooks={"request": [token_auth]})
 
 
-def convert_tweets_lists_to_map(obj):
-    # convert data
-    obj.data = {i["id"]: i for i in obj.data}
-    # convert media
-    obj.includes.media = {i["media_key"]: i for i in obj.includes.media or []}
-    # convert users
-    obj.includes.users = {i["id"]: i for i in obj.includes.users or []}
-    # convert extra tweets
-    obj.includes.tweets = {i["id"]: i for i in obj.includes.tweets or []}
-    return obj
-
-
-def convert_users_lists_to_map(obj):
-    # convert data
-    obj.data = {i["id"]: i for i in obj.data}
-    return obj
-
-
 class Twitter:
     __client: httpx.AsyncClient
+    __api_base: str
 
     @classmethod
-    def from_credentials(cls, api_key: str, api_secret: str):
+    def from_credentials(
+        cls, api_key: str, api_secret: str, api_base: str = "https://api.twitter.com"
+    ):
         instance = cls()
-        instance.__client = credentialed_client(api_key, api_secret)
+        instance.__client = credentialed_client(api_key, api_secret, api_base)
+        instance.__api_base = api_base
         return instance
 
     @property
@@ -131,7 +149,7 @@ class Twitter:
     async def tweets(self, *ids) -> TweetsResponse:
         response: httpx.Response = await self.__client.request(
             "GET",
-            "https://api.twitter.com/2/tweets",
+            f"{self.__api_base}/2/tweets",
             params={
                 "ids": ",".join(ids),
                 "expansions": ",".join(
@@ -172,13 +190,12 @@ class Twitter:
                 ),
             },
         )
-        output = json.loads(response.text, object_hook=lambda d: SimpleNamespace(**d))
-        return convert_tweets_lists_to_map(output)
+        return parse_tweets_response(response.content)
 
     async def users(self, *users) -> UsersResponse:
         response: httpx.Response = await self.__client.request(
             "GET",
-            "https://api.twitter.com/2/users",
+            f"{self.__api_base}/2/users",
             params={
                 "ids": ",".join(users),
                 "user.fields": ",".join(
@@ -186,5 +203,4 @@ class Twitter:
                 ),
             },
         )
-        output = json.loads(response.text, object_hook=lambda d: SimpleNamespace(**d))
-        return convert_users_lists_to_map(output)
+        return parse_users_response(response.content)
@@ -0,0 +1,182 @@
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import sanic
+
+from .crawlers import crawler_profile
+from .metrics import VIDEO_VARIANTS
+
+# Where a video is handed out: in an embed, rehosted by /dl/ and .mp4 links, or by
+# the d. host and /dir/.
+ROUTES = ("embed", "download", "direct")
+
+# Smallest acceptable resolution by route, as the short side in pixels. None takes
+# the best variant there is.
+DEFAULT_RESOLUTIONS = {"embed": 360, "download": 720, "direct": 720}
+
+resolution_path = re.compile(r"/(\d+)x(\d+)/")
+
+
+class VariantPolicy(NamedTuple):
+    """
+    Take the smallest variant of at least `resolution`, leaving out those larger
+    than `max_bytes` unless nothing else is left.
+    """
+
+    resolution: Optional[int] = None
+    max_bytes: Optional[int] = None
+
+
+def api_variants(video_info: dict) -> List[dict]:
+    """
+    The MP4 variants of a v1.1 API video, smallest first. The API does not tell
+    their resolution and size, those come from the URL and the bitrate.
+    """
+    duration = video_info.get("duration_millis", 0) / 1000
+    variants = []
+    for video in video_info.get("variants", ()):
+        if video.get("content_type") != "video/mp4":
+            continue
+        width, height = variant_resolution(video["url"])
+        bitrate = video.get("bitrate", 0)
+        variants.append(
+            {
+                "url": video["url"],
+                "bitrate": bitrate,
+                "width": width,
+                "height": height,
+                "size": int(bitrate / 8 * duration),
+            }
+        )
+    return sorted(variants, key=lambda variant: variant["bitrate"])
+
+
+def youtubedl_variants(result: dict) -> List[dict]:
+    """
+    The progressive MP4 formats youtube-dl found, smallest first.
+    """
+    variants = []
+    for video in result.get("formats") or ():
+        if video.get("ext") != "mp4" or not str(video.get("protocol")).startswith(
+            "http"
+        ):
+            continue
+        bitrate = int((video.get("tbr") or 0) * 1000)
+        variants.append(
+            {
+                "url": video["url"],
+                "bitrate": bitrate,
+                "width": video.get("width") or 0,
+                "height": video.get("height") or 0,
+                "size": video.get("filesize")
+                or int(bitrate / 8 * (result.get("duration") or 0)),
+            }
+        )
+    return sorted(variants, key=lambda variant: variant["bitrate"])
+
+
+def variant_resolution(url: str) -> Tuple[int, int]:
+    match = resolution_path.search(url)
+    if match is None:
+        return 0, 0
+    return int(match.group(1)), int(match.group(2))
+
+
+def select_variant(variants: List[dict], policy: VariantPolicy) -> Optional[dict]:
+    """
+    The variant `policy` picks out of `variants`, which are ordered smallest first.
+    """
+    if not variants:
+        return None
+    fitting = [
+        variant
+        for variant in variants
+        if policy.max_bytes is None
+        or not variant.get("size")
+        or variant["size"] <= policy.max_bytes
+    ] or variants[:1]
+    if policy.resolution is not None:
+        for variant in fitting:
+            if min(variant["width"], variant["height"]) >= policy.resolution:
+                return variant
+    return fitting[-1]
+
+
+def parse_resolutions(value) -> Dict[Tuple[str, Optional[str]], Optional[int]]:
+    """
+    Resolutions come as a mapping, or from the environment as
+    "route=pixels,route.profile=pixels", where "best" takes the best variant.
+    """
+    if not isinstance(value, dict):
+        value = dict(
+            item.split("=", 1) for item in str(value or "").split(",") if "=" in item
+        )
+    resolutions = {}
+    for key, resolution in value.items():
+        route, _, profile = key.strip().partition(".")
+        if route not in ROUTES:
+            raise ValueError(f"Unknown video route {route!r}")
+        resolution = str(resolution).strip()
+        resolutions[route, profile or None] = (
+            None if resolution == "best" else int(resolution)
+        )
+    return resolutions
+
+
+def parse_size_limits(value) -> Dict[str, int]:
+    """
+    Size limits come as a mapping, or from the environment as "profile=megabytes".
+    """
+    if not isinstance(value, dict):
+        value = dict(
+            item.split("=", 1) for item in str(value or "").split(",") if "=" in item
+        )
+    return {
+        profile.strip(): int(float(megabytes) * 2**20)
+        for profile, megabytes in value.items()
+    }
+
+
+def variant_policy(request: sanic.Request, route: str) -> VariantPolicy:
+    profile = crawler_profile(request.headers.get("user-agent"))
+    name = profile.name if profile is not None else None
+    resolutions = request.app.config.VARIANT_RESOLUTIONS
+    return VariantPolicy(
+        resolutions.get((route, name), resolutions[route, None]),
+        request.app.config.VARIANT_SIZE_LIMITS.get(name),
+    )
+
+
+def video_variant(request: sanic.Request, vnf: dict, route: str) -> dict:
+    """
+    The variant of the video in `vnf` to hand out on `route` to this client. Links
+    cached before variants were kept only have their best one.
+    """
+    variant = select_variant(vnf.get("variants") or [], variant_policy(request, route))
+    if variant is None:
+        variant = {"url": vnf["url"], "width": 0, "height": 0}
+    VIDEO_VARIANTS.labels(route, min(variant["width"], variant["height"])).inc()
+    return variant
+
+
+def initialize_variants(app: sanic.Sanic):
+    """
+    VIDEO_RESOLUTIONS sets the smallest acceptable resolution by route, and by route
+    and crawler profile; VIDEO_SIZE_LIMITS caps the size of videos by crawler profile.
+    """
+
+    @app.before_server_start
+    def configure_variants(app: sanic.Sanic, loop):
+        resolutions = {
+            (route, None): resolution
+            for route, resolution in DEFAULT_RESOLUTIONS.items()
+        }
+        resolutions.update(parse_resolutions(app.config.get("VIDEO_RESOLUTIONS")))
+        app.config.update(
+            {
+                "VARIANT_RESOLUTIONS": resolutions,
+                "VARIANT_SIZE_LIMITS": parse_size_limits(
+                    app.config.get("VIDEO_SIZE_LIMITS")
+                ),
+            }
+        )
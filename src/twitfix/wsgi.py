@@ -2,6 +2,7 @@ import multiprocessing
 import os
 
 from .routes import app
+from .structured_logging import initialize_logging
 
 if app.config.get("DEPLOY_TARGET") == "GCP":
     import google.cloud.logging_v2
@@ -10,17 +11,26 @@ if app.config.get("DEPLOY_TARGET") == "GCP":
 
     client = google.cloud.logging_v2.Client()
     client.setup_logging()
-    init_cloud_logging(app)
+    capture_request_data = init_cloud_logging(app, client)
+    initialize_logging(app, record_filters=[capture_request_data])
 else:
     import logging.config
 
     import sanic.log
 
-    logging.config.dictConfig(sanic.log.LOGGING_CONFIG_DEFAULTS)
+    defaults = sanic.log.LOGGING_CONFIG_DEFAULTS
+    generic = {
+        **defaults["formatters"]["generic"],
+        "class": "twitfix.structured_logging.StructuredFormatter",
+    }
+    logging.config.dictConfig(
+        {**defaults, "formatters": {**defaults["formatters"], "generic": generic}}
+    )
+    initialize_logging(app)
 
 
 def main():
-    workers = multiprocessing.cpu_count()
+    workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
     port = int(os.environ.get("PORT", "8080"))
     app.run(host="0.0.0.0", port=port, workers=workers, debug=False, access_log=False)
 
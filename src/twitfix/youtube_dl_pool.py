@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import sanic
+
+from .metrics import YOUTUBE_DL_QUEUE_SECONDS, YOUTUBE_DL_SECONDS
+from .startup import lazy_import
+
+youtube_dl = lazy_import("youtube_dl")
+
+YOUTUBE_DL_PARAMS = {"outtmpl": "%(id)s.%(ext)s"}
+TWEET_EXTRACTOR = "Twitter"
+
+
+class YoutubeDLPool:
+    """
+    Long lived YoutubeDL instances, one per thread of a small executor.
+
+    A YoutubeDL is expensive to set up and not thread safe, so every thread keeps its
+    own. Keeping them around also keeps the extractor instances, with their guest
+    token and cookies, so those are not fetched again for every tweet.
+    """
+
+    # LazyLoader is not safe to trigger from several threads at once.
+    creating = threading.Lock()
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.local = threading.local()
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(
+            self.workers, thread_name_prefix="youtube-dl"
+        )
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def instance(self):
+        ydl = getattr(self.local, "ydl", None)
+        if ydl is None:
+            with self.creating:
+                ydl = youtube_dl.YoutubeDL(YOUTUBE_DL_PARAMS)
+                # Instantiated once here, then cached by the YoutubeDL.
+                ydl.get_info_extractor(TWEET_EXTRACTOR)
+            self.local.ydl = ydl
+        return ydl
+
+    def extract(self, url: str, queued: float) -> dict:
+        YOUTUBE_DL_QUEUE_SECONDS.observe(time.perf_counter() - queued)
+        ydl = self.instance()
+        # Tweets go straight to the Twitter extractor instead of asking every
+        # extractor whether it is suitable, anything else takes the usual route.
+        ie_key = (
+            TWEET_EXTRACTOR
+            if ydl.get_info_extractor(TWEET_EXTRACTOR).suitable(url)
+            else None
+        )
+        started = time.perf_counter()
+        outcome = "failure"
+        try:
+            result = ydl.extract_info(url, download=False, ie_key=ie_key)
+            outcome = "success"
+            return result
+        except Exception:
+            # The guest token or cookies may have gone stale, start over next time.
+            self.local.ydl = None
+            raise
+        finally:
+            YOUTUBE_DL_SECONDS.labels(ie_key or "any", outcome).observe(
+                time.perf_counter() - started
+            )
+
+    async def extract_info(self, url: str) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.extract, url, time.perf_counter()
+        )
+
+    async def warm(self):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(self.executor, self.instance)
+                for _ in range(self.workers)
+            )
+        )
+
+
+def initialize_youtube_dl(app: sanic.Sanic):
+    pool = YoutubeDLPool(app.config.get("YOUTUBE_DL_WORKERS", 4))
+    app.config.update({"YOUTUBE_DL": pool})
+
+    @app.before_server_start
+    def start_pool(app: sanic.Sanic, loop):
+        pool.start()
+
+    @app.after_server_start
+    async def warm_pool(app: sanic.Sanic, loop):
+        # In the background, so it does not hold up the worker becoming ready.
+        if app.config.DOWNLOAD_METHOD in ("youtube-dl", "hybrid"):
+            app.add_task(pool.warm())
+
+    @app.after_server_stop
+    def stop_pool(app: sanic.Sanic, loop):
+        pool.stop()